@@ -0,0 +1,70 @@
+# benchmarks/bench_context_cache.py (コンテキストキャッシュで送る入力トークン数の確認)
+#
+# 使い方: python benchmarks/bench_context_cache.py [--messages 40] [--max-history 20] [--entry-chars 800]
+# ネットワークに接続せず、スタブのキャッシュバックエンド (utils.context_cache.StubCacheBackend) とスタブクライアントで
+# 会話を再現する。1メッセージごとに履歴へ2件 (ユーザー・Bot) 追加し、max_history 件を超えた古いものを押し出す。
+# キャッシュなしとありで、API に送った入力トークン数 (キャッシュから読んだ分を除く) とキャッシュの作成回数を比べる。
+
+import sys
+import asyncio
+import argparse
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import gemini_client
+from utils import config_manager
+from utils import context_cache
+from utils import token_estimator
+from utils.gemini_pool import GeminiClientPool, PoolEndpoint
+
+
+def content(role: str, text: str):
+    return SimpleNamespace(role=role, parts=[SimpleNamespace(text=text)])
+
+class StubAsyncModels:
+    def __init__(self, backend: context_cache.StubCacheBackend): self.backend = backend
+    async def generate_content(self, *, model, contents, config=None):
+        tokens = token_estimator.estimate_contents_tokens(list(contents) + ([config.system_instruction] if config.system_instruction else []))
+        cached = self.backend.token_counts.get(config.cached_content, 0) if config.cached_content else 0
+        return SimpleNamespace(text="ok", usage_metadata=SimpleNamespace(prompt_token_count=tokens + cached, cached_content_token_count=cached,
+                                                                        total_token_count=tokens + cached))
+
+async def run(messages: int, max_history: int, entry_chars: int, enabled: bool) -> dict:
+    backend = context_cache.StubCacheBackend()
+    manager = config_manager.gemini_context_cache
+    manager.set_backend_factory(lambda endpoint: backend)
+    manager.configure(enabled, ttl=3600, min_tokens=1000, max_delta=8)
+    manager.reset_stats()
+    config_manager.bot_settings['gemini_rpm_limit'] = 0
+    pool = GeminiClientPool([PoolEndpoint("stub", SimpleNamespace(aio=SimpleNamespace(models=StubAsyncModels(backend))))])
+    persona = content("system", "ペルソナ" * 1000)
+    history = []
+    for i in range(messages):
+        current = content("user", f"メッセージ {i}")
+        instructions = content("user", "リクエストごとの指示" * 20)
+        config = SimpleNamespace(system_instruction=content("system", persona.parts[0].text + instructions.parts[0].text), tools=None, cached_content=None)
+        request = context_cache.CacheableRequest(persona, None, history, [instructions, current])
+        await gemini_client.generate_content_async(pool, model="stub", contents=history + [current], config=config, cache_request=request)
+        await asyncio.sleep(0) # 裏で行うキャッシュの作成を進める
+        history = (history + [content("user", f"[user]: {i} {'あ' * entry_chars}"), content("model", f"[bot]: {i} {'い' * entry_chars}")])[-max_history:]
+    stats = manager.stats()
+    stats["deleted"] = len(backend.deleted)
+    return stats
+
+async def main(messages: int, max_history: int, entry_chars: int):
+    print(f"{messages} messages, max_history {max_history}, {entry_chars} chars per entry, persona ~2000 tokens")
+    for enabled in (False, True):
+        stats = await run(messages, max_history, entry_chars, enabled)
+        print(f"{'cached  ' if enabled else 'uncached'}: uncached input {stats['uncached_input_tokens']:8d} tokens, "
+              f"cached input {stats['cached_input_tokens']:8d} tokens, requests with cache {stats['requests_cached']:3d}/{messages}, "
+              f"caches created {stats['creations']} (deleted {stats['deleted']})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare input tokens sent with and without Gemini context caching (stub backend).")
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--max-history", type=int, default=20)
+    parser.add_argument("--entry-chars", type=int, default=800)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.max_history, args.entry_chars))
@@ -0,0 +1,89 @@
+# benchmarks/bench_gemini_concurrency.py (Gemini 呼び出しの同時実行性の確認)
+#
+# 使い方: python benchmarks/bench_gemini_concurrency.py [--concurrency 8] [--delay 0.5]
+# ネットワークに接続せず、応答に delay 秒かかるスタブクライアントで N 件の呼び出しを同時に行い、
+# 従来の同期呼び出し (イベントループ上で直列) と utils.gemini_client 経由の呼び出しの所要時間を比べる。
+# 非同期API・スレッドプールのフォールバックとも、N 件がほぼ delay 秒で終われば重なって実行されている。
+# --max-concurrency を指定すると実行枠 (config_manager.gemini_scheduler) の上限を変えて測る (既定は N)。
+
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import gemini_client
+from utils import config_manager
+from utils.gemini_pool import GeminiClientPool, PoolEndpoint
+
+
+class StubModels:
+    def __init__(self, delay: float): self.delay = delay
+    def generate_content(self, *, model, contents, config=None):
+        time.sleep(self.delay)
+        return SimpleNamespace(text=f"echo: {contents}")
+
+class StubAsyncModels:
+    def __init__(self, delay: float): self.delay = delay
+    async def generate_content(self, *, model, contents, config=None):
+        await asyncio.sleep(self.delay)
+        return SimpleNamespace(text=f"echo: {contents}")
+
+def make_client(delay: float, with_aio: bool):
+    client = SimpleNamespace(models=StubModels(delay))
+    if with_aio: client.aio = SimpleNamespace(models=StubAsyncModels(delay))
+    return client
+
+def make_pool(delay: float, with_aio: bool) -> GeminiClientPool:
+    config_manager.bot_settings['gemini_rpm_limit'] = 0 # スタブなのでクォータは無制限にする
+    return GeminiClientPool([PoolEndpoint("stub", make_client(delay, with_aio))])
+
+async def run_blocking(client, count: int) -> float:
+    async def one(i):
+        return client.models.generate_content(model="stub", contents=f"message {i}") # 変更前と同じくループを止める
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return time.perf_counter() - start
+
+async def run_helper(client, count: int) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(gemini_client.generate_content_async(client, model="stub", contents=f"message {i}") for i in range(count)))
+    return time.perf_counter() - start
+
+async def check_timeout_and_cancel(delay: float):
+    client = make_pool(delay, with_aio=True)
+    try:
+        await gemini_client.generate_content_async(client, model="stub", contents="slow", timeout=delay / 5)
+        print("timeout        : NOT raised (unexpected)")
+    except asyncio.TimeoutError:
+        print(f"timeout        : raised after {delay / 5:.2f}s as expected")
+    task = asyncio.create_task(gemini_client.generate_content_async(client, model="stub", contents="cancel me"))
+    await asyncio.sleep(delay / 5)
+    task.cancel()
+    try:
+        await task
+        print("cancellation   : request completed (unexpected)")
+    except asyncio.CancelledError:
+        print("cancellation   : request cancelled as expected")
+
+async def main(concurrency: int, delay: float, max_concurrency: int):
+    config_manager.gemini_scheduler.set_max_concurrency(max_concurrency)
+    print(f"{concurrency} concurrent requests, stub latency {delay:.2f}s each, scheduler limit {max_concurrency}")
+    blocking = await run_blocking(make_client(delay, with_aio=False), concurrency)
+    aio = await run_helper(make_pool(delay, with_aio=True), concurrency)
+    fallback = await run_helper(make_pool(delay, with_aio=False), concurrency)
+    print(f"blocking sync  : {blocking:6.2f}s")
+    print(f"aio            : {aio:6.2f}s")
+    print(f"executor (max {gemini_client.FALLBACK_MAX_WORKERS}): {fallback:6.2f}s")
+    await check_timeout_and_cancel(delay)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show that Gemini requests overlap instead of running one after another.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.delay, args.max_concurrency or args.concurrency))
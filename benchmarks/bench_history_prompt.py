@@ -0,0 +1,53 @@
+# benchmarks/bench_history_prompt.py (履歴を API 用の Content に整形する時間の比較)
+#
+# 使い方: python benchmarks/bench_history_prompt.py [--sizes 20 500 5000] [--messages 200]
+# 満杯の履歴に1メッセージごとに1件追加し (古い1件が押し出される)、そのたびにプロンプト用の履歴を作る。
+# 毎回すべてのエントリを整形する方法 (変更前と同じ) と utils.history_prompt.HistoryPromptFormatter の差分整形を比べる。
+# 結果が同じであることも確かめる。google-genai が必要。
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.history_models import ROLE_MODEL, ROLE_USER, HistoryEntry, HistoryPart
+from utils.history_prompt import HistoryPromptFormatter, format_entry
+
+BOT_NAME = "Bot"
+
+
+def make_entry(i: int) -> HistoryEntry:
+    role = ROLE_MODEL if i % 2 else ROLE_USER
+    return HistoryEntry(role=role, parts=(HistoryPart(text=f"  メッセージ {i} " + "あいうえお" * 20 + "  "),),
+                        interlocutor_id=0 if role == ROLE_MODEL else 1000 + i % 7, channel_id=1, current_interlocutor_id=1000 + i % 7)
+
+def speaker_name(entry: HistoryEntry, bot_name: str) -> str:
+    return bot_name if entry.role == ROLE_MODEL else f"user{entry.interlocutor_id}"
+
+def format_all(snapshot):
+    """変更前と同じく、毎回すべてのエントリを整形する"""
+    return [content for content in (format_entry(entry, speaker_name(entry, BOT_NAME)) for entry in snapshot) if content is not None]
+
+def run(size: int, messages: int):
+    history = [make_entry(i) for i in range(size)]
+    formatter = HistoryPromptFormatter(speaker_name)
+    formatter.format(tuple(history), 1, BOT_NAME) # 起動後の最初の1回 (全件の整形) は計測に含めない
+    timings = {"full": 0.0, "incremental": 0.0}
+    for i in range(size, size + messages):
+        history = history[1:] + [make_entry(i)]
+        snapshot = tuple(history)
+        start = time.perf_counter(); full = format_all(snapshot); timings["full"] += time.perf_counter() - start
+        start = time.perf_counter(); incremental = formatter.format(snapshot, 1, BOT_NAME); timings["incremental"] += time.perf_counter() - start
+        assert [c.parts[0].text for c in incremental] == [c.parts[0].text for c in full]
+    print(f"{size:5d} entries: full {timings['full'] / messages * 1e3:8.3f} ms/prompt, "
+          f"incremental {timings['incremental'] / messages * 1e3:8.3f} ms/prompt "
+          f"({timings['full'] / max(timings['incremental'], 1e-9):6.1f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full vs incremental formatting of history into genai Content objects.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 500, 5000])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+    for size in args.sizes: run(size, args.messages)
@@ -0,0 +1,80 @@
+# benchmarks/bench_json_codec.py (JSONコーデックのベンチマーク)
+#
+# 使い方: python benchmarks/bench_json_codec.py [--sizes 1000 10000 100000] [--repeat 3]
+# user_data と会話履歴を模したデータについて、コーデック (json / orjson) と
+# 保存形式 (インデント付き / コンパクト) ごとのエンコード・デコード時間とサイズを表示する。
+
+import sys
+import time
+import random
+import argparse
+import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import json_codec
+
+
+def make_user_data(count: int) -> dict:
+    """user_data.json と同じ形のデータを生成する"""
+    now = datetime.datetime.now().astimezone()
+    data = {}
+    for i in range(count):
+        user_id = str(100000000000000000 + i)
+        data[user_id] = {
+            "nickname": f"ユーザー{i}",
+            "random_dm": {
+                "enabled": i % 3 == 0, "min_interval": 21600, "max_interval": 172800,
+                "stop_start_hour": 23, "stop_end_hour": 7,
+                "last_interaction": now - datetime.timedelta(minutes=i),
+                "next_send_time": now + datetime.timedelta(hours=i % 48),
+            },
+        }
+    return data
+
+def make_history(count: int) -> dict:
+    """conversation_history.json と同じ形のデータを生成する"""
+    rng = random.Random(0)
+    now = datetime.datetime.now().astimezone()
+    entries = []
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "model"
+        text = "こんにちは、今日はいい天気ですね。" * rng.randint(1, 8)
+        entries.append({
+            "role": role, "parts": [{"text": text}], "channel_id": 200000000000000000 + i % 20,
+            "interlocutor_id": 100000000000000000 + i % 50,
+            "current_interlocutor_id": 100000000000000000 + i % 50,
+            "timestamp": (now - datetime.timedelta(seconds=count - i)).isoformat(),
+        })
+    return {"global_history": entries, "last_seq": count}
+
+def _best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run(sizes, repeat: int):
+    codecs = json_codec.available_codecs()
+    if "orjson" not in codecs: print("(orjson is not installed; only the stdlib codec is measured)")
+    print(f"{'dataset':<10} {'entries':>8} {'codec':<7} {'format':<7} {'encode ms':>10} {'decode ms':>10} {'size KiB':>10}")
+    for dataset, factory in (("user_data", make_user_data), ("history", make_history)):
+        for size in sizes:
+            data = factory(size)
+            for codec in codecs.values():
+                for compact in (False, True):
+                    encoded = codec.dumps(data, compact)
+                    encode_time = _best_of(lambda: codec.dumps(data, compact), repeat)
+                    decode_time = _best_of(lambda: codec.loads(encoded), repeat)
+                    print(f"{dataset:<10} {size:>8} {codec.name:<7} {'compact' if compact else 'indent':<7} "
+                          f"{encode_time * 1000:>10.1f} {decode_time * 1000:>10.1f} {len(encoded) / 1024:>10.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON codecs used for on-disk data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
@@ -0,0 +1,102 @@
+# benchmarks/bench_prompt_templates.py (システムプロンプトの組み立て時間の比較)
+#
+# 使い方: python benchmarks/bench_prompt_templates.py [--iterations 20000] [--persona-chars 4000]
+# 変更前と同じ += の連結で毎回組み立てる方法と、utils.prompt_templates のコンパイル済みテンプレートを比べる。
+# テンプレートは「毎回違う値で埋める」場合 (キャッシュに当たらない) と「同じ値で続けて呼ぶ」場合 (Content を使い回す) を測る。
+# あわせて、GenerateContentConfig を毎回作る方法と config_manager.get_compiled_generation_config() の共有設定に
+# システムインストラクションだけを付ける方法も比べる。
+# google-genai が必要。
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from google.genai import types as genai_types
+
+from utils import config_manager
+from utils import prompt_templates
+
+
+def legacy_system_prompt(persona: str, display_name: str, user_id: int, call_name: str, channel_name: str, channel_id: int,
+                         mood: str, location: str, description: str, bot_name: str) -> genai_types.Content:
+    """変更前の ChatCog.create_system_prompt と同じ組み立て方"""
+    sys_prompt = persona
+    sys_prompt += f"\n\n--- ★★★ 現在の最重要情報 ★★★ ---"
+    sys_prompt += f"\nあなたは今、以下の Discord ユーザーと **直接** 会話しています。このユーザーに集中してください。"
+    sys_prompt += f"\n- ユーザー名: {display_name} (Discord 表示名)"
+    sys_prompt += f"\n- ユーザーID: {user_id}"
+    sys_prompt += f"\n- ★★ あなたが呼びかけるべき名前: 「{call_name}」 ★★"
+    sys_prompt += f"\n   (注: これは設定されたニックネーム、またはユーザー表示名です。)"
+    sys_prompt += f"\n- 会話の場所: サーバーチャンネル「{channel_name}」(ID: {channel_id})"
+    sys_prompt += "\n---------------------------------"
+    sys_prompt += f"\n\n--- あなたの現在の状態 ---"
+    sys_prompt += f"\nあなたは「{mood}」な気分です。これは {location} の天気 ({description}) に基づいています。応答には、この気分を自然に反映させてください。"
+    sys_prompt += f"\n\n--- ★★★ 応答生成時の最重要指示 ★★★ ---"
+    sys_prompt += f"\n1. **最優先事項:** 会話の相手は常に上記の「ユーザーID: {user_id}」を持つ人物です。応答する際は、**必ず、絶対に「{call_name}」という名前で呼びかけてください。** "
+    sys_prompt += f"\n2. **厳禁:** 過去の会話履歴には、他のユーザーとの会話や、あなた自身の過去の発言が含まれています。履歴を参照することは許可しますが、**現在の対話相手である「{call_name}」さんを、それ以外の会話相手の名前で絶対に呼ばないでください。** 過去の文脈に引きずられず、**現在の「{call_name}」さんとの対話にのみ集中してください。**"
+    sys_prompt += f"\n3. 履歴内の各発言には `[発言者名]:` というプレフィックスが付いています。これを注意深く確認し、現在の対話相手「{call_name}」さんとの文脈に関係のある情報か慎重に判断してください。"
+    sys_prompt += f"\n4. **厳禁:** あなたの応答の **いかなる部分にも** `[{bot_name}]:` や `[{call_name}]:` のような角括弧で囲まれた発言者名を含めてはいけません。あなたの応答は、会話本文のみで構成してください。"
+    sys_prompt += f"\n4. **応答を生成する前に、本当にあなたが今誰と会話しているのかを整理してください。**"
+    sys_prompt += f"\n5. {prompt_templates.CITATION_RULE}"
+    sys_prompt += "\n----------------------------------------\n"
+    return genai_types.Content(parts=[genai_types.Part(text=sys_prompt)], role="system")
+
+def template_system_prompt(display_name: str, user_id: int, call_name: str, channel_name: str, channel_id: int,
+                           mood: str, location: str, description: str, bot_name: str) -> genai_types.Content:
+    template = prompt_templates.get_template(prompt_templates.KIND_CHAT)
+    return template.system_instruction(display_name=display_name, user_id=user_id, call_name=call_name,
+                                       location=prompt_templates.chat_location(channel_name, channel_id),
+                                       mood_section=prompt_templates.mood_section(mood, location, description),
+                                       bot_name=bot_name, citation_rule=prompt_templates.citation_rule())
+
+def measure(label: str, build, iterations: int, vary: bool):
+    start = time.perf_counter()
+    for i in range(iterations):
+        user_id = i if vary else 1
+        build(f"user{user_id}", user_id, f"call{user_id}", "general", 123, "元気", "東京", "晴れ", "Bot")
+    elapsed = time.perf_counter() - start
+    print(f"{label:32s}: {elapsed / iterations * 1e6:7.2f} us/prompt")
+
+def legacy_generation_config(system_instruction: genai_types.Content) -> genai_types.GenerateContentConfig:
+    """変更前の ChatCog と同じく、メッセージごとに安全性設定・ツール・生成設定を作る"""
+    generation = config_manager.get_generation_config_dict()
+    return genai_types.GenerateContentConfig(
+        temperature=generation.get('temperature', 0.9), top_p=generation.get('top_p', 1.0), top_k=generation.get('top_k', 1),
+        candidate_count=generation.get('candidate_count', 1), max_output_tokens=generation.get('max_output_tokens', 1024),
+        safety_settings=[genai_types.SafetySetting(**s) for s in config_manager.get_safety_settings_list()],
+        tools=[genai_types.Tool(google_search=genai_types.GoogleSearch())], system_instruction=system_instruction)
+
+def compiled_generation_config(system_instruction: genai_types.Content) -> genai_types.GenerateContentConfig:
+    return config_manager.with_system_instruction(config_manager.get_compiled_generation_config(config_manager.GENERATION_KIND_CHAT), system_instruction)
+
+def measure_config(label: str, build, system_instruction: genai_types.Content, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations): build(system_instruction)
+    elapsed = time.perf_counter() - start
+    print(f"{label:32s}: {elapsed / iterations * 1e6:7.2f} us/config")
+
+def main(iterations: int, persona_chars: int):
+    config_manager.persona_prompt = "あ" * persona_chars
+    persona = config_manager.get_persona_prompt()
+    reference = legacy_system_prompt(persona, "user1", 1, "call1", "general", 123, "元気", "東京", "晴れ", "Bot")
+    assert template_system_prompt("user1", 1, "call1", "general", 123, "元気", "東京", "晴れ", "Bot").parts[0].text == reference.parts[0].text
+    print(f"{iterations} prompts, persona {persona_chars} chars")
+    measure("legacy += concatenation", lambda *a: legacy_system_prompt(persona, *a), iterations, vary=True)
+    measure("template (different users)", template_system_prompt, iterations, vary=True)
+    measure("template (same user, cached)", template_system_prompt, iterations, vary=False)
+    config_manager.gemini_config = {"safety_settings": [{"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in (
+        "HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT")]}
+    config_manager.bump_version("gemini_config")
+    assert compiled_generation_config(reference) == legacy_generation_config(reference)
+    measure_config("config built per message", legacy_generation_config, reference, iterations)
+    measure_config("compiled config + instruction", compiled_generation_config, reference, iterations)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare system prompt build time: legacy concatenation vs compiled templates.")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--persona-chars", type=int, default=4000)
+    args = parser.parse_args()
+    main(args.iterations, args.persona_chars)
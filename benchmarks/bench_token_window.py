@@ -0,0 +1,57 @@
+# benchmarks/bench_token_window.py (トークン予算による履歴の選び方と見積もりの速さの確認)
+#
+# 使い方: python benchmarks/bench_token_window.py [--sizes 20 500 5000] [--budget 32000] [--large-every 10]
+# 短い会話の中に、large-every 件ごとに ProcessingCog が読み込んだ PDF 全文のような長いエントリ (20000文字) を混ぜる。
+# 件数だけで制限する場合 (予算なし) と予算で制限する場合の、送る履歴の見積もりトークン数と選ぶ時間を比べる。
+# あわせて、日本語・英語のテキストを見積もる速さを測る。google-genai が必要。
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import token_estimator
+from utils.history_models import ROLE_MODEL, ROLE_USER, HistoryEntry, HistoryPart
+from utils.history_prompt import HistoryPromptFormatter
+
+SAMPLES = {
+    "ja": "今日はとても良い天気ですね。週末はどこかへ出かける予定がありますか？" * 20,
+    "en": "The quick brown fox jumps over the lazy dog. Do you have any plans for the weekend? " * 20,
+    "mixed": "このページ https://example.com/docs/getting-started によると、Gemini API は multimodal です。" * 20,
+}
+
+
+def make_entry(i: int, large_every: int) -> HistoryEntry:
+    role = ROLE_MODEL if i % 2 else ROLE_USER
+    text = f"メッセージ {i} " + ("PDFの本文 " * 4000 if large_every and i % large_every == 0 else "こんにちは、元気ですか？" * 5)
+    return HistoryEntry(role=role, parts=(HistoryPart(text=text),), interlocutor_id=0 if role == ROLE_MODEL else 1000)
+
+def bench_estimator(iterations: int = 20000):
+    for label, text in SAMPLES.items():
+        start = time.perf_counter()
+        for _ in range(iterations): tokens = token_estimator.estimate_text_tokens(text)
+        elapsed = time.perf_counter() - start
+        print(f"estimate {label:5s} ({len(text):5d} chars -> {tokens:5d} tokens): {elapsed / iterations * 1e6:6.2f} us")
+
+def bench_window(size: int, budget: int, large_every: int, repeats: int = 200):
+    snapshot = tuple(make_entry(i, large_every) for i in range(size))
+    formatter = HistoryPromptFormatter(lambda entry, bot_name: bot_name if entry.role == ROLE_MODEL else "user")
+    for label, token_budget in (("count only", None), (f"budget {budget}", budget)):
+        formatter.format(snapshot, 1, "Bot", token_budget=token_budget) # 整形は最初の1回だけ
+        start = time.perf_counter()
+        for _ in range(repeats): formatter.format(snapshot, 1, "Bot", token_budget=token_budget)
+        elapsed = time.perf_counter() - start
+        selected, available, tokens = formatter.last_window
+        print(f"{size:5d} entries, {label:12s}: {selected:5d} / {available:5d} entries, ~{tokens:8d} tokens, "
+              f"{elapsed / repeats * 1e3:7.3f} ms/prompt")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show token-budget history windowing and token estimator speed.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 500, 5000])
+    parser.add_argument("--budget", type=int, default=32000)
+    parser.add_argument("--large-every", type=int, default=10)
+    args = parser.parse_args()
+    bench_estimator()
+    for size in args.sizes: bench_window(size, args.budget, args.large_every)
@@ -4,7 +4,6 @@ import discord
 from discord.ext import commands
 import logging
 import datetime
-import os
 from google import genai
 from google.genai import types as genai_types
 from google.genai import errors as genai_errors
@@ -14,6 +13,14 @@ from typing import Optional, List, Dict, Any # ★ List, Dict, Any を追加
 # 他のCogやUtilsから必要なものをインポート
 from utils import config_manager
 from utils import helpers # ★ helpers をインポート
+from utils import gemini_client
+from utils import gemini_pool
+from utils import streaming
+from utils import response_cache
+from utils import context_cache
+from utils import prompt_templates
+from utils.message_coalescer import MessageCoalescer
+from utils import request_scheduler
 from cogs.history_cog import HistoryCog
 from cogs.processing_cog import ProcessingCog
 from cogs.weather_mood_cog import WeatherMoodCog
@@ -23,23 +30,21 @@ logger = logging.getLogger(__name__)
 class ChatCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.genai_client = None
+        self.genai_client: Optional[gemini_pool.GeminiClientPool] = None # 全 Cog で共有するクライアントプール
+        self._inflight_tasks: set = set() # 応答生成中の on_message タスク (アンロード時にキャンセルする)
+        self._coalescer = MessageCoalescer(*config_manager.get_message_coalesce_settings())
         self.initialize_genai_client()
         logger.info("ChatCog loaded.")
 
+    def cog_unload(self):
+        for task in list(self._inflight_tasks): task.cancel()
+        logger.info(f"ChatCog unloaded. Cancelled {len(self._inflight_tasks)} in-flight response(s).")
+
     def initialize_genai_client(self):
-        """Geminiクライアントを初期化/再初期化する"""
-        try:
-            api_key = os.getenv("GOOGLE_AI_KEY")
-            if not api_key:
-                logger.error("GOOGLE_AI_KEY not found in environment variables.")
-                self.genai_client = None
-                return
-            self.genai_client = genai.Client(api_key=api_key)
-            logger.info("Gemini client initialized successfully.")
-        except Exception as e:
-            logger.error("Failed to initialize Gemini client", exc_info=e)
-            self.genai_client = None
+        """Geminiクライアントプールを初期化/再初期化する (GOOGLE_AI_KEYS の複数キー、なければ GOOGLE_AI_KEY)"""
+        gemini_pool.reset_shared_pool()
+        self.genai_client = gemini_pool.get_shared_pool(lambda api_key: genai.Client(api_key=api_key))
+        if self.genai_client: logger.info("Gemini client initialized successfully.")
 
     # --- イベントリスナー ---
     @commands.Cog.listener()
@@ -48,10 +53,11 @@ class ChatCog(commands.Cog):
         if message.mention_everyone: return
 
         should_respond = False
+        priority = request_scheduler.PRIORITY_CHANNEL # Gemini API の実行枠を割り当てる優先度
         is_dm = isinstance(message.channel, discord.DMChannel)
-        if is_dm: should_respond = True
+        if is_dm: should_respond = True; priority = request_scheduler.PRIORITY_INTERACTIVE_DM
         elif message.guild:
-            if self.bot.user.mentioned_in(message): should_respond = True
+            if self.bot.user.mentioned_in(message): should_respond = True; priority = request_scheduler.PRIORITY_MENTION
             else:
                 server_id_str = str(message.guild.id)
                 # ★ get_allowed_channels のキーは str で取得
@@ -79,10 +85,35 @@ class ChatCog(commands.Cog):
              # await message.reply("エラー: AIサービスに接続できません。", mention_author=False)
              return
 
+        task = asyncio.current_task()
+        self._inflight_tasks.add(task)
+        try:
+            messages = [message]
+            self._coalescer.window, self._coalescer.typing_window, self._coalescer.max_wait = config_manager.get_message_coalesce_settings()
+            if self._coalescer.window > 0:
+                # 続けて送られたメッセージはまとめて1回だけ応答する (後続のメッセージは最初の呼び出しに合流して終わる)
+                messages = await self._coalescer.submit((message.author.id, message.channel.id), message)
+                if messages is None:
+                    logger.debug(f"Message {message.id} was merged into a pending batch.")
+                    return
+            await self._generate_and_reply(messages, is_dm, priority)
+        finally: self._inflight_tasks.discard(task)
+
+    @commands.Cog.listener()
+    async def on_typing(self, channel: discord.abc.Messageable, user: discord.abc.User, when: datetime.datetime):
+        if user.bot: return
+        self._coalescer.touch((user.id, channel.id))
+
+    async def _generate_and_reply(self, messages: List[discord.Message], is_dm: bool, priority: int):
+        """応答を生成して送信する (Gemini 呼び出しは非同期APIで行い、イベントループを止めない)
+
+        messages は同じユーザー・チャンネルから続けて届いたメッセージ (古い順)。内容を1つの Content に
+        まとめ、最後のメッセージに返信する。priority は Gemini API の実行枠を待つときの優先度。
+        """
+        message = messages[-1]
         async with message.channel.typing():
+            streamer: Optional[streaming.StreamingReply] = None
             try:
-                cleaned_text = helpers.clean_discord_message(message.content)
-                logger.debug(f"Cleaned message content: '{cleaned_text}'") # ★ログ追加
                 user_id = message.author.id
                 channel_id = message.channel.id if not is_dm else None
                 user_nickname = config_manager.get_nickname(user_id)
@@ -105,21 +136,24 @@ class ChatCog(commands.Cog):
                      return
 
                 # --- 履歴と現在のメッセージ内容を準備 ---
-                history_list = await history_cog.get_global_history_for_prompt()
-                logger.debug(f"Retrieved global history (length: {len(history_list)}) for prompt.")
+                history_list = await history_cog.get_scoped_history_for_prompt(message.guild.id if message.guild else None, channel_id, user_id)
+                logger.debug(f"Retrieved history {config_manager.history_key_for(message.guild.id if message.guild else None, channel_id, user_id)} (length: {len(history_list)}) for prompt.")
                 # logger.debug(f"Formatted history for prompt: {history_list}") # 必要なら詳細ログ
 
                 current_parts = []
-                if cleaned_text: current_parts.append(genai_types.Part(text=cleaned_text))
-                logger.debug(f"Processing attachments...")
-                attachment_parts = await processing_cog.process_attachments(message.attachments)
-                current_parts.extend(attachment_parts)
-                logger.debug(f"Processing URL in message (if any)...")
-                if not message.attachments: # 添付ファイルがない場合のみURL処理
-                    url_content_parts = await processing_cog.process_url_in_message(cleaned_text)
-                    if url_content_parts: current_parts.extend(url_content_parts)
-
-                logger.debug(f"Current message parts check: cleaned_text='{cleaned_text}', current_parts has {len(current_parts)} parts.")
+                for source_message in messages:
+                    cleaned_text = helpers.clean_discord_message(source_message.content)
+                    logger.debug(f"Cleaned message content: '{cleaned_text}'") # ★ログ追加
+                    if cleaned_text: current_parts.append(genai_types.Part(text=cleaned_text))
+                    logger.debug(f"Processing attachments...")
+                    attachment_parts = await processing_cog.process_attachments(source_message.attachments)
+                    current_parts.extend(attachment_parts)
+                    logger.debug(f"Processing URL in message (if any)...")
+                    if not source_message.attachments: # 添付ファイルがない場合のみURL処理
+                        url_content_parts = await processing_cog.process_url_in_message(cleaned_text)
+                        if url_content_parts: current_parts.extend(url_content_parts)
+
+                logger.debug(f"Current message parts check: {len(messages)} message(s), current_parts has {len(current_parts)} parts.")
 
                 if not current_parts:
                     logger.warning("No processable content found in the message. Stopping response.")
@@ -137,74 +171,71 @@ class ChatCog(commands.Cog):
                 logger.debug(f"Generation config: {generation_config_dict}")
                 logger.debug(f"Safety settings: {safety_settings_list}")
 
-                # --- システムインストラクション ---
+                # --- システムインストラクション (テンプレートは設定の版ごとにコンパイル済み。ここではリクエストごとの項目を埋めるだけ) ---
+                prompt_template = prompt_templates.get_template(prompt_templates.KIND_CHAT, message.guild.id if message.guild else None)
+                channel_name = message.channel.name if isinstance(message.channel, discord.TextChannel) else "不明なチャンネル"
+                prompt_values = {
+                    "display_name": message.author.display_name, "user_id": user_id, "call_name": call_name,
+                    "location": prompt_templates.chat_location(channel_name, channel_id),
+                    "mood_section": prompt_templates.mood_section(weather_mood_cog.get_current_mood(), weather_mood_cog.current_weather_location,
+                                                                  weather_mood_cog.current_weather_description) if weather_mood_cog else "",
+                    "bot_name": self.bot.user.display_name,
+                }
+
                 def create_system_prompt(add_recitation_warning=False):
-                    persona_prompt_base = config_manager.get_persona_prompt()
-                    sys_prompt = persona_prompt_base
-                    sys_prompt += f"\n\n--- ★★★ 現在の最重要情報 ★★★ ---"
-                    sys_prompt += f"\nあなたは今、以下の Discord ユーザーと **直接** 会話しています。このユーザーに集中してください。"
-                    sys_prompt += f"\n- ユーザー名: {message.author.display_name} (Discord 表示名)"
-                    sys_prompt += f"\n- ユーザーID: {user_id}"
-                    sys_prompt += f"\n- ★★ あなたが呼びかけるべき名前: 「{call_name}」 ★★"
-                    sys_prompt += f"\n   (注: これは設定されたニックネーム、またはユーザー表示名です。)"
-                    if channel_id:
-                        channel_name = message.channel.name if isinstance(message.channel, discord.TextChannel) else "不明なチャンネル"
-                        sys_prompt += f"\n- 会話の場所: サーバーチャンネル「{channel_name}」(ID: {channel_id})"
-                    else:
-                        sys_prompt += f"\n- 会話の場所: ダイレクトメッセージ (DM)"
-                    sys_prompt += "\n---------------------------------"
-                    current_mood = "普通"
-                    if weather_mood_cog:
-                        current_mood = weather_mood_cog.get_current_mood()
-                        last_loc = weather_mood_cog.current_weather_location
-                        last_desc = weather_mood_cog.current_weather_description
-                        if last_loc and last_desc:
-                            sys_prompt += f"\n\n--- あなたの現在の状態 ---"
-                            sys_prompt += f"\nあなたは「{current_mood}」な気分です。これは {last_loc} の天気 ({last_desc}) に基づいています。応答には、この気分を自然に反映させてください。"
-                        else:
-                            sys_prompt += f"\n\n--- あなたの現在の状態 ---"
-                            sys_prompt += f"\nあなたは「{current_mood}」な気分です。応答には、この気分を自然に反映させてください。"
-                    sys_prompt += f"\n\n--- ★★★ 応答生成時の最重要指示 ★★★ ---"
-                    sys_prompt += f"\n1. **最優先事項:** 会話の相手は常に上記の「ユーザーID: {user_id}」を持つ人物です。応答する際は、**必ず、絶対に「{call_name}」という名前で呼びかけてください。** "
-                    sys_prompt += f"\n2. **厳禁:** 過去の会話履歴には、他のユーザーとの会話や、あなた自身の過去の発言が含まれています。履歴を参照することは許可しますが、**現在の対話相手である「{call_name}」さんを、それ以外の会話相手の名前で絶対に呼ばないでください。** 過去の文脈に引きずられず、**現在の「{call_name}」さんとの対話にのみ集中してください。**"
-                    sys_prompt += f"\n3. 履歴内の各発言には `[発言者名]:` というプレフィックスが付いています。これを注意深く確認し、現在の対話相手「{call_name}」さんとの文脈に関係のある情報か慎重に判断してください。"
-                    sys_prompt += f"\n4. **厳禁:** あなたの応答の **いかなる部分にも** `[{self.bot.user.display_name}]:` や `[{call_name}]:` のような角括弧で囲まれた発言者名を含めてはいけません。あなたの応答は、会話本文のみで構成してください。"
-                    sys_prompt += f"\n4. **応答を生成する前に、本当にあなたが今誰と会話しているのかを整理してください。**"
-                    if add_recitation_warning:
-                        sys_prompt += f"\n5. **重要:** 前回の応答はウェブ検索結果等の引用が多すぎたため停止しました。**今回は検索結果をそのまま引用せず、必ず自分の言葉で要約・説明するようにしてください。** 引用符 `[]` も使わないでください。"
-                    else:
-                        sys_prompt += f"\n5. ウェブ検索結果などを参照する場合は、その内容を**必ず自分の言葉で要約・説明**してください。検索結果のテキストをそのまま長文でコピー＆ペーストする行為や、引用符 `[]` を使用することは禁止します。"
-                    sys_prompt += "\n----------------------------------------\n"
-                    logger.debug(f"Generated System Prompt (recitation warning: {add_recitation_warning}):\n{sys_prompt[:500]}...") # ★ログ追加
-                    return genai_types.Content(parts=[genai_types.Part(text=sys_prompt)], role="system")
+                    content = prompt_template.system_instruction(**prompt_values, citation_rule=prompt_templates.citation_rule(add_recitation_warning))
+                    logger.debug(f"Generated System Prompt (recitation warning: {add_recitation_warning}):\n{content.parts[0].text[:500]}...") # ★ログ追加
+                    return content
                 # --- システムインストラクションここまで ---
 
                 system_instruction_content = create_system_prompt()
-                safety_settings_for_api = [genai_types.SafetySetting(**s) for s in safety_settings_list]
-                tools_for_api = [genai_types.Tool(google_search=genai_types.GoogleSearch())]
-
-                final_generation_config = genai_types.GenerateContentConfig(
-                    temperature=generation_config_dict.get('temperature', 0.9),
-                    top_p=generation_config_dict.get('top_p', 1.0),
-                    top_k=generation_config_dict.get('top_k', 1),
-                    candidate_count=generation_config_dict.get('candidate_count', 1),
-                    max_output_tokens=generation_config_dict.get('max_output_tokens', 1024),
-                    safety_settings=safety_settings_for_api,
-                    tools=tools_for_api,
-                    system_instruction=system_instruction_content
-                )
+                # 生成設定・安全性設定・ツールは設定が変わるまで共有のものを使い、システムインストラクションだけを付ける
+                base_generation_config = config_manager.get_compiled_generation_config(config_manager.GENERATION_KIND_CHAT)
+                final_generation_config = config_manager.with_system_instruction(base_generation_config, system_instruction_content)
 
                 contents_for_api = []
                 contents_for_api.extend(history_list)
                 contents_for_api.append(current_content)
+                cache_request: Optional[context_cache.CacheableRequest] = None
+                if config_manager.get_context_cache_enabled():
+                    # ペルソナ・ツール・履歴はキャッシュに置けるようにし、リクエストごとの指示は今回のメッセージの先頭に付けて送る
+                    request_instructions = prompt_template.render_instructions(**prompt_values, citation_rule=prompt_templates.citation_rule()).strip()
+                    cache_request = context_cache.CacheableRequest(
+                        system_instruction=prompt_template.persona_content, tools=base_generation_config.tools, history=history_list,
+                        tail=[genai_types.Content(role="user", parts=[genai_types.Part(text=request_instructions)] + current_parts)],
+                        scope_key=config_manager.history_key_for(message.guild.id if message.guild else None, channel_id, user_id))
                 # logger.debug(f"Contents for API: {contents_for_api}") # 必要なら詳細ログ
 
-                logger.info(f"Sending request to Gemini. Model: {model_name}, History length: {len(history_list)}, Current parts: {len(current_parts)}") # ★ログ修正
-                response = self.genai_client.models.generate_content(
-                    model=model_name,
-                    contents=contents_for_api,
-                    config=final_generation_config,
-                )
+                # --- 応答キャッシュ (temperature が低い場合のみ、同じ入力への応答を再利用する) ---
+                cache_key: Optional[str] = None
+                cached_text: Optional[str] = None
+                if config_manager.is_response_cache_applicable(generation_config_dict):
+                    history_key = response_cache.history_digest(history_list) if config_manager.get_response_cache_include_history() else None
+                    # 呼びかける名前・ユーザー・チャンネルはキーに含めない (別のチャンネルで同じ内容・URL を聞かれても使える)
+                    cache_key = response_cache.make_cache_key(model_name, generation_config_dict, safety_settings_list, config_manager.get_version("prompts"),
+                                                              prompt_template.fingerprint, prompt_template.shared_values(prompt_values), current_parts, history_key)
+                    cached_text = config_manager.get_cached_response(cache_key)
+                    if cached_text is not None: cached_text = response_cache.personalize(cached_text, call_name)
+
+                if cached_text is not None:
+                    logger.info(f"Response cache hit for user {user_id}. Skipping Gemini request.")
+                    response = genai_types.GenerateContentResponse(candidates=[genai_types.Candidate(
+                        content=genai_types.Content(role="model", parts=[genai_types.Part(text=cached_text)]),
+                        finish_reason=genai_types.FinishReason.STOP)])
+                elif config_manager.get_streaming_responses_enabled():
+                    logger.info(f"Sending request to Gemini. Model: {model_name}, History length: {len(history_list)}, Current parts: {len(current_parts)}") # ★ログ修正
+                    # 届いた分から表示する (応答全体は従来どおり response にまとめて以降の処理に使う)
+                    streamer = streaming.StreamingReply(message, max_length=1900, max_total_length=config_manager.get_max_response_length(),
+                                                        edit_interval=config_manager.get_stream_edit_interval())
+                    response = await self._generate_streaming(streamer, model=model_name, contents=contents_for_api, config=final_generation_config,
+                                                              priority=priority, user_id=user_id, cache_request=cache_request)
+                else:
+                    logger.info(f"Sending request to Gemini. Model: {model_name}, History length: {len(history_list)}, Current parts: {len(current_parts)}") # ★ログ修正
+                    response = await gemini_client.generate_content_async(
+                        self.genai_client, model=model_name, contents=contents_for_api,
+                        config=final_generation_config, timeout=config_manager.get_gemini_request_timeout(),
+                        priority=priority, user_id=user_id, cache_request=cache_request
+                    )
                 logger.debug(f"Received response from Gemini. Finish reason: {response.candidates[0].finish_reason if response.candidates else 'N/A'}") # ★ログ追加
 
                 response_text = ""
@@ -228,21 +259,18 @@ class ChatCog(commands.Cog):
                 if finish_reason == genai_types.FinishReason.RECITATION:
                     logger.warning(f"Recitation error detected for user {user_id}. Retrying...")
                     is_recitation_error = True
+                    if streamer:
+                        # 途中まで表示した応答は取り消し、再試行の結果は通常どおり送信する
+                        await streamer.discard()
+                        streamer = None
                     await asyncio.sleep(1)
                     system_instruction_retry = create_system_prompt(add_recitation_warning=True)
-                    final_generation_config_retry = genai_types.GenerateContentConfig(
-                         temperature=generation_config_dict.get('temperature', 0.9),
-                         top_p=generation_config_dict.get('top_p', 1.0),
-                         top_k=generation_config_dict.get('top_k', 1),
-                         candidate_count=generation_config_dict.get('candidate_count', 1),
-                         max_output_tokens=generation_config_dict.get('max_output_tokens', 1024),
-                         safety_settings=safety_settings_for_api,
-                         tools=tools_for_api,
-                         system_instruction=system_instruction_retry
-                     )
+                    final_generation_config_retry = config_manager.with_system_instruction(base_generation_config, system_instruction_retry)
                     logger.debug("Sending retry request to Gemini due to Recitation error...")
-                    response = self.genai_client.models.generate_content(
-                        model=model_name, contents=contents_for_api, config=final_generation_config_retry
+                    response = await gemini_client.generate_content_async(
+                        self.genai_client, model=model_name, contents=contents_for_api,
+                        config=final_generation_config_retry, timeout=config_manager.get_gemini_request_timeout(),
+                        priority=priority, user_id=user_id
                     )
                     logger.debug(f"Retry response finish_reason: {response.candidates[0].finish_reason if response.candidates else 'N/A'}")
                     if response and response.candidates:
@@ -336,7 +364,7 @@ class ChatCog(commands.Cog):
                     user_parts_dict = [p_dict for part in current_parts if (p_dict := part_to_dict(part, is_model_response=False))]
                     if user_parts_dict:
                         logger.debug(f"Adding user entry to history (Author: {user_id}): {user_parts_dict}")
-                        await history_cog.add_history_entry_async(current_interlocutor_id=self.bot.user.id, channel_id=channel_id, role="user", parts_dict=user_parts_dict, entry_author_id=user_id)
+                        await history_cog.add_history_entry_async(current_interlocutor_id=self.bot.user.id, channel_id=channel_id, role="user", parts_dict=user_parts_dict, entry_author_id=user_id, guild_id=message.guild.id if message.guild else None)
                     else:
                         logger.debug("No valid user parts to add to history.")
 
@@ -344,13 +372,18 @@ class ChatCog(commands.Cog):
                     bot_response_parts_dict_cleaned = [p_dict for part in response_candidates_parts if (p_dict := part_to_dict(part, is_model_response=True))]
                     if bot_response_parts_dict_cleaned:
                         logger.debug(f"Adding cleaned bot response entry to history (Author: {self.bot.user.id}): {bot_response_parts_dict_cleaned}")
-                        await history_cog.add_history_entry_async(current_interlocutor_id=user_id, channel_id=channel_id, role="model", parts_dict=bot_response_parts_dict_cleaned, entry_author_id=self.bot.user.id)
+                        await history_cog.add_history_entry_async(current_interlocutor_id=user_id, channel_id=channel_id, role="model", parts_dict=bot_response_parts_dict_cleaned, entry_author_id=self.bot.user.id, guild_id=message.guild.id if message.guild else None)
                         logger.info(f"Added cleaned bot response to global history.")
                     else:
                         logger.warning("No valid parts to add to history after cleaning bot response.")
                 elif response_text: # 括弧で始まるエラーメッセージなどは履歴に保存しない
                      logger.debug("Skipping history saving for error/info message.")
 
+                # 途中で止まっていない正常な応答だけをキャッシュする
+                if (cache_key is not None and cached_text is None and not is_recitation_error
+                        and finish_reason == genai_types.FinishReason.STOP and response_text and not response_text.startswith("(")):
+                    config_manager.store_cached_response(cache_key, response_cache.depersonalize(response_text, call_name))
+
                 # --- 応答送信 ---
                 if response_text:
                     # 1. 引用マーク削除
@@ -378,7 +411,11 @@ class ChatCog(commands.Cog):
                     # 4. 送信
                     if final_response_text:
                          try:
-                              await helpers.split_and_send_messages(message, final_response_text, 1900)
+                              if streamer and streamer.started:
+                                   finishing, streamer = streamer, None # 完了させた応答は finally で取り消さない
+                                   await finishing.finish()
+                              else:
+                                   await helpers.split_and_send_messages(message, final_response_text, 1900)
                               logger.info(f"Successfully sent response to user {user_id}.")
                          except Exception as send_e:
                               logger.error(f"Error in split_and_send_messages for user {user_id}", exc_info=send_e)
@@ -411,6 +448,13 @@ class ChatCog(commands.Cog):
                       if is_dm: await message.channel.send(reply_msg)
                       else: await message.reply(reply_msg, mention_author=False)
                  except discord.HTTPException: logger.error("Failed to send API error message to Discord.")
+            except asyncio.TimeoutError:
+                 logger.warning(f"Gemini request timed out for user {user_id} (timeout: {config_manager.get_gemini_request_timeout()}s)")
+                 reply_msg = f"({call_name}さん、AIの応答がタイムアウトしました。しばらく待ってから試してください。)"
+                 try:
+                      if is_dm: await message.channel.send(reply_msg)
+                      else: await message.reply(reply_msg, mention_author=False)
+                 except discord.HTTPException: logger.error("Failed to send timeout message to Discord.")
             except discord.errors.NotFound:
                 logger.warning(f"Message {message.id} or channel {message.channel.id} not found. Maybe deleted?")
             except Exception as e:
@@ -420,6 +464,49 @@ class ChatCog(commands.Cog):
                      if is_dm: await message.channel.send(reply_msg)
                      else: await message.reply(reply_msg, mention_author=False)
                 except discord.HTTPException: logger.error("Failed to send unexpected error message to Discord.")
+            finally:
+                # 完了しなかったストリーミング応答 (途中のタイムアウト・APIエラー、プレフィックスだけ・エラー文の応答) は
+                # 途中までの表示を残さず、遅延中の編集も止める
+                if streamer:
+                    try: await streamer.discard()
+                    except Exception as e: logger.warning(f"Failed to discard partial streamed response: {e}")
+
+    async def _generate_streaming(self, streamer: streaming.StreamingReply, *, model: str, contents: List[Any], config: Any,
+                                  priority: int, user_id: int, cache_request: Optional[context_cache.CacheableRequest] = None) -> Any:
+        """generate_content_stream で応答を受け取り、テキストを streamer に流す。全チャンクをまとめた応答を返す"""
+        chunks = []
+        async for chunk in gemini_client.generate_content_stream_async(self.genai_client, model=model, contents=contents, config=config,
+                                                                        timeout=config_manager.get_gemini_request_timeout(),
+                                                                        priority=priority, user_id=user_id, cache_request=cache_request):
+            chunks.append(chunk)
+            if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
+                for part in chunk.candidates[0].content.parts:
+                    if part.text: await streamer.feed(part.text)
+        logger.debug(f"Received {len(chunks)} stream chunk(s) from Gemini.")
+        return _merge_stream_chunks(chunks)
+
+
+def _merge_stream_chunks(chunks: List[Any]) -> Any:
+    """ストリームのチャンクを generate_content と同じ形の応答1つにまとめる
+
+    テキストは1つの Part に連結し、それ以外の Part (function_call など) はそのまま残す。
+    finish_reason・safety_ratings は最後のチャンク、prompt_feedback は最初に現れたものを使う。
+    """
+    if not chunks: return genai_types.GenerateContentResponse()
+    texts, other_parts = [], []
+    for chunk in chunks:
+        if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts: continue
+        for part in chunk.candidates[0].content.parts:
+            if part.text: texts.append(part.text)
+            else: other_parts.append(part)
+    last = chunks[-1]
+    prompt_feedback = next((c.prompt_feedback for c in chunks if c.prompt_feedback), None)
+    merged_parts = ([genai_types.Part(text="".join(texts))] if texts else []) + other_parts
+    candidates = None
+    if last.candidates or merged_parts:
+        candidate = last.candidates[0] if last.candidates else genai_types.Candidate()
+        candidates = [candidate.model_copy(update={"content": genai_types.Content(role="model", parts=merged_parts) if merged_parts else None})]
+    return last.model_copy(update={"candidates": candidates, "prompt_feedback": prompt_feedback})
 
 
 # CogをBotに登録するためのセットアップ関数
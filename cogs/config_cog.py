@@ -287,10 +287,10 @@ class ConfigCog(commands.Cog):
 
         if not enabled:
             if min_interval is not None or max_interval is not None or stop_start_hour is not None or stop_end_hour is not None: await interaction.followup.send("ランダムDMを無効にする場合、他のパラメータは指定できません。", ephemeral=True); return
-            async with config_manager.data_lock: # ★ ロック取得
+            async with config_manager.user_data_lock: # ★ ロック取得
                 if user_id_str in config_manager.user_data and "random_dm" in config_manager.user_data[user_id_str]:
                     config_manager.user_data[user_id_str]["random_dm"]["enabled"] = False
-                    await config_manager.save_user_data_nolock() # ★ ロック内で保存
+                    config_manager.mark_user_data_dirty(user_id_str) # ★ 遅延保存に登録
                     await interaction.followup.send("ランダムDMを無効にしました。", ephemeral=True); logger.info(f"Random DM disabled for user {interaction.user}")
                 else: await interaction.followup.send("ランダムDMは既に無効です。", ephemeral=True); return
 
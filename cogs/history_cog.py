@@ -1,19 +1,27 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 import logging
-from typing import List, Optional, Dict, Any
-from collections import deque
+from typing import List, Optional, Dict, Any, Sequence
+from collections import deque, OrderedDict
 import os
 import asyncio
 import datetime # datetime をインポート
 
 # config_manager や genai.types などをインポート
 from utils import config_manager
+from utils.history_models import ROLE_MODEL, HistoryEntry
+from utils.history_prompt import HistoryPromptFormatter
+from utils import gemini_client
+from utils import gemini_pool
+from utils import history_partitions as partitions
 from google.genai import types as genai_types
 
 logger = logging.getLogger(__name__)
 
+EXACT_COUNT_BATCH = 20 # 1回の裏の処理で count_tokens により数えるエントリ数の上限
+PARTITION_SWEEP_INTERVAL = 60.0 # 使われていない履歴パーティションを退避するか確認する間隔 (秒)
+
 # --- 削除確認用の View ---
 class ConfirmClearView(discord.ui.View):
     def __init__(self, *, timeout=30.0):
@@ -58,101 +66,97 @@ class HistoryCog(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self._history_formatter = HistoryPromptFormatter(self._resolve_speaker_name) # 整形済みの履歴 (エントリごと)
+        self._scoped_formatters: "OrderedDict[str, HistoryPromptFormatter]" = OrderedDict() # パーティションごと (LRU)
+        self._exact_count_task: Optional[asyncio.Task] = None
+        config_manager.speaker_directory.attach(bot)
+        self.partition_sweep_loop.start()
         logger.info("HistoryCog loaded.")
 
-    # ★ get_global_history_for_prompt を修正 ★
+    def cog_unload(self):
+        self.partition_sweep_loop.cancel()
+
+    @tasks.loop(seconds=PARTITION_SWEEP_INTERVAL)
+    async def partition_sweep_loop(self):
+        # 新しいパーティションを読み込まない静かな間も、使われていないものをファイルに退避する
+        try: await config_manager.sweep_history_partitions_async()
+        except Exception as e: logger.error("Failed to sweep idle history partitions", exc_info=e)
+
+    def _resolve_speaker_name(self, entry: HistoryEntry, bot_name: str) -> str:
+        """履歴エントリの発言者名 (Bot の発言は Bot 名、ユーザーはニックネーム > サーバーでの表示名 > グローバル名)"""
+        if entry.role == ROLE_MODEL: return bot_name
+        return config_manager.speaker_directory.resolve(entry.interlocutor_id, entry.channel_id) # 分からない名前は裏で取得される
+
     async def get_global_history_for_prompt(self) -> List[genai_types.Content]:
-        """グローバル履歴をAPIリクエスト用に整形し、発言者情報を付与して返す"""
-        logger.debug(f"Getting global history for prompt")
-        history_deque = config_manager.get_global_history() # グローバル履歴を取得
-        content_history = []
-        if not history_deque:
-            logger.debug(f"No global history found")
-            return content_history
-        logger.debug(f"Raw global history deque (len={len(history_deque)}): {list(history_deque)}")
-
-        # Bot自身の名前を事前に取得
+        """グローバル履歴をAPIリクエスト用に整形し、発言者情報を付与して返す (前回から増えたエントリだけを整形する)
+
+        トークン予算 (history_token_budget) が設定されていれば、新しいエントリから予算に収まる分だけを返す。
+        """
+        history_snapshot = config_manager.get_global_history() # 不変のスナップショット (変更されるまで同じタプル)
+        return self._format_for_prompt(self._history_formatter, history_snapshot, "global")
+
+    async def get_scoped_history_for_prompt(self, guild_id: Optional[int], channel_id: Optional[int], user_id: int) -> List[genai_types.Content]:
+        """会話の場所 (サーバー・チャンネル・DM の相手) のスコープの履歴を整形して返す
+
+        history_scope が global ならグローバル履歴と同じ。それ以外はその場所のパーティションだけを使う
+        (メモリになければファイルから読み込む)。channel_id が None なら DM。
+        """
+        scope = config_manager.get_history_scope()
+        if scope == partitions.SCOPE_GLOBAL: return await self.get_global_history_for_prompt()
+        key = config_manager.history_partition_key(scope, guild_id, channel_id, user_id)
+        history_snapshot = await config_manager.get_scoped_history_async(key)
+        formatter = self._scoped_formatters.get(key)
+        if formatter is None:
+            formatter = self._scoped_formatters[key] = HistoryPromptFormatter(self._resolve_speaker_name)
+            while len(self._scoped_formatters) > config_manager.history_partitions.max_loaded: # パーティションと同じ数だけ覚えておく
+                self._scoped_formatters.popitem(last=False)
+        self._scoped_formatters.move_to_end(key)
+        return self._format_for_prompt(formatter, history_snapshot, key)
+
+    def _format_for_prompt(self, formatter: HistoryPromptFormatter, history_snapshot: Sequence[HistoryEntry], label: str) -> List[genai_types.Content]:
         bot_name = self.bot.user.display_name if self.bot.user else "Bot"
-
-        for entry in list(history_deque): # dequeをリスト化して安全にイテレート
-            try:
-                parts_obj_list = []
-                role = entry.get("role")
-                entry_parts = entry.get("parts", [])
-                interlocutor_id = entry.get("interlocutor_id") # 発言者ID
-
-                if not role or not entry_parts or role not in ["user", "model"] or interlocutor_id is None:
-                    logger.warning(f"Skip invalid global history entry (missing essential info): {entry}")
-                    continue
-
-                # --- 発言者名の取得 ---
-                speaker_name = f"User {interlocutor_id}" # デフォルト
-                if role == "model":
-                    speaker_name = bot_name # Botの発言
-                elif role == "user":
-                    # ニックネームを取得、なければフォールバック
-                    nickname = config_manager.get_nickname(interlocutor_id)
-                    if nickname:
-                        speaker_name = nickname
-                    else:
-                        # Discordユーザー情報を取得試行 (キャッシュにあれば高速)
-                        user = self.bot.get_user(interlocutor_id)
-                        if user:
-                            speaker_name = user.display_name
-                        # else: # キャッシュになければAPIコールが必要になるため、ID表示に留める
-                        #     logger.warning(f"Could not find user {interlocutor_id} in cache for history speaker name.")
-
-                context_prefix = f"[{speaker_name}]: " # 発言者プレフィックス
-
-                # --- Parts の整形 ---
-                first_part = True
-                processed_parts = [] # 整形後のPartを一時格納
-                for part_dict in entry_parts:
-                    if 'text' in part_dict and isinstance(part_dict['text'], str) and part_dict['text'].strip():
-                        text_content = part_dict['text'].strip()
-                        # 最初のテキストパートにのみプレフィックスを追加
-                        final_text = context_prefix + text_content if first_part else text_content
-                        processed_parts.append(genai_types.Part(text=final_text))
-                        first_part = False # 2番目以降のテキストパートにはプレフィックス不要
-                    elif 'inline_data' in part_dict:
-                        logger.warning("Skipping inline_data restoration in history formatting.")
-                        # Blobの復元は複雑なためスキップ or プレフィックス付きテキストで代替表現も検討
-                        # if first_part:
-                        #    processed_parts.append(genai_types.Part(text=f"{context_prefix}[添付データ: {part_dict['inline_data'].get('mime_type', '不明')}]"))
-                        #    first_part = False
-                        # else:
-                        #    processed_parts.append(genai_types.Part(text=f"[添付データ: {part_dict['inline_data'].get('mime_type', '不明')}]"))
-                    elif 'function_call' in part_dict and isinstance(part_dict['function_call'], dict):
-                        fc_data = part_dict['function_call']
-                        if 'name' in fc_data and 'args' in fc_data:
-                             # 関数呼び出しにはプレフィックス不要
-                             processed_parts.append(genai_types.Part(function_call=genai_types.FunctionCall(name=fc_data.get('name'), args=fc_data.get('args'))))
-                             # もしテキストも同時に存在しうるなら、テキスト部分にプレフィックスを付ける
-                        else: logger.warning(f"Skipping invalid function_call dict in history: {part_dict}")
-                        first_part = False # 関数呼び出しがあれば、後続のテキストにはプレフィックス不要
-                    elif 'function_response' in part_dict and isinstance(part_dict['function_response'], dict):
-                         fr_data = part_dict['function_response'];
-                         if 'name' in fr_data and 'response' in fr_data:
-                              # 関数応答にもプレフィックス不要
-                              processed_parts.append(genai_types.Part(function_response=genai_types.FunctionResponse(name=fr_data.get('name'), response=fr_data.get('response'))))
-                         else: logger.warning(f"Skipping invalid function_response dict in history: {part_dict}")
-                         first_part = False # 関数応答があれば、後続のテキストにはプレフィックス不要
-                    else: logger.warning(f"Skipping unrecognized part dict in history: {part_dict}")
-
-                if processed_parts: # 整形されたPartがあればContentに追加
-                    content_history.append(genai_types.Content(role=role, parts=processed_parts))
-                else:
-                    logger.warning(f"No valid parts constructed for history entry: {entry}")
-            except Exception as e:
-                logger.error(f"Error converting global history entry dict: {entry}", exc_info=e)
-
-        logger.debug(f"Formatted global history for prompt (returned {len(content_history)} entries)")
+        budget = config_manager.get_history_token_budget()
+        content_history = formatter.format(history_snapshot, config_manager.get_version("speaker_names"), bot_name,
+                                           token_budget=budget, scale=config_manager.token_metrics.scale)
+        selected, available, tokens = formatter.last_window
+        config_manager.token_metrics.record_history_window(selected, available, tokens, budget)
+        logger.debug(f"Formatted {label} history for prompt (returned {selected} of {available} entries, ~{tokens} tokens, "
+                     f"budget {budget or 'unlimited'}, {formatter.formatted_count} formatted so far)")
+        if config_manager.get_history_token_count_exact(): self._schedule_exact_count(formatter)
         return content_history
 
+    def _schedule_exact_count(self, formatter: HistoryPromptFormatter):
+        """まだ正確なトークン数が分からないエントリを裏で count_tokens により数える (プロンプトの組み立ては待たない)"""
+        if self._exact_count_task and not self._exact_count_task.done(): return
+        if not formatter.pending_exact(1): return
+        self._exact_count_task = asyncio.create_task(self._count_exact_tokens(formatter), name="history_exact_token_count")
+
+    async def _count_exact_tokens(self, formatter: HistoryPromptFormatter):
+        pool = gemini_pool.current_shared_pool()
+        if pool is None: return
+        model = config_manager.get_model_name()
+        for item in formatter.pending_exact(EXACT_COUNT_BATCH):
+            tokens = await gemini_client.count_tokens_async(pool, model=model, contents=[item.content])
+            if tokens is None: return # 失敗したら次のリクエストのときに再び試す
+            config_manager.token_metrics.observe(item.tokens, tokens) # 見積もりの補正にも使う
+            formatter.set_exact_tokens(item, tokens)
+
+
+    # --- 発言者名の変更を反映する ---
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.display_name != after.display_name:
+            config_manager.speaker_directory.invalidate_user(after.id, after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        if before.display_name != after.display_name:
+            config_manager.speaker_directory.invalidate_user(after.id)
 
     # ★ add_history_entry_async (変更なし、config_manager側で処理) ★
-    async def add_history_entry_async(self, current_interlocutor_id: int, channel_id: Optional[int], role: str, parts_dict: List[Dict[str, Any]], entry_author_id: int):
-        """グローバル会話履歴にエントリを追加・保存する (config_managerを呼び出す)"""
+    async def add_history_entry_async(self, current_interlocutor_id: int, channel_id: Optional[int], role: str, parts_dict: List[Dict[str, Any]], entry_author_id: int,
+                                      guild_id: Optional[int] = None):
+        """グローバル会話履歴 (とスコープの履歴) にエントリを追加・保存する (config_managerを呼び出す)"""
         if role not in ["user", "model"]: logger.error(f"Invalid role '{role}'"); return
         logger.debug(f"Adding history async (Global) - Current interlocutor: {current_interlocutor_id}, Channel: {channel_id}, Role: {role}, Entry author: {entry_author_id}")
         try:
@@ -161,7 +165,8 @@ class HistoryCog(commands.Cog):
                 channel_id=channel_id,
                 role=role,
                 parts_dict=parts_dict,
-                entry_author_id=entry_author_id
+                entry_author_id=entry_author_id,
+                guild_id=guild_id
             )
         except Exception as e:
             logger.error(f"Error calling config_manager.add_history_entry_async", exc_info=e)
@@ -302,6 +307,54 @@ class HistoryCog(commands.Cog):
             logger.error("Error in /history show_length", exc_info=e);
             await interaction.followup.send(f"設定の表示中にエラーが発生しました: {e}", ephemeral=True)
 
+    @history_commands.command(name="set_scope", description="プロンプトに使う会話履歴の範囲 (全体・サーバー・チャンネル・DM) を設定します")
+    @app_commands.describe(scope="履歴を分ける単位")
+    @app_commands.choices(scope=[
+        app_commands.Choice(name="Global (すべての会話で共有)", value=partitions.SCOPE_GLOBAL),
+        app_commands.Choice(name="Guild (サーバーごと, DMはユーザーごと)", value=partitions.SCOPE_GUILD),
+        app_commands.Choice(name="Channel (チャンネルごと, DMはユーザーごと)", value=partitions.SCOPE_CHANNEL),
+        app_commands.Choice(name="DM (DMのみユーザーごと)", value=partitions.SCOPE_DM),
+    ])
+    async def history_set_scope(self, interaction: discord.Interaction, scope: str):
+        await interaction.response.defer(ephemeral=True);
+        try:
+            await config_manager.update_history_scope_async(scope)
+            await interaction.followup.send(f"会話履歴の範囲を `{scope}` に設定しました。", ephemeral=True);
+            logger.info(f"History scope set to {scope} by {interaction.user}")
+        except Exception as e:
+            logger.error("Error in /history set_scope", exc_info=e);
+            await interaction.followup.send(f"設定の保存中にエラーが発生しました: {e}", ephemeral=True)
+
+    @history_commands.command(name="stats", description="会話履歴の件数の内訳 (ユーザー別・チャンネル別) を表示します")
+    async def history_stats(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True);
+        try:
+            stats = config_manager.get_history_stats()
+            embed = discord.Embed(title="会話履歴の統計", color=discord.Color.blue())
+            embed.add_field(name="保持件数", value=f"`{stats['total']}` / `{stats['max_history']}` 件", inline=True)
+            embed.add_field(name="あなたが関与する履歴", value=f"`{config_manager.get_user_history_count(interaction.user.id)}` 件", inline=True)
+            partition_stats = config_manager.get_history_partition_stats()
+            embed.add_field(name="範囲", value=f"`{partition_stats['scope']}` (メモリ上のパーティション `{partition_stats['loaded']}` / `{partition_stats['max_loaded']}`)", inline=True)
+            if stats["archived"] is not None:
+                embed.add_field(name="アーカイブ済み", value=f"`{stats['archived']}` 件", inline=True)
+
+            bot_id = self.bot.user.id if self.bot.user else None # Bot の応答も発言者として索引されているので除く
+            top_users = sorted(((uid, count) for uid, count in stats["user_counts"].items() if uid != bot_id), key=lambda item: item[1], reverse=True)[:10]
+            user_lines = []
+            for user_id, count in top_users:
+                user = self.bot.get_user(user_id)
+                name = config_manager.get_nickname(user_id) or (user.display_name if user else f"User {user_id}")
+                user_lines.append(f"- {name}: `{count}` 件")
+            embed.add_field(name="ユーザー別 (上位10件)", value="\n".join(user_lines) or "なし", inline=False)
+
+            top_channels = sorted(stats["channel_counts"].items(), key=lambda item: item[1], reverse=True)[:5]
+            channel_lines = [f"- {f'<#{channel_id}>' if channel_id is not None else 'DM'}: `{count}` 件" for channel_id, count in top_channels]
+            embed.add_field(name="チャンネル別 (上位5件)", value="\n".join(channel_lines) or "なし", inline=False)
+            await interaction.followup.send(embed=embed, ephemeral=True)
+        except Exception as e:
+            logger.error("Error in /history stats", exc_info=e);
+            await interaction.followup.send(f"統計の表示中にエラーが発生しました: {e}", ephemeral=True)
+
 
 # CogをBotに登録するためのセットアップ関数
 async def setup(bot: commands.Bot):
@@ -16,12 +16,18 @@ import asyncio
 # genai.types などをインポート
 from google.genai import types as genai_types
 from utils import helpers # URL抽出など
+from utils import config_manager
+from utils.response_cache import ResponseCache
 
 logger = logging.getLogger(__name__)
 
+URL_CACHE_MAX_ENTRIES = 100 # 応答キャッシュが有効な場合に、URL から抽出した内容を覚えておく件数
+URL_CACHE_TTL = 3600.0 # 同 (秒)
+
 class ProcessingCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self._url_cache = ResponseCache(URL_CACHE_MAX_ENTRIES, URL_CACHE_TTL) # URL → 抽出した内容の Part テキスト
         logger.info("ProcessingCog loaded.")
 
     async def process_attachments(self, attachments: List[discord.Attachment]) -> List[genai_types.Part]:
@@ -112,6 +118,14 @@ class ProcessingCog(commands.Cog):
         if not url:
             return parts
 
+        # 同じURLが何度も貼られた場合は取得・抽出をやり直さない (応答キャッシュが有効な場合のみ)
+        use_cache = config_manager.get_response_cache_enabled()
+        if use_cache:
+            cached_text = self._url_cache.get(url)
+            if cached_text is not None:
+                logger.info(f"Using cached content for URL: {url}")
+                return [genai_types.Part(text=cached_text)]
+
         logger.info(f"Processing URL found in message: {url}")
         try:
             # --- YouTube URL処理 ---
@@ -148,6 +162,7 @@ class ProcessingCog(commands.Cog):
         except Exception as e:
             logger.error(f"Error processing URL {url}", exc_info=e)
 
+        if use_cache and parts: self._url_cache.put(url, parts[0].text)
         return parts
 
     def _extract_text_from_general_url(self, url: str) -> Optional[str]:
@@ -7,7 +7,6 @@ import datetime
 import asyncio
 import random
 from typing import Optional, List, Dict, Any # ★ List, Dict, Any を追加
-import os
 
 # config_manager や genai 関連をインポート
 from utils import config_manager
@@ -15,6 +14,10 @@ from google import genai
 from google.genai import types as genai_types
 from google.genai import errors as genai_errors
 from utils import helpers # ★ helpers をインポート
+from utils import gemini_client
+from utils import gemini_pool
+from utils import prompt_templates
+from utils.request_scheduler import PRIORITY_RANDOM_DM
 from cogs.history_cog import HistoryCog # HistoryCog をインポート
 
 logger = logging.getLogger(__name__)
@@ -23,7 +26,7 @@ class RandomDMCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.genai_client = None
-        self.user_data_lock = config_manager.data_lock
+        self.user_data_lock = config_manager.user_data_lock
         self.dm_sender_loop.start()
         logger.info("RandomDMCog loaded and task started.")
 
@@ -32,27 +35,12 @@ class RandomDMCog(commands.Cog):
         logger.info("RandomDMCog unloaded and task stopped.")
 
     async def initialize_genai_client_if_needed(self):
-        """ChatCogからGenAIクライアントを取得、なければ初期化を試みる"""
-        if self.genai_client: return True
-        chat_cog = self.bot.get_cog("ChatCog")
-        if chat_cog and chat_cog.genai_client:
-            self.genai_client = chat_cog.genai_client
-            logger.info("Using GenAI client from ChatCog for Random DM.")
-            return True
-        else:
-            logger.warning("Could not get GenAI client from ChatCog. Attempting independent initialization for RandomDMCog...")
-            try:
-                api_key = os.getenv("GOOGLE_AI_KEY")
-                if not api_key:
-                     logger.error("GOOGLE_AI_KEY not found in environment variables. Random DM cannot use AI.")
-                     return False
-                self.genai_client = genai.Client(api_key=api_key)
-                logger.info("Gemini client initialized independently for RandomDMCog.")
-                return True
-            except Exception as e:
-                logger.error("Failed to initialize Gemini client independently for RandomDMCog", exc_info=e)
-                self.genai_client = None
-                return False
+        """ChatCog と共有する GenAI クライアントプールを取得する (未作成なら作成する)"""
+        self.genai_client = gemini_pool.get_shared_pool(lambda api_key: genai.Client(api_key=api_key))
+        if not self.genai_client:
+            logger.error("Gemini client pool is not available. Random DM cannot use AI.")
+            return False
+        return True
 
     async def reset_user_timer(self, user_id: int):
         # (変更なし)
@@ -65,6 +53,7 @@ class RandomDMCog(commands.Cog):
                      now_aware = datetime.datetime.now().astimezone()
                      user_settings["last_interaction"] = now_aware
                      user_settings["next_send_time"] = None
+                     config_manager.bump_version("user_data") # ファイルには保存しないがスナップショットは更新する
                      logger.info(f"Random DM timer reset in memory for user {user_id}.")
              else:
                   logger.debug(f"User {user_id_str} not found in user_data for timer reset.")
@@ -136,11 +125,8 @@ class RandomDMCog(commands.Cog):
                     logger.error(f"Error processing user {user_id_str} in dm_sender_loop", exc_info=e)
             if users_to_update_config:
                 logger.debug(f"Updating random DM configs in memory and file for users: {list(users_to_update_config.keys())}") # ★ログ修正
-                try:
-                    await config_manager.save_user_data_nolock()
-                    logger.debug("Finished updating random DM configs in file.")
-                except Exception as e:
-                     logger.error("Error during bulk save of random DM configs", exc_info=e)
+                # ループ毎の全体書き込みはせず、遅延保存でまとめて書き込む
+                for updated_user_id in users_to_update_config: config_manager.mark_user_data_dirty(str(updated_user_id))
 
         if users_to_dm:
             logger.info(f"Preparing to send random DMs to {len(users_to_dm)} users: {users_to_dm}") # ★ログ追加
@@ -177,30 +163,15 @@ class RandomDMCog(commands.Cog):
             user_representation = user.display_name
             call_name = user_nickname if user_nickname else user_representation
 
-            # --- システムプロンプト ---
-            persona_prompt = config_manager.get_persona_prompt()
-            sys_prompt_text = persona_prompt
-            sys_prompt_text += f"\n\n--- ★★★ 現在の最重要情報 ★★★ ---"
-            sys_prompt_text += f"\nあなたはこれから、以下の Discord ユーザーに**あなたから**ダイレクトメッセージ（DM）を送ります。これは新しい会話の始まり、または久しぶりの声かけです。"
-            sys_prompt_text += f"\n- ユーザー名: {user_representation} (Discord 表示名)"
-            sys_prompt_text += f"\n- ユーザーID: {user_id}"
-            sys_prompt_text += f"\n- ★★ あなたが呼びかけるべき名前: 「{call_name}」 ★★"
-            sys_prompt_text += f"\n   (注: これは設定されたニックネーム、またはユーザー表示名です。)"
-            sys_prompt_text += f"\n- 会話の場所: ダイレクトメッセージ (DM)"
-            sys_prompt_text += "\n---------------------------------"
-            sys_prompt_text += f"\n\n--- ★★★ 応答生成時の最重要指示 ★★★ ---"
-            sys_prompt_text += f"\n1. **最優先事項:** これはあなたからの最初のDM、または久しぶりの声かけです。応答する際は、**必ず、絶対に「{call_name}」という名前で呼びかけてください。** 他の呼び方は**禁止**します。"
-            sys_prompt_text += f"\n2. **厳禁:** 過去の会話履歴には、他のユーザーとの会話や、現在の相手と他のユーザーとの会話、サーバーチャンネルでの会話が含まれている可能性があります。これらの履歴は参考程度に留め、**今回のDMの内容は、現在の相手「{call_name}」さんとの新しい会話として自然なものにしてください。** 過去の他の会話に引きずられないように注意してください。"
-            sys_prompt_text += f"\n3. **今回のあなたの発言指示:** 「{dm_prompt_text_base}」に基づき、フレンドリーで自然な最初のメッセージを作成してください。相手が返信しやすいような、オープンな質問を含めると良いでしょう。"
-            sys_prompt_text += f"\n4. **厳禁:** あなたの応答の **いかなる部分にも** `[{self.bot.user.display_name}]:` や `[{call_name}]:` のような角括弧で囲まれた発言者名を含めてはいけません。あなたの応答は、会話本文のみで構成してください。"
-            sys_prompt_text += f"\n5. 引用符 `[]` は使用禁止です。"
-            sys_prompt_text += "\n----------------------------------------\n"
-            system_instruction_content = genai_types.Content(parts=[genai_types.Part(text=sys_prompt_text)], role="system")
-            logger.debug(f"Generated System Prompt for Random DM to {user_id}:\n{sys_prompt_text[:500]}...") # ★ログ追加
+            # --- システムプロンプト (コンパイル済みのテンプレートに項目を埋める) ---
+            system_instruction_content = prompt_templates.get_template(prompt_templates.KIND_RANDOM_DM).system_instruction(
+                display_name=user_representation, user_id=user_id, call_name=call_name,
+                dm_prompt=dm_prompt_text_base, bot_name=self.bot.user.display_name)
+            logger.debug(f"Generated System Prompt for Random DM to {user_id}:\n{system_instruction_content.parts[0].text[:500]}...") # ★ログ追加
             # --- システムプロンプトここまで ---
 
-            history_list = await history_cog.get_global_history_for_prompt()
-            logger.debug(f"Using global history (length: {len(history_list)}) for random DM context to {user_id}")
+            history_list = await history_cog.get_scoped_history_for_prompt(None, None, user_id) # DM のスコープ (global ならグローバル履歴)
+            logger.debug(f"Using history {config_manager.history_key_for(None, None, user_id)} (length: {len(history_list)}) for random DM context to {user_id}")
             start_message_content = genai_types.Content(role="user", parts=[genai_types.Part(text=f"（{call_name}さんへのDM開始指示: {dm_prompt_text_base}）")])
 
             contents_for_api = []
@@ -209,27 +180,16 @@ class RandomDMCog(commands.Cog):
 
             # --- Gemini API 呼び出し ---
             model_name = config_manager.get_model_name()
-            generation_config_dict = config_manager.get_generation_config_dict()
-            safety_settings_list = config_manager.get_safety_settings_list()
-            safety_settings_for_api = [genai_types.SafetySetting(**s) for s in safety_settings_list]
-            tools_for_api = None
-
-            final_generation_config = genai_types.GenerateContentConfig(
-                 temperature=generation_config_dict.get('temperature', 0.9),
-                 top_p=generation_config_dict.get('top_p', 1.0),
-                 top_k=generation_config_dict.get('top_k', 1),
-                 candidate_count=generation_config_dict.get('candidate_count', 1),
-                 max_output_tokens=generation_config_dict.get('max_output_tokens', 512),
-                 safety_settings=safety_settings_for_api,
-                 tools=tools_for_api,
-                 system_instruction=system_instruction_content
-            )
+            final_generation_config = config_manager.with_system_instruction(
+                config_manager.get_compiled_generation_config(config_manager.GENERATION_KIND_RANDOM_DM), system_instruction_content)
 
             logger.info(f"Sending random DM request to Gemini. Model: {model_name}, History length: {len(history_list)}") # ★ログ修正
             if not contents_for_api: logger.error("Cannot send request to Gemini for random DM, contents_for_api is empty."); return
 
-            response = self.genai_client.models.generate_content(
-                model=model_name, contents=contents_for_api, config=final_generation_config
+            response = await gemini_client.generate_content_async(
+                self.genai_client, model=model_name, contents=contents_for_api,
+                config=final_generation_config, timeout=config_manager.get_gemini_request_timeout(),
+                priority=PRIORITY_RANDOM_DM, user_id=user_id # 会話への応答より後回しにする
             )
             logger.debug(f"Gemini Response for random DM ({user_id}): FinishReason={response.candidates[0].finish_reason if response.candidates else 'N/A'}")
 
@@ -327,6 +287,7 @@ class RandomDMCog(commands.Cog):
             else: logger.info(f"Skipped sending empty or prefix-only random DM to user {user_id}.")
 
         # --- エラーハンドリング ---
+        except asyncio.TimeoutError: logger.warning(f"Gemini request timed out during random DM preparation for {user_id}")
         except genai_errors.APIError as e: logger.error(f"Gemini API Error during random DM preparation for {user_id}: Code={e.code if hasattr(e, 'code') else 'N/A'}, Message={e.message}", exc_info=False)
         except Exception as e: logger.error(f"Error preparing or sending random DM to user {user_id}", exc_info=e) # ★ここに入る可能性
 
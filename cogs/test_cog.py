@@ -4,9 +4,21 @@ from discord import app_commands
 import discord
 import logging
 import asyncio
+from utils import config_manager
+from utils import gemini_pool
+from utils import helpers
 
 logger = logging.getLogger(__name__)
 
+STATS_MESSAGE_MAX_LENGTH = 1900 # Discord の1メッセージ2000文字の上限に余裕を持たせる
+
+
+def is_bot_owner():
+    """スラッシュコマンド用のオーナー限定チェック (commands.is_owner はプレフィックスコマンドにしか効かない)"""
+    async def predicate(interaction: discord.Interaction) -> bool:
+        return await interaction.client.is_owner(interaction.user) # False なら app_commands.CheckFailure になる
+    return app_commands.check(predicate)
+
 # ★ Cogリストの定義を削除 ★
 
 class TestCog(commands.Cog):
@@ -18,8 +30,77 @@ class TestCog(commands.Cog):
         latency = round(self.bot.latency * 1000)
         await interaction.response.send_message(f"Pong! ({latency}ms)", ephemeral=True)
 
+    @app_commands.command(name="lock_stats", description="設定・履歴のロックの競合状況を表示します (オーナー限定)")
+    @is_bot_owner() # Botオーナーのみ実行可能
+    async def lock_stats(self, interaction: discord.Interaction):
+        """領域ごとのロックの取得回数・競合回数・待ち時間を表示する"""
+        lines = []
+        for name, stats in config_manager.get_lock_stats().items():
+            lines.append(f"`{name}`: 取得 {stats['acquisitions']} 回 / 競合 {stats['contended']} 回 ({stats['contention_rate']:.1%}), "
+                         f"待ち 平均 {stats['avg_wait_ms']:.1f}ms・最大 {stats['max_wait_ms']:.1f}ms, "
+                         f"保持 平均 {stats['avg_hold_ms']:.1f}ms・最大 {stats['max_hold_ms']:.1f}ms")
+        await self._send_stats(interaction, lines)
+
+    @app_commands.command(name="scheduler_stats", description="Gemini API の実行枠と待ち行列の状況を表示します (オーナー限定)")
+    @is_bot_owner() # Botオーナーのみ実行可能
+    async def scheduler_stats(self, interaction: discord.Interaction):
+        """実行中のリクエスト数と、優先度クラスごとの待ち数・待ち時間を表示する"""
+        stats = config_manager.get_scheduler_stats()
+        lines = [f"実行中 {stats['active']} / 上限 {stats['max_concurrency']}"]
+        for name, queue in stats["queues"].items():
+            lines.append(f"`{name}`: 待ち {queue['queued']} 件 (最大 {queue['max_queued']} 件), 処理 {queue['dispatched']} 件, "
+                         f"待ち時間 平均 {queue['avg_wait_ms']:.1f}ms・最大 {queue['max_wait_ms']:.1f}ms")
+        budget = stats["retry_budget"]
+        lines.append(f"再試行 {budget['retries']} 回 (予算切れ {budget['denied']} 回)")
+        for name, endpoint in gemini_pool.shared_pool_stats().items():
+            limiter = endpoint["rate_limiter"]
+            lines.append(f"`{name}`{' (' + endpoint['model'] + ')' if endpoint['model'] else ''}: 実行中 {endpoint['in_flight']}, "
+                         f"応答 {endpoint['latency_ms']:.0f}ms, リクエスト {endpoint['requests']} 回 / 失敗 {endpoint['failures']} 回 / 切り離し {endpoint['ejections']} 回"
+                         f"{' (残り ' + format(endpoint['ejected_for_ms'] / 1000, '.0f') + '秒)' if endpoint['ejected_for_ms'] else ''}, "
+                         f"送信レート {limiter['scale']:.0%} (RPM {limiter['rpm_limit']} / TPM {limiter['tpm_limit']}), 429 {limiter['rate_limited']} 回, "
+                         f"ペース待ち {limiter['throttled']} 回 (最大 {limiter['max_throttle_wait_ms']:.0f}ms)")
+        cache = config_manager.get_response_cache_stats()
+        lines.append(f"応答キャッシュ {'有効' if cache['enabled'] else '無効'}: {cache['entries']} / {cache['max_entries']} 件, "
+                     f"ヒット {cache['hits']} 回 / ミス {cache['misses']} 回 (ヒット率 {cache['hit_rate']:.0%}), 追い出し {cache['evictions']} 件")
+        context = config_manager.get_context_cache_stats()
+        lines.append(f"コンテキストキャッシュ {'有効' if context['enabled'] else '無効'}: キャッシュ利用 {context['requests_cached']} 回 / 通常 {context['requests_uncached']} 回, "
+                     f"入力トークン キャッシュ {context['cached_input_tokens']} / 通常 {context['uncached_input_tokens']} ({context['cached_ratio']:.0%}), "
+                     f"作成 {context['creations']} 回 (失敗 {context['creation_failures']} 回), 破棄 {context['invalidations']} 回")
+        tokens = config_manager.get_token_metrics_stats()
+        lines.append(f"履歴トークン予算 {tokens['budget'] or '無制限'}: 平均 {tokens['avg_history_tokens']:.0f} / 最大 {tokens['max_history_tokens']} トークン, "
+                     f"削った回数 {tokens['truncated_requests']} / {tokens['requests']} 回 ({tokens['dropped_entries']} 件), "
+                     f"入力トークン 見積もり {tokens['estimated_prompt_tokens']} / 実際 {tokens['actual_prompt_tokens']} (補正 {tokens['scale']:.2f})")
+        speakers = config_manager.get_speaker_directory_stats()
+        lines.append(f"発言者名キャッシュ: {speakers['users']} 人, ヒット率 {speakers['hit_rate']:.0%}, "
+                     f"取得待ち {speakers['pending']} 件, 取得 {speakers['fetched']} 件 (失敗 {speakers['fetch_failures']} 件)")
+        history_partitions = config_manager.get_history_partition_stats()
+        lines.append(f"履歴のスコープ: {history_partitions['scope']}, メモリ上のパーティション {history_partitions['loaded']} / {history_partitions['max_loaded']} 件 "
+                     f"(読み込み {history_partitions['loads']} 回, 補完 {history_partitions['backfills']} 回, 退避 {history_partitions['evictions']} 回)")
+        await self._send_stats(interaction, lines)
+
+    async def _send_stats(self, interaction: discord.Interaction, lines):
+        """統計を2000文字の上限に収まるように分けて送る (APIキーが多いと1通に収まらない)"""
+        text = "\n".join(lines)
+        start = 0
+        while start < len(text):
+            end = helpers.find_split_end(text, start, STATS_MESSAGE_MAX_LENGTH)
+            chunk = text[start:end]
+            if not interaction.response.is_done(): await interaction.response.send_message(chunk, ephemeral=True)
+            else: await interaction.followup.send(chunk, ephemeral=True)
+            start = end
+
+    @lock_stats.error
+    @scheduler_stats.error
+    async def stats_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        if isinstance(error, app_commands.CheckFailure):
+            await interaction.response.send_message("このコマンドはBotのオーナーのみ実行できます。", ephemeral=True)
+        else:
+            logger.error(f"An error occurred in /{interaction.command.name if interaction.command else 'stats'} command", exc_info=error)
+            if not interaction.response.is_done(): await interaction.response.send_message(f"コマンドの実行中にエラーが発生しました: {error}", ephemeral=True)
+            else: await interaction.followup.send(f"コマンドの実行中にエラーが発生しました: {error}", ephemeral=True)
+
     @app_commands.command(name="reload_cogs", description="すべてのCogを再読み込みします (オーナー限定)")
-    @commands.is_owner() # Botオーナーのみ実行可能
+    @is_bot_owner() # Botオーナーのみ実行可能
     async def reload_cogs(self, interaction: discord.Interaction):
         """すべてのCogを再読み込みするコマンド"""
         await interaction.response.defer(ephemeral=True)
@@ -66,8 +147,8 @@ class TestCog(commands.Cog):
     @reload_cogs.error
     async def reload_cogs_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
         """/reload_cogs コマンドのエラーハンドリング"""
-        if isinstance(error, commands.NotOwner): # エラータイプを修正
-            await interaction.followup.send("このコマンドはBotのオーナーのみ実行できます。", ephemeral=True)
+        if isinstance(error, app_commands.CheckFailure): # オーナー以外 (defer 前に失敗するので response で返す)
+            await interaction.response.send_message("このコマンドはBotのオーナーのみ実行できます。", ephemeral=True)
         else:
             logger.error("An error occurred in /reload_cogs command", exc_info=error)
             # is_done() でチェックしてから応答を試みる
@@ -72,7 +72,13 @@ async def on_ready():
 
 async def main():
     async with bot:
-        await bot.start(DISCORD_BOT_TOKEN)
+        try:
+            await bot.start(DISCORD_BOT_TOKEN)
+        finally:
+            # ★ 遅延中の user_data などの書き込みを確定させる
+            await config_manager.flush_pending_writes_async()
+            # 作成済みの Gemini コンテキストキャッシュを削除する (残すと期限まで保存料金がかかる)
+            await config_manager.gemini_context_cache.clear()
 
 if __name__ == '__main__':
     try:
@@ -80,4 +86,7 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         logger.info("Bot stopped by KeyboardInterrupt.")
     except Exception as e:
-        logger.critical("Unhandled exception during bot execution", exc_info=e)
\ No newline at end of file
+        logger.critical("Unhandled exception during bot execution", exc_info=e)
+    finally:
+        # ★ 投入済みの設定・履歴の書き込みを完了させてから終了
+        config_manager.shutdown_io_worker()
\ No newline at end of file
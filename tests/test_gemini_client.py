@@ -0,0 +1,80 @@
+# tests/test_gemini_client.py (スタブクライアントで Gemini 呼び出しの同時実行・タイムアウト・キャンセルを確かめる)
+
+import sys
+import time
+import asyncio
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import gemini_client
+from utils import config_manager
+from utils.gemini_pool import GeminiClientPool, PoolEndpoint
+
+DELAY = 0.2 # スタブの応答時間 (秒)
+CONCURRENCY = 8
+
+
+class StubAsyncModels:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = 0
+
+    async def generate_content(self, *, model, contents, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return SimpleNamespace(text=f"echo: {contents}")
+
+
+def make_pool(delay: float = DELAY) -> GeminiClientPool:
+    client = SimpleNamespace(models=None, aio=SimpleNamespace(models=StubAsyncModels(delay)))
+    return GeminiClientPool([PoolEndpoint("stub", client)])
+
+
+class GenerateContentAsyncTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._saved_settings = dict(config_manager.bot_settings)
+        config_manager.bot_settings['gemini_rpm_limit'] = 0 # スタブなのでクォータは無制限にする
+        config_manager.bot_settings['gemini_tpm_limit'] = 0
+        self._saved_concurrency = config_manager.gemini_scheduler.max_concurrency
+
+    def tearDown(self):
+        config_manager.bot_settings.clear()
+        config_manager.bot_settings.update(self._saved_settings)
+        config_manager.gemini_scheduler.set_max_concurrency(self._saved_concurrency)
+
+    async def test_concurrent_calls_overlap(self):
+        config_manager.gemini_scheduler.set_max_concurrency(CONCURRENCY)
+        pool = make_pool()
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(gemini_client.generate_content_async(pool, model="stub", contents=f"message {i}")
+                                           for i in range(CONCURRENCY)))
+        elapsed = time.perf_counter() - start
+        self.assertEqual([r.text for r in responses], [f"echo: message {i}" for i in range(CONCURRENCY)])
+        self.assertLess(elapsed, DELAY * 2, f"{CONCURRENCY} calls took {elapsed:.2f}s (one call takes {DELAY}s)") # 直列なら DELAY * N
+
+    async def test_timeout_raises(self):
+        pool = make_pool()
+        with self.assertRaises(asyncio.TimeoutError):
+            await gemini_client.generate_content_async(pool, model="stub", contents="slow", timeout=DELAY / 4)
+        self.assertEqual(config_manager.gemini_scheduler.active, 0)
+
+    async def test_cancel_releases_scheduler_slot(self):
+        config_manager.gemini_scheduler.set_max_concurrency(1)
+        pool = make_pool()
+        running = asyncio.create_task(gemini_client.generate_content_async(pool, model="stub", contents="running"))
+        await asyncio.sleep(DELAY / 4)
+        queued = asyncio.create_task(gemini_client.generate_content_async(pool, model="stub", contents="queued"))
+        await asyncio.sleep(0)
+        self.assertEqual(config_manager.gemini_scheduler.active, 1)
+        running.cancel() # 実行中のリクエストをキャンセルすると、待っていたリクエストに枠が回る
+        with self.assertRaises(asyncio.CancelledError): await running
+        response = await asyncio.wait_for(queued, timeout=DELAY * 2)
+        self.assertEqual(response.text, "echo: queued")
+        self.assertEqual(config_manager.gemini_scheduler.active, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# utils/async_locks.py (待ち時間・保持時間を計測する asyncio.Lock)
+
+import time
+import asyncio
+import logging
+from typing import Dict, Any
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_WAIT_THRESHOLD = 0.1 # これより長く待たされた場合は警告ログを出す (秒)
+
+
+class MonitoredLock:
+    """asyncio.Lock のラッパー。競合回数と待ち時間/保持時間を記録する
+
+    `async with lock:` の形でのみ使う (acquire/release を直接呼ばない)。
+    """
+
+    def __init__(self, name: str, slow_wait_threshold: float = DEFAULT_SLOW_WAIT_THRESHOLD):
+        self.name = name
+        self.slow_wait_threshold = slow_wait_threshold
+        self._lock = asyncio.Lock()
+        self._acquired_at = 0.0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.acquisitions = 0
+        self.contended = 0 # 取得時に他のタスクが保持していた回数
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_hold = 0.0
+        self.max_hold = 0.0
+
+    def locked(self) -> bool: return self._lock.locked()
+
+    async def __aenter__(self):
+        contended = self._lock.locked()
+        start = time.perf_counter()
+        await self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        wait = self._acquired_at - start
+        self.acquisitions += 1
+        if contended:
+            self.contended += 1
+            self.total_wait += wait
+            if wait > self.max_wait: self.max_wait = wait
+            if wait >= self.slow_wait_threshold:
+                logger.warning(f"Lock '{self.name}' was contended for {wait * 1000:.1f} ms")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        hold = time.perf_counter() - self._acquired_at
+        self.total_hold += hold
+        if hold > self.max_hold: self.max_hold = hold
+        self._lock.release()
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        """計測値を返す (時間はミリ秒)"""
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "contention_rate": self.contended / self.acquisitions if self.acquisitions else 0.0,
+            "avg_wait_ms": self.total_wait / self.contended * 1000 if self.contended else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "avg_hold_ms": self.total_hold / self.acquisitions * 1000 if self.acquisitions else 0.0,
+            "max_hold_ms": self.max_hold * 1000,
+            "locked": self.locked(),
+        }
@@ -8,24 +8,83 @@ from collections import deque
 import datetime
 # ★ timezone の代わりにローカルタイムゾーンを使うため、特別な import は不要
 # from datetime import timezone
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple, Mapping, Awaitable, Callable
 import asyncio
+import copy
+import time
+import contextlib
+import itertools
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import storage
+from utils import json_codec
+from utils.async_locks import MonitoredLock
+from utils.request_scheduler import RequestScheduler
+from utils.rate_limiter import RetryBudget
+from utils.history_models import HistoryEntry
+from utils.history_buffer import HistoryBuffer
+from utils.history_archive import HistoryArchive
+from utils import history_partitions as partitions
+from utils.response_cache import ResponseCache
+from utils.context_cache import ContextCacheManager
+from utils.speaker_directory import SpeakerDirectory
+from utils.token_estimator import TokenMetrics
 
 logger = logging.getLogger(__name__)
 
 CONFIG_DIR = Path("config")
 PROMPTS_DIR = Path("prompts")
+GUILD_PROMPTS_DIR = PROMPTS_DIR / "guilds" # サーバーごとのプロンプトの差し替え (guilds/<サーバーID>/persona_prompt.txt など)
 HISTORY_FILE = CONFIG_DIR / "conversation_history.json"
+HISTORY_JOURNAL_FILE = CONFIG_DIR / "conversation_history.journal.jsonl" # 追記専用ジャーナル (1行1エントリ)
 BOT_CONFIG_FILE = CONFIG_DIR / "bot_config.json"
 USER_DATA_FILE = CONFIG_DIR / "user_data.json"
 CHANNEL_SETTINGS_FILE = CONFIG_DIR / "channel_settings.json"
 GEMINI_CONFIG_FILE = CONFIG_DIR / "gemini_config.json"
 GENERATION_CONFIG_FILE = CONFIG_DIR / "generation_config.json"
 WEATHER_CONFIG_FILE = CONFIG_DIR / "weather_config.json"
+SQLITE_DB_FILE = CONFIG_DIR / "bot_data.sqlite3" # storage_backend が "sqlite" の場合の保存先
+HISTORY_ARCHIVE_DIR = CONFIG_DIR / "history_archive" # ホットウィンドウから押し出された履歴の保存先
+HISTORY_PARTITIONS_DIR = CONFIG_DIR / "history_partitions" # スコープごとの履歴 (history_scope が global 以外) の退避先
+RESPONSE_CACHE_FILE = CONFIG_DIR / "response_cache.json" # 応答キャッシュ (response_cache_enabled が True の場合のみ)
 
 # --- デフォルト設定 ---
 DEFAULT_MAX_HISTORY = 20
 DEFAULT_MAX_RESPONSE_LENGTH = 1800
+DEFAULT_STORAGE_BACKEND = "json" # "json" または "sqlite" (bot_config.json の storage_backend)
+DEFAULT_COMPACT_JSON = False # True にすると user_data・履歴・チャンネル設定の JSON をインデントなしで保存する
+DEFAULT_HISTORY_ARCHIVE_ENABLED = True # False にすると押し出された履歴は従来どおり破棄する
+DEFAULT_HISTORY_ARCHIVE_BLOCK_SIZE = 64
+DEFAULT_GEMINI_REQUEST_TIMEOUT = 60.0 # Gemini API 1リクエストあたりのタイムアウト (秒)
+DEFAULT_GEMINI_MAX_CONCURRENCY = 4 # Gemini API への同時リクエスト数の上限
+DEFAULT_GEMINI_RPM_LIMIT = 15 # Gemini API のクォータ (APIキーごと): 1分あたりのリクエスト数 (0 で無制限)
+DEFAULT_GEMINI_TPM_LIMIT = 1_000_000 # Gemini API のクォータ (APIキーごと): 1分あたりのトークン数 (0 で無制限)
+DEFAULT_GEMINI_MAX_RETRIES = 4 # 429/5xx を受けたときの1リクエストあたりの再試行回数の上限
+DEFAULT_GEMINI_RETRY_BUDGET_RATIO = 0.2 # 再試行はリクエスト数のこの割合まで
+DEFAULT_STREAMING_RESPONSES = True # True なら応答をストリーミングで受け取り、届いた分から表示する
+DEFAULT_STREAM_EDIT_INTERVAL = 1.0 # ストリーミング中にメッセージを編集する最短間隔 (秒)
+DEFAULT_MESSAGE_COALESCE_WINDOW = 0.0 # 同じユーザー・チャンネルでこの秒数内に続いたメッセージをまとめて応答する (0 で無効)
+DEFAULT_MESSAGE_COALESCE_TYPING_WINDOW = 5.0 # まとめ待ちの間に入力中の通知があった場合に延ばす待ち時間 (秒)
+DEFAULT_MESSAGE_COALESCE_MAX_WAIT = 10.0 # 最初のメッセージからの最大待ち時間 (秒)
+DEFAULT_RESPONSE_CACHE_ENABLED = False # True にすると同じ入力への応答を再利用する (同じURL・PDFが何度も貼られる場合など)
+DEFAULT_RESPONSE_CACHE_TTL = 86400.0 # 応答キャッシュの有効期限 (秒)
+DEFAULT_RESPONSE_CACHE_MAX_ENTRIES = 500 # 応答キャッシュの件数上限 (超えたら最近使っていないものから消す)
+DEFAULT_RESPONSE_CACHE_MAX_TEMPERATURE = 0.5 # temperature がこれより高い場合は応答キャッシュを使わない
+DEFAULT_RESPONSE_CACHE_INCLUDE_HISTORY = False # True なら会話履歴が同じ場合のみ応答を再利用する
+RESPONSE_CACHE_SAVE_EVERY = 20 # 応答キャッシュをこの回数変更するごとにファイルへ保存する
+DEFAULT_CONTEXT_CACHE_ENABLED = False # True にするとペルソナと履歴の古い部分を Gemini のコンテキストキャッシュに置き、差分だけを送る
+DEFAULT_CONTEXT_CACHE_TTL = 1800.0 # コンテキストキャッシュの有効期限 (秒)
+DEFAULT_CONTEXT_CACHE_MIN_TOKENS = 4096 # キャッシュする部分の推定トークン数の下限 (モデルの最小キャッシュサイズ以上にする)
+DEFAULT_CONTEXT_CACHE_MAX_DELTA = 8 # キャッシュ後に増えた履歴がこの件数を超えたらキャッシュを作り直す
+DEFAULT_HISTORY_TOKEN_BUDGET = 32000 # プロンプトに入れる履歴の推定トークン数の上限 (新しいものから詰める。0 で件数のみで制限)
+DEFAULT_HISTORY_TOKEN_COUNT_EXACT = False # True なら履歴の各エントリのトークン数を裏で count_tokens により数え直す
+DEFAULT_HISTORY_SCOPE = partitions.SCOPE_GLOBAL # 履歴を分ける単位 (global / guild / channel / dm)。global 以外ではプロンプトに同じ場所の履歴だけを使う
+DEFAULT_HISTORY_PARTITION_MAX_LOADED = partitions.DEFAULT_MAX_LOADED # メモリに置く履歴パーティション数の上限
+DEFAULT_HISTORY_PARTITION_IDLE_SECONDS = partitions.DEFAULT_IDLE_SECONDS # この秒数使われなかった履歴パーティションはファイルに退避する
+DEFAULT_HISTORY_JOURNAL_COMPACT_THRESHOLD = 200 # ジャーナルがこの件数を超えたらスナップショットへ圧縮
+DEFAULT_USER_DATA_WRITE_DELAY = 2.0 # user_data の変更をまとめる待ち時間 (秒, 最後の変更から)
+DEFAULT_USER_DATA_MAX_WRITE_DELAY = 10.0 # 最初の未保存変更から書き込みまでの最大遅延 (秒)
 DEFAULT_RANDOM_DM_PROMPT = "最近どうですか？何か面白いことありましたか？"
 DEFAULT_PERSONA_PROMPT = "あなたは親切なAIアシスタントです。"
 DEFAULT_GENERATION_CONFIG = {
@@ -51,7 +110,9 @@ DEFAULT_RANDOM_DM_CONFIG = {
     "last_interaction": None,
     "next_send_time": None,
 }
-GLOBAL_HISTORY_KEY = "global_history"
+GLOBAL_HISTORY_KEY = storage.GLOBAL_HISTORY_KEY
+GENERATION_KIND_CHAT = "chat" # 会話への応答用の設定 (Google 検索ツールつき)
+GENERATION_KIND_RANDOM_DM = "random_dm" # ランダムDM用の設定 (ツールなし)
 
 # --- データ保持用変数 ---
 bot_settings: Dict[str, Any] = {}
@@ -59,34 +120,66 @@ user_data: Dict[str, Dict[str, Any]] = {}
 channel_settings: Dict[str, List[int]] = {}
 gemini_config: Dict[str, Any] = {}
 generation_config: Dict[str, Any] = {}
-conversation_history: Dict[str, deque] = {GLOBAL_HISTORY_KEY: deque(maxlen=DEFAULT_MAX_HISTORY)}
+conversation_history: Dict[str, HistoryBuffer] = {GLOBAL_HISTORY_KEY: HistoryBuffer(DEFAULT_MAX_HISTORY)}
 persona_prompt: str = ""
 random_dm_prompt: str = ""
+guild_prompt_overrides: Dict[str, Dict[str, str]] = {} # サーバーID → {ファイル名: 内容}
 weather_config: Dict[str, Any] = {}
-data_lock = asyncio.Lock()
+history_last_seq: int = 0 # ジャーナルに書き込んだ最後のシーケンス番号
+history_journal_count: int = 0 # 前回の圧縮以降にジャーナルへ追記した件数
+_storage: Optional[storage.StorageBackend] = None # user_data・履歴・チャンネル設定の保存先
+_history_archive: Optional[HistoryArchive] = None # 履歴のコールド層 (無効時は None)
+# 状態の領域ごとのロック (複数取る場合は settings → history → user_data → weather の順に取る)
+history_lock = MonitoredLock("history")
+user_data_lock = MonitoredLock("user_data")
+weather_lock = MonitoredLock("weather")
+settings_lock = MonitoredLock("settings")
+# Gemini API 呼び出しの実行枠 (チャット応答・ランダムDMで共有する)
+gemini_scheduler = RequestScheduler("gemini", DEFAULT_GEMINI_MAX_CONCURRENCY)
+gemini_retry_budget = RetryBudget(DEFAULT_GEMINI_RETRY_BUDGET_RATIO)
+response_cache = ResponseCache(DEFAULT_RESPONSE_CACHE_MAX_ENTRIES, DEFAULT_RESPONSE_CACHE_TTL)
+gemini_context_cache = ContextCacheManager()
+history_partitions = partitions.HistoryPartitions(HISTORY_PARTITIONS_DIR, DEFAULT_MAX_HISTORY) # スコープごとの履歴 (グローバル履歴とは別に保持)
+token_metrics = TokenMetrics() # 送ったトークン数の記録と見積もりの補正
+# 履歴の発言者名のキャッシュ (名前が変わったら speaker_names の版を上げ、整形済みの履歴を作り直させる)
+speaker_directory = SpeakerDirectory(lambda user_id: get_nickname(user_id), lambda: bump_version("speaker_names"))
+# 領域ごとのバージョン番号と、そのバージョンの不変スナップショット (変更時にバージョンを上げて破棄する)
+SNAPSHOT_DOMAINS = ("history", "user_data", "channel_settings", "gemini_config", "generation_config", "bot_settings", "prompts", "weather",
+                    "speaker_names") # speaker_names: 履歴の発言者名 (speaker_directory) の版 (整形済み履歴の作り直し用)
+_version_counter = itertools.count(1) # 全領域で共有する単調増加カウンタ
+_versions: Dict[str, int] = {domain: 0 for domain in SNAPSHOT_DOMAINS}
+_snapshots: Dict[str, Any] = {}
+_compiled_generation_configs: Dict[str, Tuple[Tuple[int, int], Any]] = {} # 種類 → ((generation_config の版, gemini_config の版), GenerateContentConfig)
+# user_data の遅延書き込み (write-behind) 用の状態
+_user_data_dirty_ids: set = set() # 未保存の変更があるユーザーID (str)
+_user_data_first_dirty_at: Optional[float] = None
+_user_data_last_dirty_at: Optional[float] = None
+_user_data_flush_task: Optional[asyncio.Task] = None
+# ディスク書き込みはすべてこの単一スレッドのワーカーが担当する (投入順に実行される)
+_io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="config_io")
 
 # --- ロード関数 ---
 def _load_json(filepath: Path, default: Any = {}) -> Any:
     """JSONファイルを安全に読み込む"""
     try:
         if filepath.exists() and filepath.is_file():
-            with open(filepath, 'r', encoding='utf-8') as f:
+            with open(filepath, 'rb') as f:
                 try:
-                    data = json.load(f)
+                    data = json_codec.loads(f.read())
                     logger.info(f"Successfully loaded JSON from: {filepath}")
                     return data
-                except json.JSONDecodeError:
-                    logger.error(f"Error decoding JSON from {filepath}. Creating with default value.")
-                    _save_json(filepath, default)
-                    return default.copy()
+                except (json_codec.DecodeError, UnicodeDecodeError):
+                    logger.error(f"Error decoding JSON from {filepath}. Quarantining it and creating with default value.")
+            # 壊れたファイルは上書きせずに退避してからデフォルト値で作り直す
+            if storage.quarantine_file(filepath) is not None: storage.save_json(filepath, default)
+            return default.copy()
         else:
             logger.warning(f"{filepath} not found. Creating with default value.")
-            _save_json(filepath, default)
+            storage.save_json(filepath, default)
             return default.copy()
     except Exception as e:
+        # 読み込めなかった (権限など) ファイルは上書きしない
         logger.error(f"Error loading {filepath}: {e}. Returning default value.")
-        try: _save_json(filepath, default)
-        except Exception as save_e: logger.error(f"Failed to save default config to {filepath} after load error.", exc_info=save_e)
         return default.copy()
 
 def _load_text(filepath: Path, default: str = "") -> str:
@@ -100,18 +193,58 @@ def _load_text(filepath: Path, default: str = "") -> str:
                 return content
         else:
              logger.warning(f"{filepath} not found or is not a file. Creating with default value.")
-             _save_text(filepath, default)
+             storage.save_text(filepath, default)
              return default
+    except UnicodeDecodeError as e:
+        logger.error(f"Error decoding {filepath}: {e}. Quarantining it and creating with default value.")
+        if storage.quarantine_file(filepath) is not None: storage.save_text(filepath, default)
+        return default
     except Exception as e:
+        # 読み込めなかった (権限など) ファイルは上書きしない
         logger.error(f"Error loading {filepath}: {e}. Returning default value.")
-        try: _save_text(filepath, default)
-        except Exception as save_e: logger.error(f"Failed to save default text to {filepath} after load error.", exc_info=save_e)
         return default
 
+def _load_guild_prompt_overrides() -> Dict[str, Dict[str, str]]:
+    """prompts/guilds/<サーバーID>/*.txt を読み込む (ディレクトリがなければ空。デフォルトのファイルは作らない)"""
+    overrides: Dict[str, Dict[str, str]] = {}
+    if not GUILD_PROMPTS_DIR.is_dir(): return overrides
+    for guild_dir in GUILD_PROMPTS_DIR.iterdir():
+        if not guild_dir.is_dir(): continue
+        for filepath in guild_dir.glob("*.txt"):
+            try: overrides.setdefault(guild_dir.name, {})[filepath.name] = filepath.read_text(encoding='utf-8')
+            except (OSError, UnicodeDecodeError) as e: logger.error(f"Error loading guild prompt {filepath}: {e}")
+    if overrides: logger.info(f"Loaded prompt overrides for {len(overrides)} guild(s).")
+    return overrides
+
+def _history_entry_from_dict(entry: Any) -> Optional[HistoryEntry]:
+    """ロードした履歴エントリ (保存形式の dict) を検証し HistoryEntry に変換する"""
+    if not isinstance(entry, dict):
+        logger.warning(f"Skipping non-dict entry in global history list: {entry}")
+        return None
+    try:
+        return HistoryEntry.from_dict(entry)
+    except (ValueError, TypeError, KeyError) as e: logger.warning(f"Skip invalid history entry: {entry} - Error: {e}")
+    return None
+
+def _create_storage_backend(backend_name: str, max_history: int, compact_json: bool = False) -> storage.StorageBackend:
+    """設定に応じたストレージバックエンドを生成する (不明な値や失敗時は JSON)"""
+    json_backend = storage.JsonStorageBackend(USER_DATA_FILE, CHANNEL_SETTINGS_FILE, HISTORY_FILE, HISTORY_JOURNAL_FILE, compact=compact_json)
+    if backend_name == "sqlite":
+        try:
+            sqlite_backend = storage.SqliteStorageBackend(SQLITE_DB_FILE)
+            if sqlite_backend.is_new: sqlite_backend.migrate_from(json_backend, max_history) # 初回のみ既存JSONを取り込む
+            return sqlite_backend
+        except Exception as e:
+            logger.error(f"Failed to open SQLite storage {SQLITE_DB_FILE}. Falling back to JSON storage.", exc_info=e)
+    elif backend_name != "json":
+        logger.warning(f"Unknown storage_backend '{backend_name}'. Using JSON storage.")
+    return json_backend
+
 def load_all_configs():
     """すべての設定とデータをロードする"""
     global bot_settings, user_data, channel_settings, gemini_config, generation_config
-    global conversation_history, persona_prompt, random_dm_prompt, weather_config
+    global conversation_history, persona_prompt, random_dm_prompt, weather_config, guild_prompt_overrides
+    global history_last_seq, history_journal_count, _storage, _history_archive
 
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
     PROMPTS_DIR.mkdir(parents=True, exist_ok=True)
@@ -120,9 +253,59 @@ def load_all_configs():
     loaded_bot_config = _load_json(BOT_CONFIG_FILE, {"max_history": DEFAULT_MAX_HISTORY, "max_response_length": DEFAULT_MAX_RESPONSE_LENGTH})
     bot_settings['max_history'] = loaded_bot_config.get('max_history', DEFAULT_MAX_HISTORY)
     bot_settings['max_response_length'] = loaded_bot_config.get('max_response_length', DEFAULT_MAX_RESPONSE_LENGTH)
+    bot_settings['history_journal_compact_threshold'] = loaded_bot_config.get('history_journal_compact_threshold', DEFAULT_HISTORY_JOURNAL_COMPACT_THRESHOLD)
+    bot_settings['user_data_write_delay'] = loaded_bot_config.get('user_data_write_delay', DEFAULT_USER_DATA_WRITE_DELAY)
+    bot_settings['user_data_max_write_delay'] = loaded_bot_config.get('user_data_max_write_delay', DEFAULT_USER_DATA_MAX_WRITE_DELAY)
+    bot_settings['storage_backend'] = loaded_bot_config.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+    bot_settings['compact_json'] = loaded_bot_config.get('compact_json', DEFAULT_COMPACT_JSON)
+    bot_settings['history_archive_enabled'] = loaded_bot_config.get('history_archive_enabled', DEFAULT_HISTORY_ARCHIVE_ENABLED)
+    bot_settings['history_archive_block_size'] = loaded_bot_config.get('history_archive_block_size', DEFAULT_HISTORY_ARCHIVE_BLOCK_SIZE)
+    bot_settings['gemini_request_timeout'] = loaded_bot_config.get('gemini_request_timeout', DEFAULT_GEMINI_REQUEST_TIMEOUT)
+    bot_settings['gemini_max_concurrency'] = loaded_bot_config.get('gemini_max_concurrency', DEFAULT_GEMINI_MAX_CONCURRENCY)
+    gemini_scheduler.set_max_concurrency(bot_settings['gemini_max_concurrency'])
+    bot_settings['gemini_rpm_limit'] = loaded_bot_config.get('gemini_rpm_limit', DEFAULT_GEMINI_RPM_LIMIT)
+    bot_settings['gemini_tpm_limit'] = loaded_bot_config.get('gemini_tpm_limit', DEFAULT_GEMINI_TPM_LIMIT)
+    bot_settings['gemini_max_retries'] = loaded_bot_config.get('gemini_max_retries', DEFAULT_GEMINI_MAX_RETRIES)
+    bot_settings['gemini_retry_budget_ratio'] = loaded_bot_config.get('gemini_retry_budget_ratio', DEFAULT_GEMINI_RETRY_BUDGET_RATIO)
+    gemini_retry_budget.ratio = bot_settings['gemini_retry_budget_ratio']
+    bot_settings['streaming_responses'] = loaded_bot_config.get('streaming_responses', DEFAULT_STREAMING_RESPONSES)
+    bot_settings['stream_edit_interval'] = loaded_bot_config.get('stream_edit_interval', DEFAULT_STREAM_EDIT_INTERVAL)
+    bot_settings['message_coalesce_window'] = loaded_bot_config.get('message_coalesce_window', DEFAULT_MESSAGE_COALESCE_WINDOW)
+    bot_settings['message_coalesce_typing_window'] = loaded_bot_config.get('message_coalesce_typing_window', DEFAULT_MESSAGE_COALESCE_TYPING_WINDOW)
+    bot_settings['message_coalesce_max_wait'] = loaded_bot_config.get('message_coalesce_max_wait', DEFAULT_MESSAGE_COALESCE_MAX_WAIT)
+    bot_settings['response_cache_enabled'] = loaded_bot_config.get('response_cache_enabled', DEFAULT_RESPONSE_CACHE_ENABLED)
+    bot_settings['response_cache_ttl'] = loaded_bot_config.get('response_cache_ttl', DEFAULT_RESPONSE_CACHE_TTL)
+    bot_settings['response_cache_max_entries'] = loaded_bot_config.get('response_cache_max_entries', DEFAULT_RESPONSE_CACHE_MAX_ENTRIES)
+    bot_settings['response_cache_max_temperature'] = loaded_bot_config.get('response_cache_max_temperature', DEFAULT_RESPONSE_CACHE_MAX_TEMPERATURE)
+    bot_settings['response_cache_include_history'] = loaded_bot_config.get('response_cache_include_history', DEFAULT_RESPONSE_CACHE_INCLUDE_HISTORY)
+    response_cache.configure(bot_settings['response_cache_max_entries'], bot_settings['response_cache_ttl'])
+    if bot_settings['response_cache_enabled'] and not len(response_cache):
+        response_cache.load_records(_load_json(RESPONSE_CACHE_FILE, {"entries": []}).get("entries", []))
+        response_cache.dirty = 0
+        logger.info(f"Response cache ready: {len(response_cache)} entries")
+    bot_settings['context_cache_enabled'] = loaded_bot_config.get('context_cache_enabled', DEFAULT_CONTEXT_CACHE_ENABLED)
+    bot_settings['context_cache_ttl'] = loaded_bot_config.get('context_cache_ttl', DEFAULT_CONTEXT_CACHE_TTL)
+    bot_settings['context_cache_min_tokens'] = loaded_bot_config.get('context_cache_min_tokens', DEFAULT_CONTEXT_CACHE_MIN_TOKENS)
+    bot_settings['context_cache_max_delta'] = loaded_bot_config.get('context_cache_max_delta', DEFAULT_CONTEXT_CACHE_MAX_DELTA)
+    gemini_context_cache.configure(bool(bot_settings['context_cache_enabled']), bot_settings['context_cache_ttl'],
+                                   bot_settings['context_cache_min_tokens'], bot_settings['context_cache_max_delta'])
+    bot_settings['history_token_budget'] = loaded_bot_config.get('history_token_budget', DEFAULT_HISTORY_TOKEN_BUDGET)
+    bot_settings['history_token_count_exact'] = loaded_bot_config.get('history_token_count_exact', DEFAULT_HISTORY_TOKEN_COUNT_EXACT)
+    bot_settings['history_scope'] = loaded_bot_config.get('history_scope', DEFAULT_HISTORY_SCOPE)
+    if bot_settings['history_scope'] not in partitions.HISTORY_SCOPES:
+        logger.warning(f"Unknown history_scope '{bot_settings['history_scope']}'. Using '{DEFAULT_HISTORY_SCOPE}'.")
+        bot_settings['history_scope'] = DEFAULT_HISTORY_SCOPE
+    bot_settings['history_partition_max_loaded'] = loaded_bot_config.get('history_partition_max_loaded', DEFAULT_HISTORY_PARTITION_MAX_LOADED)
+    bot_settings['history_partition_idle_seconds'] = loaded_bot_config.get('history_partition_idle_seconds', DEFAULT_HISTORY_PARTITION_IDLE_SECONDS)
+    history_partitions.configure(bot_settings['max_history'], bot_settings['history_partition_max_loaded'], bot_settings['history_partition_idle_seconds'])
+
+    if _storage is not None: # 再接続で on_ready から再び呼ばれた場合は、投入済みの書き込みを終えてから閉じる
+        _drain_io_worker()
+        _storage.close()
+    _storage = _create_storage_backend(bot_settings['storage_backend'], bot_settings['max_history'], bool(bot_settings['compact_json']))
 
     # user_data のロード (datetime aware ローカルTZに)
-    loaded_user_data = _load_json(USER_DATA_FILE)
+    loaded_user_data = _storage.load_user_data()
     temp_user_data = {}
     for uid, u_data in loaded_user_data.items():
         new_u_data = {}
@@ -155,172 +338,408 @@ def load_all_configs():
         temp_user_data[uid] = new_u_data
     user_data = temp_user_data
 
-    channel_settings = _load_json(CHANNEL_SETTINGS_FILE)
+    channel_settings = _storage.load_channel_settings()
     gemini_config = _load_json(GEMINI_CONFIG_FILE, DEFAULT_GEMINI_CONFIG)
     generation_config = _load_json(GENERATION_CONFIG_FILE, DEFAULT_GENERATION_CONFIG)
 
-    # 履歴のロード (datetime aware ローカルTZに)
-    loaded_history_data = _load_json(HISTORY_FILE)
+    # 履歴のロード (新しい max_history 件だけを保存形式の dict から HistoryEntry に変換)
     max_hist = bot_settings['max_history']
-    global_hist_list = loaded_history_data.get(GLOBAL_HISTORY_KEY, [])
-
-    dq = deque(maxlen=max_hist)
-    if isinstance(global_hist_list, list):
-        for entry in global_hist_list:
-            if isinstance(entry, dict):
-                try:
-                    if "timestamp" in entry and isinstance(entry["timestamp"], str):
-                         dt_obj = datetime.datetime.fromisoformat(entry["timestamp"])
-                         entry["timestamp"] = dt_obj.astimezone() # ローカルTZに変換
-                    elif "timestamp" not in entry or not isinstance(entry["timestamp"], datetime.datetime):
-                         entry["timestamp"] = None
-                    elif isinstance(entry["timestamp"], datetime.datetime):
-                         dt_obj = entry["timestamp"]
-                         if dt_obj.tzinfo is None or dt_obj.tzinfo.utcoffset(dt_obj) is None:
-                              entry["timestamp"] = dt_obj.astimezone()
-                         else:
-                              entry["timestamp"] = dt_obj.astimezone()
-
-                    entry.setdefault("role", None); entry.setdefault("parts", [])
-                    entry.setdefault("channel_id", None); entry.setdefault("interlocutor_id", None)
-                    entry.setdefault("current_interlocutor_id", None)
-                    if entry["role"] and entry["interlocutor_id"] is not None: dq.append(entry)
-                    else: logger.warning(f"Skipping history entry with missing info: {entry}")
-                except (ValueError, TypeError, KeyError) as e: logger.warning(f"Skip invalid history entry: {entry} - Error: {e}")
-            else: logger.warning(f"Skipping non-dict entry in global history list: {entry}")
-    else: logger.warning(f"Invalid history format (expected dict with key '{GLOBAL_HISTORY_KEY}'): {loaded_history_data}")
-
-    conversation_history = {GLOBAL_HISTORY_KEY: dq}
+    history_load_start = time.perf_counter()
+    _history_archive = None # 古いアーカイブは _drain_io_worker で書き出し済み
+    if bot_settings['history_archive_enabled']:
+        try: _history_archive = HistoryArchive(HISTORY_ARCHIVE_DIR, bot_settings['history_archive_block_size'])
+        except Exception as e: logger.error(f"Failed to open history archive {HISTORY_ARCHIVE_DIR}. Evicted history will be discarded.", exc_info=e)
+    # アーカイブが有効な場合は、前回アーカイブに書き出す前に停止した分 (最大1ブロック) も読み込む
+    overflow_allowance = bot_settings['history_archive_block_size'] if _history_archive is not None else 0
+    loaded_entries, last_seq = _storage.load_history(max_hist + overflow_allowance)
+    convert_start = time.perf_counter()
+    # 各エントリが保存時の seq を持つ (旧形式のエントリだけ last_seq から振る)。無効なエントリを飛ばしても番号はずれない
+    valid_records = [(seq, e) for seq, e in ((seq, _history_entry_from_dict(entry)) for seq, entry in storage.history_records(loaded_entries, last_seq)) if e is not None]
+    buffer = HistoryBuffer(max_hist)
+    evicted = []
+    for seq, e in valid_records: evicted.extend(buffer.append(seq, e))
+    if evicted and _history_archive is not None:
+        archived_until = _history_archive.last_seq
+        _history_archive.append([(seq, e.to_dict()) for seq, e in evicted if seq > archived_until])
+    history_load_end = time.perf_counter()
+    logger.info(f"Global history ready: {len(buffer)} entries in {(history_load_end - history_load_start) * 1000:.1f} ms "
+                f"(conversion {(history_load_end - convert_start) * 1000:.1f} ms)")
+
+    conversation_history = {GLOBAL_HISTORY_KEY: buffer}
+    history_last_seq = last_seq
+    history_journal_count = 0
 
     persona_prompt = _load_text(PROMPTS_DIR / "persona_prompt.txt", DEFAULT_PERSONA_PROMPT)
     random_dm_prompt = _load_text(PROMPTS_DIR / "random_dm_prompt.txt", DEFAULT_RANDOM_DM_PROMPT)
+    guild_prompt_overrides = _load_guild_prompt_overrides()
     weather_config = _load_json(WEATHER_CONFIG_FILE, {"last_location": None})
 
+    speaker_directory.clear() # ニックネームを読み直したので覚えた名前は捨てる
+    for domain in SNAPSHOT_DOMAINS: bump_version(domain)
     logger.info("All configurations and data loaded.")
 
-# --- 保存関数 ---
-def _save_json(filepath: Path, data: Any):
-    """JSONファイルに安全に書き込む (datetime/deque対応)"""
+# --- バージョン付きスナップショット ---
+def bump_version(domain: str) -> int:
+    """領域の状態を変更したら呼ぶ。新しいバージョン番号を返し、古いスナップショットを破棄する"""
+    version = next(_version_counter)
+    _versions[domain] = version
+    _snapshots.pop(domain, None)
+    return version
+
+def get_version(domain: Optional[str] = None) -> int:
+    """領域 (省略時は全体) の現在のバージョン番号を返す。変更のたびに単調増加するのでキャッシュのキーに使える"""
+    if domain is None: return max(_versions.values())
+    return _versions[domain]
+
+def _freeze(value: Any) -> Any:
+    """dict/list を読み取り専用の MappingProxyType/tuple に再帰的に変換する"""
+    if isinstance(value, dict): return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple, deque)): return tuple(_freeze(v) for v in value)
+    if isinstance(value, set): return frozenset(value)
+    return value
+
+def _get_snapshot(domain: str, build: Callable[[], Any]) -> Any:
+    """現在のバージョンのスナップショットを返す (なければ作る。次に変更されるまで全員で共有する)"""
+    snapshot = _snapshots.get(domain)
+    if snapshot is None:
+        snapshot = _snapshots[domain] = build()
+    return snapshot
+
+# --- I/Oワーカー ---
+def _submit_io(func: Callable[..., Any], *args: Any) -> Awaitable[Any]:
+    """書き込み処理をI/Oワーカーに投入し、完了を待てるハンドルを返す"""
+    future = _io_executor.submit(func, *args)
     try:
-        def dt_serializer(obj):
-            if isinstance(obj, datetime.datetime):
-                # aware datetimeをisoformatに変換（TZ情報が含まれる）
-                return obj.isoformat()
-            if isinstance(obj, deque): return list(obj)
-            try: json.dumps(obj); return obj
-            except TypeError: logger.warning(f"Object type {type(obj)} not JSON serializable, converting to str."); return str(obj)
-
-        filepath.parent.mkdir(parents=True, exist_ok=True)
-        temp_filepath = filepath.with_suffix(filepath.suffix + '.tmp')
-        with open(temp_filepath, 'w', encoding='utf-8') as f:
-            # default引数を使ってシリアライズ
-            json.dump(data, f, indent=4, ensure_ascii=False, default=dt_serializer)
-        os.replace(temp_filepath, filepath)
-        logger.debug(f"Successfully saved JSON to: {filepath}")
-    except Exception as e:
-        logger.error(f"Error saving data to {filepath}", exc_info=e)
-        if 'temp_filepath' in locals() and temp_filepath.exists():
-            try: os.remove(temp_filepath)
-            except OSError: pass
-
-
-def _save_text(filepath: Path, text: str):
-    """テキストファイルに安全に書き込む"""
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return future # イベントループ外 (起動前など) では concurrent.futures.Future のまま返す
+    return asyncio.wrap_future(future, loop=loop)
+
+def shutdown_io_worker():
+    """投入済みの書き込みをすべて完了させてからI/Oワーカーを停止する"""
+    logger.info("Waiting for pending config writes to finish...")
+    if _history_archive is not None: _io_executor.submit(_history_archive.flush)
+    _io_executor.shutdown(wait=True)
+    if _storage is not None: _storage.close()
+    logger.info("Config I/O worker stopped.")
+
+def _drain_io_worker():
+    """遅延中の書き込みを投入し、I/Oワーカーの処理がすべて終わるまで待つ (保存先を閉じる・差し替える前に呼ぶ)"""
+    if _user_data_first_dirty_at is not None:
+        dirty_ids = set(_user_data_dirty_ids)
+        _reset_user_data_dirty()
+        save_user_data_nolock(dirty_ids)
+    _save_dirty_partitions_nolock()
+    if _history_archive is not None: _io_executor.submit(_history_archive.flush)
+    _io_executor.submit(lambda: None).result() # 単一スレッドで順に処理するので、最後に投入したものが終われば全部終わっている
+    logger.debug("Drained config I/O worker.")
+
+def _snapshot_user_data() -> Dict[str, Dict[str, Any]]:
+    """保存用に user_data の不変スナップショットを取る (ネストした dict もコピー)"""
+    return {uid: {k: (v.copy() if isinstance(v, dict) else v) for k, v in u_data.items()} for uid, u_data in user_data.items()}
+
+# --- 非同期保存関数 (スナップショットの取得のみロック内で行い、書き込みはI/Oワーカーで行う) ---
+def save_user_data_nolock(dirty_ids: Optional[set] = None) -> Awaitable[Any]:
+    """ユーザーデータのスナップショットを取り、保存をI/Oワーカーに投入する (ロックなし)"""
+    logger.debug("Scheduling save of user_data (no lock)...")
+    return _submit_io(_storage.save_user_data, _snapshot_user_data(), set(dirty_ids) if dirty_ids is not None else None)
+
+def _history_window_snapshot() -> tuple:
+    """(seq, エントリ) のタプル (HistoryEntry は不変なのでそのままI/Oワーカーに渡せる)"""
+    buffer = conversation_history.get(GLOBAL_HISTORY_KEY)
+    return tuple(buffer.items()) if buffer is not None else ()
+
+def _stored_history(window: tuple) -> List[Dict[str, Any]]:
+    """保存形式に変換する (ロード時に振り直さないよう seq も保存する)"""
+    return [{**e.to_dict(), storage.HISTORY_SEQ_KEY: seq} for seq, e in window]
+
+def _compact_history(window: tuple, last_seq: int):
+    # 押し出し済みのエントリはスナップショットから消えるので、先にアーカイブへ書き出しておく
+    if _history_archive is not None: _history_archive.flush()
+    _storage.compact_history(_stored_history(window), last_seq) # dict への変換もI/Oワーカー上で行う
+
+def _delete_user_history(user_id: int, window: tuple, last_seq: int) -> int:
+    """保存済みの履歴とアーカイブからユーザーのエントリを消し、アーカイブから消した件数を返す"""
+    purged = _history_archive.purge_user(user_id) if _history_archive is not None else 0
+    _storage.delete_user_history(user_id, _stored_history(window), last_seq)
+    return purged
+
+def _delete_channel_history(channel_id: int, window: tuple, last_seq: int) -> int:
+    purged = _history_archive.purge_channel(channel_id) if _history_archive is not None else 0
+    _storage.delete_channel_history(channel_id, _stored_history(window), last_seq)
+    return purged
+
+def _clear_history(last_seq: int):
+    if _history_archive is not None: _history_archive.clear()
+    _storage.clear_history(last_seq)
+
+def _archive_history(evicted: list):
+    _history_archive.append([(seq, e.to_dict()) for seq, e in evicted])
+
+def _archive_evicted_nolock(evicted: list):
+    """ホットウィンドウから押し出されたエントリをアーカイブに送る (無効時は破棄)"""
+    if evicted and _history_archive is not None: _submit_io(_archive_history, evicted)
+
+def _append_history(seq: int, entry: HistoryEntry):
+    _storage.append_history(seq, entry.to_dict())
+
+def save_conversation_history_nolock() -> Awaitable[Any]:
+     """保存済みのグローバル会話履歴を現在のウィンドウに揃える (JSONではスナップショット化+ジャーナル圧縮, ロックなし)"""
+     global history_journal_count
+     logger.debug("Scheduling compaction of global conversation_history (no lock)...")
+     history_journal_count = 0
+     return _submit_io(_compact_history, _history_window_snapshot(), history_last_seq)
+
+def _next_history_seq() -> int:
+    """新しい履歴エントリのシーケンス番号を採番する (履歴ロック内で呼ぶ)"""
+    global history_last_seq
+    history_last_seq += 1
+    return history_last_seq
+
+def append_history_journal_nolock(seq: int, entry: HistoryEntry) -> Awaitable[Any]:
+    """履歴エントリを追記し、必要なら圧縮する (ロックなし)"""
+    global history_journal_count
+    handle = _submit_io(_append_history, seq, entry)
+    history_journal_count += 1
+    threshold = bot_settings.get('history_journal_compact_threshold', DEFAULT_HISTORY_JOURNAL_COMPACT_THRESHOLD)
+    if history_journal_count >= max(threshold, 1):
+        logger.info(f"History journal reached {history_journal_count} records. Compacting...")
+        handle = save_conversation_history_nolock() # I/Oワーカーは投入順に実行するので追記より後に完了する
+    return handle
+
+# --- user_data の遅延書き込み (write-behind) ---
+def mark_user_data_dirty(user_id_str: Optional[str] = None):
+    """user_data の変更を記録し、短時間の変更をまとめて1回の書き込みにする (ロック内で呼ぶ)"""
+    global _user_data_first_dirty_at, _user_data_last_dirty_at, _user_data_flush_task
+    bump_version("user_data")
+    now = time.monotonic()
+    if user_id_str is not None: _user_data_dirty_ids.add(user_id_str)
+    if _user_data_first_dirty_at is None: _user_data_first_dirty_at = now
+    _user_data_last_dirty_at = now
+    if _user_data_flush_task and not _user_data_flush_task.done(): return # 既存の待機に合流
     try:
-        filepath.parent.mkdir(parents=True, exist_ok=True)
-        temp_filepath = filepath.with_suffix(filepath.suffix + '.tmp')
-        with open(temp_filepath, 'w', encoding='utf-8') as f: f.write(text)
-        os.replace(temp_filepath, filepath)
-        logger.debug(f"Successfully saved text to: {filepath}")
-    except Exception as e:
-        logger.error(f"Error saving text to {filepath}", exc_info=e)
-        if 'temp_filepath' in locals() and temp_filepath.exists():
-            try: os.remove(temp_filepath)
-            except OSError: pass
-
-# --- 非同期保存関数 ---
-async def save_user_data_nolock():
-    """ユーザーデータを保存 (ロックなし, datetimeは_save_jsonで処理)"""
-    try:
-        logger.debug("Executing _save_json for user_data (no lock)...")
-        _save_json(USER_DATA_FILE, user_data)
-        logger.debug("Finished _save_json for user_data (no lock).")
-    except Exception as e:
-        logger.error("Failed to save user_data.json", exc_info=e)
-
-async def save_conversation_history_nolock():
-     """グローバル会話履歴を保存 (ロックなし, datetimeは_save_jsonで処理)"""
-     try:
-         logger.debug("Executing _save_json for global conversation_history (no lock)...")
-         _save_json(HISTORY_FILE, conversation_history)
-         logger.debug("Finished _save_json for global conversation_history (no lock).")
-     except Exception as e:
-         logger.error("Failed to save conversation_history.json", exc_info=e)
-
-# --- 同期保存関数 ---
-def save_bot_settings(): _save_json(BOT_CONFIG_FILE, bot_settings)
-def save_channel_settings(): _save_json(CHANNEL_SETTINGS_FILE, channel_settings)
-def save_gemini_config(): _save_json(GEMINI_CONFIG_FILE, gemini_config)
+        _user_data_flush_task = asyncio.get_running_loop().create_task(_user_data_write_behind(), name="user_data_write_behind")
+    except RuntimeError:
+        # イベントループ外ではまとめずにそのまま保存する
+        _reset_user_data_dirty()
+        save_user_data_nolock()
+
+def _reset_user_data_dirty():
+    global _user_data_first_dirty_at, _user_data_last_dirty_at
+    _user_data_dirty_ids.clear()
+    _user_data_first_dirty_at = None
+    _user_data_last_dirty_at = None
+
+async def _user_data_write_behind():
+    """最後の変更から一定時間待ってから保存する (最初の変更からの最大遅延で打ち切る)"""
+    while _user_data_first_dirty_at is not None:
+        delay = bot_settings.get('user_data_write_delay', DEFAULT_USER_DATA_WRITE_DELAY)
+        max_delay = bot_settings.get('user_data_max_write_delay', DEFAULT_USER_DATA_MAX_WRITE_DELAY)
+        deadline = min(_user_data_last_dirty_at + delay, _user_data_first_dirty_at + max_delay)
+        wait = deadline - time.monotonic()
+        if wait <= 0: break
+        await asyncio.sleep(wait)
+    await flush_user_data_async()
+
+async def flush_user_data_async():
+    """未保存の user_data の変更があれば直ちに保存する"""
+    async with user_data_lock:
+        if _user_data_first_dirty_at is None: return
+        dirty_ids = set(_user_data_dirty_ids)
+        _reset_user_data_dirty()
+        save_handle = save_user_data_nolock(dirty_ids)
+    logger.debug(f"Flushing user_data write-behind ({len(dirty_ids)} dirty user(s))")
+    await save_handle
+
+async def flush_pending_writes_async():
+    """シャットダウン時に遅延中の書き込みをすべて確定させる"""
+    if _user_data_flush_task and not _user_data_flush_task.done():
+        _user_data_flush_task.cancel()
+    await flush_user_data_async()
+    if response_cache.dirty: await save_response_cache()
+    async with history_lock:
+        handles = _save_dirty_partitions_nolock()
+    for handle in handles: await handle
+
+# --- 同期保存関数 (I/Oワーカーに投入し、完了ハンドルを返す。変更後に呼ばれるのでバージョンもここで上げる) ---
+def save_bot_settings(): bump_version("bot_settings"); return _submit_io(storage.save_json, BOT_CONFIG_FILE, bot_settings.copy())
+def save_channel_settings(): bump_version("channel_settings"); return _submit_io(_storage.save_channel_settings, copy.deepcopy(channel_settings))
+def save_gemini_config(): bump_version("gemini_config"); return _submit_io(storage.save_json, GEMINI_CONFIG_FILE, copy.deepcopy(gemini_config))
 def save_generation_config():
-    config_to_save = generation_config.copy(); config_to_save.pop("safety_settings", None); config_to_save.pop("tools", None); config_to_save.pop("system_instruction", None); _save_json(GENERATION_CONFIG_FILE, config_to_save)
-def save_persona_prompt(): _save_text(PROMPTS_DIR / "persona_prompt.txt", persona_prompt)
-def save_random_dm_prompt(): _save_text(PROMPTS_DIR / "random_dm_prompt.txt", random_dm_prompt)
-def save_weather_config(): _save_json(WEATHER_CONFIG_FILE, weather_config)
+    bump_version("generation_config")
+    config_to_save = generation_config.copy(); config_to_save.pop("safety_settings", None); config_to_save.pop("tools", None); config_to_save.pop("system_instruction", None); return _submit_io(storage.save_json, GENERATION_CONFIG_FILE, config_to_save)
+def save_persona_prompt(): bump_version("prompts"); return _submit_io(storage.save_text, PROMPTS_DIR / "persona_prompt.txt", persona_prompt)
+def save_random_dm_prompt(): bump_version("prompts"); return _submit_io(storage.save_text, PROMPTS_DIR / "random_dm_prompt.txt", random_dm_prompt)
+def save_weather_config(): bump_version("weather"); return _submit_io(storage.save_json, WEATHER_CONFIG_FILE, weather_config.copy())
+def save_response_cache(): response_cache.dirty = 0; return _submit_io(storage.save_json, RESPONSE_CACHE_FILE, {"entries": response_cache.records()}, True)
 
 
 # --- 設定値取得関数 ---
 def get_max_history() -> int: return bot_settings.get('max_history', DEFAULT_MAX_HISTORY)
 def get_max_response_length() -> int: return bot_settings.get('max_response_length', DEFAULT_MAX_RESPONSE_LENGTH)
+def get_gemini_request_timeout() -> float: return bot_settings.get('gemini_request_timeout', DEFAULT_GEMINI_REQUEST_TIMEOUT)
+def get_gemini_rpm_limit() -> int: return bot_settings.get('gemini_rpm_limit', DEFAULT_GEMINI_RPM_LIMIT)
+def get_gemini_tpm_limit() -> int: return bot_settings.get('gemini_tpm_limit', DEFAULT_GEMINI_TPM_LIMIT)
+def get_gemini_max_retries() -> int: return bot_settings.get('gemini_max_retries', DEFAULT_GEMINI_MAX_RETRIES)
+def get_streaming_responses_enabled() -> bool: return bool(bot_settings.get('streaming_responses', DEFAULT_STREAMING_RESPONSES))
+def get_stream_edit_interval() -> float: return bot_settings.get('stream_edit_interval', DEFAULT_STREAM_EDIT_INTERVAL)
+def get_message_coalesce_settings() -> Tuple[float, float, float]:
+    """(まとめる間隔, 入力中の延長時間, 最大待ち時間) を返す (秒)"""
+    return (bot_settings.get('message_coalesce_window', DEFAULT_MESSAGE_COALESCE_WINDOW),
+            bot_settings.get('message_coalesce_typing_window', DEFAULT_MESSAGE_COALESCE_TYPING_WINDOW),
+            bot_settings.get('message_coalesce_max_wait', DEFAULT_MESSAGE_COALESCE_MAX_WAIT))
+def get_response_cache_enabled() -> bool: return bool(bot_settings.get('response_cache_enabled', DEFAULT_RESPONSE_CACHE_ENABLED))
+def is_response_cache_applicable(generation_config_dict: Mapping[str, Any]) -> bool:
+    """応答キャッシュが有効で、temperature が閾値以下 (応答がほぼ決まる) なら True"""
+    if not get_response_cache_enabled(): return False
+    return generation_config_dict.get('temperature', 0.9) <= bot_settings.get('response_cache_max_temperature', DEFAULT_RESPONSE_CACHE_MAX_TEMPERATURE)
+def get_context_cache_enabled() -> bool: return gemini_context_cache.enabled
+def get_response_cache_include_history() -> bool: return bool(bot_settings.get('response_cache_include_history', DEFAULT_RESPONSE_CACHE_INCLUDE_HISTORY))
+def get_history_scope() -> str: return bot_settings.get('history_scope', DEFAULT_HISTORY_SCOPE)
+def get_history_token_budget() -> int: return bot_settings.get('history_token_budget', DEFAULT_HISTORY_TOKEN_BUDGET)
+def get_history_token_count_exact() -> bool: return bool(bot_settings.get('history_token_count_exact', DEFAULT_HISTORY_TOKEN_COUNT_EXACT))
 def get_nickname(user_id: int) -> Optional[str]: return user_data.get(str(user_id), {}).get("nickname")
-def get_all_user_data() -> Dict[str, Dict[str, Any]]: return user_data.copy()
-def get_allowed_channels(server_id: int) -> List[int]: return channel_settings.get(str(server_id), [])
-def get_all_channel_settings() -> Dict[str, List[int]]: return channel_settings.copy()
+# 以下の get_all_* などは読み取り専用のスナップショット (MappingProxyType/tuple) を返す。変更は config_manager の関数経由で行うこと
+def get_all_user_data() -> Mapping[str, Mapping[str, Any]]: return _get_snapshot("user_data", lambda: _freeze(user_data))
+def get_allowed_channels(server_id: int) -> Tuple[int, ...]: return get_all_channel_settings().get(str(server_id), ())
+def get_all_channel_settings() -> Mapping[str, Tuple[int, ...]]: return _get_snapshot("channel_settings", lambda: _freeze(channel_settings))
 def get_model_name() -> str: return gemini_config.get('model_name', DEFAULT_GEMINI_CONFIG['model_name'])
-def get_safety_settings_list() -> List[Dict[str, str]]: return gemini_config.get('safety_settings', DEFAULT_SAFETY_SETTINGS.copy())
-def get_generation_config_dict() -> Dict[str, Any]: return generation_config.copy()
+def get_safety_settings_list() -> Tuple[Mapping[str, str], ...]:
+    return _get_snapshot("gemini_config", lambda: _freeze(gemini_config)).get('safety_settings', _freeze(DEFAULT_SAFETY_SETTINGS))
+def get_generation_config_dict() -> Mapping[str, Any]: return _get_snapshot("generation_config", lambda: _freeze(generation_config))
 def get_persona_prompt() -> str: return persona_prompt
+def get_compiled_generation_config(kind: str = GENERATION_KIND_CHAT) -> Any:
+    """generation_config と safety_settings から作った GenerateContentConfig を返す (system_instruction なし)
+
+    generation_config・gemini_config の版が変わる (/config gemini set_* で保存される) まで同じオブジェクトを
+    共有するので変更しないこと。システムインストラクションは with_system_instruction() で付けたコピーを使う。
+    """
+    versions = (get_version("generation_config"), get_version("gemini_config"))
+    cached = _compiled_generation_configs.get(kind)
+    if cached is not None and cached[0] == versions: return cached[1]
+    from google.genai import types as genai_types # config_manager 自体は SDK なしでも読み込めるように、ここで読み込む
+    generation = get_generation_config_dict()
+    compiled = genai_types.GenerateContentConfig(
+        temperature=generation.get('temperature', 0.9),
+        top_p=generation.get('top_p', 1.0),
+        top_k=generation.get('top_k', 1),
+        candidate_count=generation.get('candidate_count', 1),
+        max_output_tokens=generation.get('max_output_tokens', 1024 if kind == GENERATION_KIND_CHAT else 512),
+        safety_settings=[genai_types.SafetySetting(**s) for s in get_safety_settings_list()],
+        tools=[genai_types.Tool(google_search=genai_types.GoogleSearch())] if kind == GENERATION_KIND_CHAT else None,
+    )
+    _compiled_generation_configs[kind] = (versions, compiled)
+    logger.debug(f"Compiled {kind} generation config (versions: {versions})")
+    return compiled
+def with_system_instruction(config: Any, system_instruction: Any) -> Any:
+    """共有の GenerateContentConfig にシステムインストラクションを付けたコピーを返す (他の項目は共有する)"""
+    return config.model_copy(update={"system_instruction": system_instruction})
 def get_random_dm_prompt() -> str: return random_dm_prompt
+def get_guild_prompt_override(guild_id: Optional[str], filename: str) -> Optional[str]:
+    """サーバーごとに差し替えたプロンプト (なければ None)"""
+    return guild_prompt_overrides.get(str(guild_id), {}).get(filename) if guild_id else None
 def get_default_random_dm_config() -> Dict[str, Any]: return DEFAULT_RANDOM_DM_CONFIG.copy()
-def get_global_history() -> deque:
-    max_hist = get_max_history()
-    if GLOBAL_HISTORY_KEY not in conversation_history: conversation_history[GLOBAL_HISTORY_KEY] = deque(maxlen=max_hist)
-    elif conversation_history[GLOBAL_HISTORY_KEY].maxlen != max_hist: conversation_history[GLOBAL_HISTORY_KEY] = deque(conversation_history[GLOBAL_HISTORY_KEY], maxlen=max_hist)
-    return conversation_history[GLOBAL_HISTORY_KEY].copy()
-def get_all_history() -> Dict[str, deque]: return conversation_history.copy()
+def get_global_history() -> Tuple[HistoryEntry, ...]:
+    """グローバル履歴の不変スナップショットを返す (ロック不要。履歴が変更されるまで同じタプルを共有する)"""
+    return _get_snapshot("history", lambda: tuple(conversation_history.get(GLOBAL_HISTORY_KEY, ())))
+def get_all_history() -> Dict[str, HistoryBuffer]: return conversation_history.copy()
+def get_user_history_count(user_id: int) -> int: return _global_history_buffer().count_for_user(user_id)
+def get_history_for_user(user_id: int) -> Tuple[HistoryEntry, ...]:
+    """指定ユーザーが発言者または会話相手のエントリを古い順に返す"""
+    return tuple(entry for _, entry in _global_history_buffer().entries_for_user(user_id))
+def get_history_stats() -> Dict[str, Any]:
+    """履歴の件数の内訳 (ユーザー別・チャンネル別) を返す"""
+    buffer = _global_history_buffer()
+    return {"total": len(buffer), "max_history": buffer.maxlen,
+            "user_counts": buffer.user_counts(), "channel_counts": buffer.channel_counts(),
+            "archived": _history_archive.archived_count if _history_archive is not None else None}
+
+async def get_archived_history_async(first_seq: Optional[int] = None, last_seq: Optional[int] = None) -> List[Dict[str, Any]]:
+    """アーカイブ (コールド層) から seq の範囲の履歴を保存形式の dict で読み出す (I/Oワーカー上で読む)"""
+    if _history_archive is None: return []
+    records = await _submit_io(lambda: list(_history_archive.iter_records(first_seq, last_seq)))
+    return [entry for _, entry in records]
 def get_last_weather_location() -> Optional[str]: return weather_config.get("last_location")
+def get_snapshot_versions() -> Dict[str, int]: return dict(_versions)
+def get_lock_stats() -> Dict[str, Dict[str, Any]]:
+    """領域ごとのロックの競合状況を返す"""
+    return {lock.name: lock.stats() for lock in (history_lock, user_data_lock, weather_lock, settings_lock)}
+
+def get_scheduler_stats() -> Dict[str, Any]:
+    """Gemini API の実行枠の使用状況と優先度ごとの待ち状況、再試行の状況を返す (キーごとの状況は gemini_pool)"""
+    return {**gemini_scheduler.stats(), "retry_budget": gemini_retry_budget.stats()}
+
+def get_response_cache_stats() -> Dict[str, Any]:
+    """応答キャッシュの件数とヒット・ミスの回数を返す"""
+    return {"enabled": get_response_cache_enabled(), **response_cache.stats()}
+
+def get_history_partition_stats() -> Dict[str, Any]:
+    """履歴のスコープと、メモリにあるパーティション数・読み込み・退避の回数を返す"""
+    return {"scope": get_history_scope(), **history_partitions.stats()}
+
+def get_token_metrics_stats() -> Dict[str, Any]:
+    """履歴として送ったトークン数・予算で削った回数と、見積もりと実際の入力トークン数を返す"""
+    return {"budget": get_history_token_budget(), **token_metrics.stats()}
+
+def get_speaker_directory_stats() -> Dict[str, Any]:
+    """発言者名キャッシュの件数とヒット・ミス、裏での取得の状況を返す"""
+    return speaker_directory.stats()
+
+def get_context_cache_stats() -> Dict[str, Any]:
+    """コンテキストキャッシュの利用状況 (キャッシュから読んだ入力トークン数と通常の入力トークン数など) を返す"""
+    return gemini_context_cache.stats()
+
+# --- 応答キャッシュ ---
+def get_cached_response(key: str) -> Optional[str]: return response_cache.get(key)
+def store_cached_response(key: str, text: str):
+    """応答をキャッシュに入れる (一定回数の変更ごとにI/Oワーカーで保存する)"""
+    response_cache.put(key, text)
+    if response_cache.dirty >= RESPONSE_CACHE_SAVE_EVERY: save_response_cache()
 
 # --- 設定値更新関数 (ロック付き) ---
 async def update_max_history_async(new_length: int):
     global bot_settings, conversation_history
     if new_length >= 0:
-        async with data_lock:
+        async with settings_lock, history_lock:
             bot_settings['max_history'] = new_length
-            logger.debug(f"Updating maxlen for global history deque...")
-            if GLOBAL_HISTORY_KEY in conversation_history:
-                 conversation_history[GLOBAL_HISTORY_KEY] = deque(conversation_history[GLOBAL_HISTORY_KEY], maxlen=new_length)
-            else:
-                 conversation_history[GLOBAL_HISTORY_KEY] = deque(maxlen=new_length)
-            save_bot_settings()
-            await save_conversation_history_nolock()
+            logger.debug(f"Updating maxlen for global history buffer...")
+            _archive_evicted_nolock(_global_history_buffer().resize(new_length))
+            history_partitions.resize(new_length)
+            _save_dirty_partitions_nolock()
+            bump_version("history")
+            settings_handle = save_bot_settings()
+            history_handle = save_conversation_history_nolock()
+        await settings_handle; await history_handle # 書き込み完了はロック外で待つ
         logger.info(f"Updated max_history to {new_length}")
 
+async def update_history_scope_async(scope: str):
+    """履歴を分ける単位を変更する (パーティションはスコープごとに別のキーなので、切り替えても混ざらない)"""
+    if scope not in partitions.HISTORY_SCOPES: raise ValueError(f"Unknown history scope: {scope}")
+    async with settings_lock:
+        bot_settings['history_scope'] = scope
+        settings_handle = save_bot_settings()
+    await settings_handle
+    logger.info(f"Updated history_scope to {scope}")
+
 async def update_nickname_async(user_id: int, nickname: str):
     global user_data
     user_id_str = str(user_id)
-    async with data_lock:
+    async with user_data_lock:
         user_data.setdefault(user_id_str, {})["nickname"] = nickname
-        await save_user_data_nolock()
+        mark_user_data_dirty(user_id_str)
+        speaker_directory.invalidate_user(user_id) # 発言者名の版も上がる
     logger.info(f"Updated nickname for user {user_id}")
 
 async def remove_nickname_async(user_id: int) -> bool:
     global user_data
     user_id_str = str(user_id)
     removed = False
-    async with data_lock:
+    async with user_data_lock:
         if user_id_str in user_data and "nickname" in user_data[user_id_str]:
             del user_data[user_id_str]["nickname"]
             if not user_data[user_id_str]: del user_data[user_id_str]
-            await save_user_data_nolock()
+            mark_user_data_dirty(user_id_str)
+            speaker_directory.invalidate_user(user_id)
             removed = True
     if removed: logger.info(f"Removed nickname for user {user_id}")
     return removed
@@ -329,7 +748,7 @@ async def update_random_dm_config_async(user_id: int, updates: Dict[str, Any]):
     """random_dm設定を更新し保存 (datetimeはaware ローカルTZを期待)"""
     global user_data
     user_id_str = str(user_id)
-    async with data_lock:
+    async with user_data_lock:
         # ★ get_or_create のような形で現在の設定を取得
         user_settings = user_data.setdefault(user_id_str, {})
         current_dm_config = user_settings.setdefault("random_dm", get_default_random_dm_config())
@@ -349,8 +768,8 @@ async def update_random_dm_config_async(user_id: int, updates: Dict[str, Any]):
                   logger.warning(f"Ignoring unknown key '{key}' in update_random_dm_config_async")
 
 
-        # user_data の更新は setdefault で行われているので、あとは保存のみ
-        await save_user_data_nolock()
+        # user_data の更新は setdefault で行われているので、あとは遅延保存に登録するのみ
+        mark_user_data_dirty(user_id_str)
     logger.info(f"Updated random DM config for user {user_id} with updates: {updates}")
 
 
@@ -370,9 +789,10 @@ def update_safety_setting(category_value: str, threshold_value: str):
 async def update_last_weather_location_async(location: Optional[str]):
     """最後に指定された天気取得場所を更新・保存する"""
     global weather_config
-    async with data_lock: # weather_configもロック対象にする
+    async with weather_lock:
         weather_config["last_location"] = location
-        save_weather_config() # 同期保存
+        save_handle = save_weather_config()
+    await save_handle
     if location:
         logger.info(f"Updated last weather location to: {location}")
     else:
@@ -380,84 +800,149 @@ async def update_last_weather_location_async(location: Optional[str]):
 
 
 # --- 履歴操作 ---
+def _global_history_buffer() -> HistoryBuffer:
+    """グローバル履歴のバッファを返す (なければ作り、保持件数を設定値に揃える)"""
+    max_hist = get_max_history()
+    buffer = conversation_history.get(GLOBAL_HISTORY_KEY)
+    if buffer is None:
+        buffer = conversation_history[GLOBAL_HISTORY_KEY] = HistoryBuffer(max_hist)
+    elif buffer.maxlen != max_hist:
+        _archive_evicted_nolock(buffer.resize(max_hist))
+    return buffer
+
+# --- スコープごとの履歴 (パーティション) ---
+def history_partition_key(scope: str, guild_id: Optional[int], channel_id: Optional[int], user_id: Optional[int]) -> str:
+    return partitions.partition_key(scope, guild_id, channel_id, user_id)
+
+def history_key_for(guild_id: Optional[int], channel_id: Optional[int], user_id: Optional[int]) -> str:
+    """会話の場所で使う履歴のキー (history_scope が global ならグローバル履歴のキー)"""
+    scope = get_history_scope()
+    return GLOBAL_HISTORY_KEY if scope == partitions.SCOPE_GLOBAL else history_partition_key(scope, guild_id, channel_id, user_id)
+
+_PARTITION_NOT_READ = object()
+
+def _install_partition_nolock(key: Optional[str], records: Any, generation: int) -> bool:
+    """ロック外で読んだパーティションをメモリに置く (ファイルがなければグローバル履歴の該当分で埋める。履歴ロック内で呼ぶ)
+
+    読んでいる間にファイルが書き換わった (退避・削除された) 場合は置かずに False を返すので、読み直す。
+    """
+    if key is None or history_partitions.get(key) is not None: return True # 他のタスクが先に置いた
+    if records is _PARTITION_NOT_READ or history_partitions.generation != generation: return False
+    backfilled = records is None
+    if backfilled:
+        keep = partitions.backfill_predicate(key)
+        records = [(seq, entry) for seq, entry in _global_history_buffer().items() if keep(entry)] if keep else []
+        logger.info(f"Created history partition {key} ({len(records)} entries from global history)")
+    history_partitions.install(key, records, backfilled)
+    _evict_partitions_nolock()
+    return True
+
+def _evict_partitions_nolock():
+    for evicted_key, evicted_records in history_partitions.take_evictions(): # 上限を超えた分・使われていない分を退避する
+        if evicted_records is not None: _submit_io(history_partitions.save_file, evicted_key, evicted_records)
+        logger.debug(f"Evicted history partition {evicted_key} from memory")
+
+@contextlib.asynccontextmanager
+async def _history_lock_with_partition(key: Optional[str]):
+    """履歴ロックを取り、key のパーティションをメモリに置いた状態にする (ファイルの読み込みはロックの外で待つ)"""
+    while True:
+        generation, records = history_partitions.generation, _PARTITION_NOT_READ
+        if key is not None and history_partitions.get(key) is None:
+            records = await _submit_io(history_partitions.load_file, key)
+        async with history_lock:
+            if _install_partition_nolock(key, records, generation):
+                yield
+                return
+        logger.debug(f"History partition {key} changed while loading. Reloading...")
+
+def _save_dirty_partitions_nolock() -> List[Awaitable[Any]]:
+    return [_submit_io(history_partitions.save_file, key, history_partitions.records(key)) for key in history_partitions.dirty_keys()]
+
+async def get_scoped_history_async(key: str) -> Tuple[HistoryEntry, ...]:
+    """パーティションの不変スナップショットを返す (メモリになければ履歴ロックを取ってファイルから読み込む)"""
+    if history_partitions.get(key) is not None: return history_partitions.snapshot(key)
+    async with _history_lock_with_partition(key):
+        return history_partitions.snapshot(key)
+
+async def sweep_history_partitions_async():
+    """しばらく使われていないパーティションをファイルに退避する (新しいパーティションを読まない間も退避されるよう定期的に呼ぶ)"""
+    if not history_partitions.loaded_keys(): return
+    async with history_lock:
+        _evict_partitions_nolock()
+
 async def add_history_entry_async(
     current_interlocutor_id: int,
     channel_id: Optional[int],
     role: str,
     parts_dict: List[Dict[str, Any]],
-    entry_author_id: int
+    entry_author_id: int,
+    guild_id: Optional[int] = None
 ):
-    """グローバル会話履歴にエントリを追加・保存する (非同期, aware ローカルTZ)"""
+    """グローバル会話履歴にエントリを追加・保存する (非同期, aware ローカルTZ)
+
+    history_scope が global 以外なら、会話の場所 (guild_id・channel_id・DM の相手) のパーティションにも追加する。
+    """
     global conversation_history
     if role not in ["user", "model"]: logger.error(f"Invalid role '{role}'"); return
-    max_hist = get_max_history()
+    scope = get_history_scope()
+    partition = None
+    if scope != partitions.SCOPE_GLOBAL: # グローバル履歴から埋める場合があるので、追加する前に読み込んでおく
+        partition = history_partition_key(scope, guild_id, channel_id, entry_author_id if role == "user" else current_interlocutor_id)
     logger.debug(f"add_history_entry_async (Global): Attempting lock...")
-    async with data_lock:
+    async with _history_lock_with_partition(partition):
         logger.debug(f"add_history_entry_async (Global): Acquired lock.")
-        if GLOBAL_HISTORY_KEY not in conversation_history:
-            conversation_history[GLOBAL_HISTORY_KEY] = deque(maxlen=max_hist)
-        elif conversation_history[GLOBAL_HISTORY_KEY].maxlen != max_hist:
-            conversation_history[GLOBAL_HISTORY_KEY] = deque(conversation_history[GLOBAL_HISTORY_KEY], maxlen=max_hist)
-        entry = {
-            "role": role, "parts": parts_dict, "channel_id": channel_id,
-            "interlocutor_id": entry_author_id,
-            "current_interlocutor_id": current_interlocutor_id,
-            "timestamp": datetime.datetime.now().astimezone() # ★ aware ローカルTZ
-        }
-        logger.debug(f"Appending entry to global history: {entry}")
-        conversation_history[GLOBAL_HISTORY_KEY].append(entry)
-        logger.debug(f"Calling save_conversation_history_nolock for global history")
-        await save_conversation_history_nolock() # 保存関数内でISO文字列化
+        buffer = _global_history_buffer()
+        entry = HistoryEntry.create(role, parts_dict, interlocutor_id=entry_author_id, channel_id=channel_id,
+                                    current_interlocutor_id=current_interlocutor_id)
+        seq = _next_history_seq()
+        logger.debug(f"Appending entry {seq} to global history")
+        _archive_evicted_nolock(buffer.append(seq, entry)) # 押し出された古いエントリはインデックスから外れ、アーカイブに移る
+        if partition is not None and history_partitions.append(partition, seq, entry):
+            _submit_io(history_partitions.save_file, partition, history_partitions.records(partition))
+        bump_version("history")
+        save_handle = append_history_journal_nolock(seq, entry) # 追記のみ (保存形式への変換はI/Oワーカーで行う)
     logger.debug(f"add_history_entry_async (Global): Released lock.")
+    await save_handle
 
 
 async def clear_all_history_async():
     """グローバル履歴を完全にクリアする"""
-    global conversation_history
-    async with data_lock:
-        if GLOBAL_HISTORY_KEY in conversation_history:
-            conversation_history[GLOBAL_HISTORY_KEY].clear()
-        else:
-            conversation_history[GLOBAL_HISTORY_KEY] = deque(maxlen=get_max_history())
-        await save_conversation_history_nolock()
+    async with history_lock:
+        _global_history_buffer().clear()
+        history_partitions.clear()
+        _submit_io(history_partitions.delete_files)
+        bump_version("history")
+        save_handle = _submit_io(_clear_history, history_last_seq)
+    await save_handle
     logger.warning("Cleared all global conversation history.")
 
 async def clear_user_history_async(target_user_id: int) -> int:
     """グローバル履歴から指定ユーザーが関与したエントリを削除する"""
-    global conversation_history; cleared_count = 0; target_user_id_str = str(target_user_id);
-    async with data_lock:
-        if GLOBAL_HISTORY_KEY not in conversation_history: return 0
-        new_deque = deque(maxlen=conversation_history[GLOBAL_HISTORY_KEY].maxlen)
-        original_len = len(conversation_history[GLOBAL_HISTORY_KEY])
-        logger.info(f"Clearing global history entries involving user {target_user_id_str}")
-        for entry in list(conversation_history[GLOBAL_HISTORY_KEY]):
-            if entry.get("interlocutor_id") != target_user_id and entry.get("current_interlocutor_id") != target_user_id:
-                new_deque.append(entry)
-            else: logger.debug(f"Removing entry involving user {target_user_id_str}: {entry}")
-        cleared_count = original_len - len(new_deque)
-        if cleared_count > 0:
-            conversation_history[GLOBAL_HISTORY_KEY] = new_deque
-            await save_conversation_history_nolock()
-            logger.info(f"Cleared global history for user {target_user_id}. {cleared_count} entries removed.")
-        else: logger.debug(f"No entries involving user {target_user_id_str} found to clear.")
+    async with history_lock:
+        logger.info(f"Clearing global history entries involving user {target_user_id}")
+        cleared_count = len(_global_history_buffer().remove_user(target_user_id)) # インデックスで該当エントリだけを削除
+        history_partitions.remove_user(target_user_id)
+        _submit_io(history_partitions.rewrite_files, lambda entry: not entry.involves_user(target_user_id), history_partitions.loaded_keys())
+        _save_dirty_partitions_nolock()
+        if cleared_count > 0: bump_version("history")
+        # ホットウィンドウから押し出された分はアーカイブにしか残っていないことがあるので、件数によらず削除する
+        save_handle = _submit_io(_delete_user_history, target_user_id, _history_window_snapshot(), history_last_seq)
+    cleared_count += await save_handle
+    if cleared_count > 0: logger.info(f"Cleared global history for user {target_user_id}. {cleared_count} entries removed.")
+    else: logger.debug(f"No entries involving user {target_user_id} found to clear.")
     return cleared_count
 
 async def clear_channel_history_async(channel_id: int) -> int:
     """グローバル履歴から指定チャンネルのエントリを削除する"""
-    global conversation_history; cleared_count = 0;
-    async with data_lock:
-        if GLOBAL_HISTORY_KEY not in conversation_history: return 0
-        new_deque = deque(maxlen=conversation_history[GLOBAL_HISTORY_KEY].maxlen)
-        original_len = len(conversation_history[GLOBAL_HISTORY_KEY])
+    async with history_lock:
         logger.info(f"Clearing global history entries for channel {channel_id}")
-        for entry in list(conversation_history[GLOBAL_HISTORY_KEY]):
-            if entry.get("channel_id") != channel_id:
-                new_deque.append(entry)
-            else: logger.debug(f"Removing entry for channel {channel_id}: {entry}")
-        cleared_count = original_len - len(new_deque)
-        if cleared_count > 0:
-            conversation_history[GLOBAL_HISTORY_KEY] = new_deque
-            await save_conversation_history_nolock()
-            logger.info(f"Cleared global history for channel {channel_id}. {cleared_count} entries removed.")
-        else: logger.debug(f"No entries for channel {channel_id} found to clear.")
+        cleared_count = len(_global_history_buffer().remove_channel(channel_id))
+        history_partitions.remove_channel(channel_id)
+        _submit_io(history_partitions.rewrite_files, lambda entry: entry.channel_id != channel_id, history_partitions.loaded_keys())
+        _save_dirty_partitions_nolock()
+        if cleared_count > 0: bump_version("history")
+        save_handle = _submit_io(_delete_channel_history, channel_id, _history_window_snapshot(), history_last_seq) # アーカイブにだけ残っている分も消す
+    cleared_count += await save_handle
+    if cleared_count > 0: logger.info(f"Cleared global history for channel {channel_id}. {cleared_count} entries removed.")
+    else: logger.debug(f"No entries for channel {channel_id} found to clear.")
     return cleared_count
\ No newline at end of file
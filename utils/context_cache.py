@@ -0,0 +1,257 @@
+# utils/context_cache.py (ペルソナと会話履歴の古い部分を Gemini のコンテキストキャッシュに置き、差分だけを送る)
+
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.token_estimator import estimate_contents_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 1800.0 # キャッシュの有効期限 (秒)
+DEFAULT_MIN_TOKENS = 4096 # 接頭部の推定トークン数がこれ未満ならキャッシュしない (API の最小トークン数に合わせる)
+DEFAULT_MAX_DELTA = 8 # キャッシュした後に増えた履歴がこの件数を超えたら作り直す
+DEFAULT_MAX_HANDLES = 16 # 持っておくキャッシュ数の上限 (キー・履歴のスコープ・システムインストラクションの組ごと。超えたら最近使っていないものから削除する)
+EXPIRY_MARGIN = 60.0 # 期限のこの秒数前からは使わない (送信中に切れるのを避ける)
+CREATE_FAILURE_BACKOFF = 300.0 # 作成に失敗したキーでは、この秒数は作成し直さない
+INVALID_CACHE_STATUS_CODES = (400, 403, 404) # キャッシュが消えている・使えない場合に返るステータスコード
+
+
+def _content_digest(content: Any) -> str:
+    """Content の役割とテキストのハッシュ (履歴のエントリがキャッシュしたものと同じかを比べる)"""
+    parts = [[getattr(part, 'text', None), repr(getattr(part, 'function_call', None)), repr(getattr(part, 'function_response', None))]
+             for part in getattr(content, 'parts', None) or ()]
+    return hashlib.sha256(json.dumps([getattr(content, 'role', None), parts], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class CacheableRequest:
+    """キャッシュできる部分 (システムインストラクション・ツール・履歴) と毎回送る部分 (tail) に分けたリクエスト
+
+    system_instruction には要求ごとに変わらない部分 (ペルソナなど) だけを入れる。要求ごとに変わる指示は
+    tail の Content に含める。scope_key は履歴のパーティションのキーで、スコープごとに別のキャッシュを持つために使う。
+    """
+
+    def __init__(self, system_instruction: Any, tools: Optional[List[Any]], history: List[Any], tail: List[Any], scope_key: Optional[str] = None):
+        self.system_instruction = system_instruction
+        self.scope_key = scope_key
+        self.tools = tools
+        self.history = list(history)
+        self.tail = list(tail)
+        self.system_digest = hashlib.sha256((_content_digest(system_instruction) + repr(tools)).encode('utf-8')).hexdigest()
+        self.history_digests = [_content_digest(content) for content in self.history]
+
+
+class CachedPrefix:
+    """作成済みのキャッシュ1つ (API キー・履歴のスコープ・システムインストラクションの組ごと)"""
+    __slots__ = ("name", "model", "system_digest", "entry_digests", "expire_at", "token_count")
+
+    def __init__(self, name: str, model: str, system_digest: str, entry_digests: Tuple[str, ...], expire_at: float, token_count: Optional[int]):
+        self.name = name
+        self.model = model
+        self.system_digest = system_digest
+        self.entry_digests = entry_digests
+        self.expire_at = expire_at # time.time() 基準
+        self.token_count = token_count
+
+    def is_fresh(self) -> bool: return time.time() < self.expire_at - EXPIRY_MARGIN
+
+
+class GeminiCacheBackend:
+    """client.aio.caches でキャッシュを作成・削除する"""
+
+    def __init__(self, client: Any): self.client = client
+
+    async def create(self, model: str, system_instruction: Any, tools: Optional[List[Any]], contents: List[Any], ttl: float) -> Tuple[str, float, Optional[int]]:
+        from google.genai import types as genai_types # SDK を使わないスタブでも読み込めるように、ここで読み込む
+        cached = await self.client.aio.caches.create(model=model, config=genai_types.CreateCachedContentConfig(
+            contents=contents or None, system_instruction=system_instruction, tools=tools, ttl=f"{int(ttl)}s",
+            display_name="discord-chat-bot context"))
+        expire_at = cached.expire_time.timestamp() if cached.expire_time else time.time() + ttl
+        return cached.name, expire_at, getattr(cached.usage_metadata, "total_token_count", None)
+
+    async def delete(self, name: str): await self.client.aio.caches.delete(name=name)
+
+
+class StubCacheBackend:
+    """API を呼ばずに作成・削除を記録するだけのバックエンド (ベンチマーク・動作確認用)"""
+
+    def __init__(self):
+        self.created: List[str] = []
+        self.deleted: List[str] = []
+        self.token_counts: Dict[str, int] = {} # キャッシュ名 → 推定トークン数 (スタブのクライアントが応答の使用量に使う)
+
+    async def create(self, model: str, system_instruction: Any, tools: Optional[List[Any]], contents: List[Any], ttl: float) -> Tuple[str, float, Optional[int]]:
+        name = f"cachedContents/stub-{len(self.created) + 1}"
+        self.created.append(name)
+        self.token_counts[name] = estimate_contents_tokens([system_instruction] + list(contents))
+        return name, time.time() + ttl, self.token_counts[name]
+
+    async def delete(self, name: str): self.deleted.append(name)
+
+
+def _with_cached_content(config: Any, name: str) -> Any:
+    """キャッシュを参照する設定を作る (システムインストラクションとツールはキャッシュ側にあるので外す)"""
+    update = {"cached_content": name, "system_instruction": None, "tools": None}
+    if hasattr(config, "model_copy"): return config.model_copy(update=update)
+    return SimpleNamespace(**{**vars(config), **update}) if config is not None else SimpleNamespace(**update)
+
+
+HandleKey = Tuple[str, Optional[str], str] # (キー名, 履歴のスコープ, システムインストラクションのハッシュ)
+
+
+class ContextCacheManager:
+    """API キー・履歴のスコープ・システムインストラクションの組ごとにキャッシュを持ち、リクエストをキャッシュ + 差分に組み替える
+
+    キャッシュは最近使った max_handles 個までを持つ (別のスコープやサーバーごとのプロンプトが互いのキャッシュを消し合わない)。
+
+    履歴の先頭側はエントリのハッシュで突き合わせ、キャッシュした最後のエントリより後だけを送る
+    (キャッシュ後に履歴の窓から押し出されたエントリは、作り直すまでキャッシュ側に残る)。
+    キャッシュがないか古い場合は今回は通常どおり送り、作成は裏で行う (応答を待たせない)。
+    """
+
+    def __init__(self, backend_factory: Optional[Callable[[Any], Any]] = None):
+        self.enabled = False
+        self.ttl = DEFAULT_TTL
+        self.min_tokens = DEFAULT_MIN_TOKENS
+        self.max_delta = DEFAULT_MAX_DELTA
+        self.max_handles = DEFAULT_MAX_HANDLES
+        self._backend_factory = backend_factory or (lambda endpoint: GeminiCacheBackend(endpoint.client))
+        self._backends: Dict[str, Tuple[Any, Any]] = {} # キー名 → (クライアント, バックエンド)
+        self._handles: "OrderedDict[HandleKey, CachedPrefix]" = OrderedDict() # 末尾が最近使ったもの
+        self._creating: Dict[HandleKey, asyncio.Task] = {}
+        self._create_blocked_until: Dict[str, float] = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests_cached = 0
+        self.requests_uncached = 0
+        self.cached_input_tokens = 0
+        self.uncached_input_tokens = 0
+        self.creations = 0
+        self.creation_failures = 0
+        self.invalidations = 0
+        self.too_small = 0 # 接頭部が小さすぎてキャッシュしなかった回数
+
+    def configure(self, enabled: bool, ttl: float, min_tokens: int, max_delta: int):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_delta = max(max_delta, 0)
+
+    def set_backend_factory(self, backend_factory: Callable[[Any], Any]):
+        """バックエンドを差し替える (スタブを使う場合など)。作成済みのキャッシュは忘れる"""
+        self._backend_factory = backend_factory
+        self._backends.clear()
+        self._handles.clear()
+
+    # --- リクエストの組み替え ---
+    def prepare(self, endpoint: Any, model: str, request: Optional[CacheableRequest], contents: Any, config: Any) -> Tuple[Any, Any, Optional[CachedPrefix]]:
+        """endpoint で使えるキャッシュがあれば (差分の contents, キャッシュ参照の config, キャッシュ) を返す
+
+        使えなければ渡された contents・config をそのまま返す。キャッシュがない・古い・差分が大きい場合は作り直しを始める。
+        """
+        if not self.enabled or request is None: return contents, config, None
+        self._backend(endpoint)
+        key = (endpoint.name, request.scope_key, request.system_digest)
+        handle = self._handles.get(key)
+        if handle is not None: self._handles.move_to_end(key)
+        delta = self._match(handle, model, request) if handle is not None else None
+        if delta is None or len(delta) > self.max_delta: self._schedule_create(endpoint, key, model, request)
+        if delta is None: return contents, config, None
+        return delta + request.tail, _with_cached_content(config, handle.name), handle
+
+    def _match(self, handle: CachedPrefix, model: str, request: CacheableRequest) -> Optional[List[Any]]:
+        """キャッシュした履歴が今の履歴の先頭側と一致すれば、それより後のエントリを返す"""
+        if handle.model != model or handle.system_digest != request.system_digest or not handle.is_fresh(): return None
+        cached, current = handle.entry_digests, request.history_digests
+        if not cached: return list(request.history)
+        for end in range(min(len(current), len(cached)), 0, -1):
+            # 今の履歴の先頭 end 件が、キャッシュした履歴の末尾 end 件と一致するか (先頭側は押し出されていてもよい)
+            if current[end - 1] == cached[-1] and tuple(current[:end]) == cached[len(cached) - end:]:
+                return request.history[end:]
+        return None
+
+    def _schedule_create(self, endpoint: Any, key: HandleKey, model: str, request: CacheableRequest):
+        task = self._creating.get(key)
+        if task is not None and not task.done(): return
+        if time.monotonic() < self._create_blocked_until.get(endpoint.name, 0.0): return
+        if estimate_contents_tokens([request.system_instruction] + request.history) < self.min_tokens: # プロンプトの予算と同じ見積もり
+            self.too_small += 1
+            return
+        self._creating[key] = asyncio.create_task(self._create(endpoint, key, model, request))
+
+    async def _create(self, endpoint: Any, key: HandleKey, model: str, request: CacheableRequest):
+        backend = self._backend(endpoint)
+        try:
+            name, expire_at, token_count = await backend.create(model, request.system_instruction, request.tools, request.history, self.ttl)
+        except Exception as e:
+            self.creation_failures += 1
+            self._create_blocked_until[endpoint.name] = time.monotonic() + CREATE_FAILURE_BACKOFF
+            logger.warning(f"Failed to create Gemini context cache for {endpoint.name}: {e}")
+            return
+        finally:
+            if self._creating.get(key) is asyncio.current_task(): del self._creating[key]
+        self.creations += 1
+        old = self._handles.pop(key, None)
+        self._handles[key] = CachedPrefix(name, model, request.system_digest, tuple(request.history_digests), expire_at, token_count)
+        logger.info(f"Created Gemini context cache {name} for {endpoint.name} (scope {request.scope_key}, {len(request.history)} history entries, {token_count} tokens)")
+        stale = [(backend, old)] if old is not None else []
+        while len(self._handles) > self.max_handles: # 最近使っていないキャッシュから削除する (別のキーのものはそのキーで消す)
+            (evicted_endpoint, _, _), evicted = self._handles.popitem(last=False)
+            entry = self._backends.get(evicted_endpoint)
+            if entry is not None: stale.append((entry[1], evicted))
+        for stale_backend, handle in stale: await self._delete(stale_backend, handle.name)
+
+    def _backend(self, endpoint: Any) -> Any:
+        """キーのバックエンドを返す (プールが作り直されてクライアントが変わった場合はキャッシュも忘れる)"""
+        entry = self._backends.get(endpoint.name)
+        if entry is None or entry[0] is not endpoint.client:
+            entry = self._backends[endpoint.name] = (endpoint.client, self._backend_factory(endpoint))
+            for key in [key for key in self._handles if key[0] == endpoint.name]: del self._handles[key]
+        return entry[1]
+
+    async def _delete(self, backend: Any, name: str):
+        try: await backend.delete(name)
+        except Exception as e: logger.debug(f"Failed to delete Gemini context cache {name}: {e}")
+
+    # --- 応答・エラーの記録 ---
+    def invalidate_on_error(self, endpoint: Any, handle: CachedPrefix, error: Exception) -> bool:
+        """キャッシュを使ったリクエストが失敗したとき、キャッシュが原因と考えられれば捨てて True を返す (呼び出し元はキャッシュなしで送り直す)"""
+        if getattr(error, "code", None) not in INVALID_CACHE_STATUS_CODES: return False
+        for key in [key for key, current in self._handles.items() if current is handle]: del self._handles[key]
+        self.invalidations += 1
+        logger.warning(f"Dropping Gemini context cache {handle.name} for {endpoint.name} after error: {error}")
+        return True
+
+    def record_usage(self, response: Any, handle: Optional[CachedPrefix]):
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", None) or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", None) or 0
+        if handle is not None: self.requests_cached += 1
+        else: self.requests_uncached += 1
+        self.cached_input_tokens += cached_tokens
+        self.uncached_input_tokens += max(prompt_tokens - cached_tokens, 0)
+
+    async def clear(self):
+        """作成中の処理を止め、作成済みのキャッシュをすべて削除する (シャットダウン時)"""
+        for task in self._creating.values(): task.cancel()
+        self._creating.clear()
+        handles, self._handles = self._handles, OrderedDict()
+        for (endpoint_name, _, _), handle in handles.items():
+            entry = self._backends.get(endpoint_name)
+            if entry is not None: await self._delete(entry[1], handle.name)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.cached_input_tokens + self.uncached_input_tokens
+        return {"enabled": self.enabled, "requests_cached": self.requests_cached, "requests_uncached": self.requests_uncached,
+                "cached_input_tokens": self.cached_input_tokens, "uncached_input_tokens": self.uncached_input_tokens,
+                "cached_ratio": self.cached_input_tokens / total if total else 0.0,
+                "creations": self.creations, "creation_failures": self.creation_failures,
+                "invalidations": self.invalidations, "too_small": self.too_small,
+                "handles": {f"{endpoint_name}/{scope_key or 'global'}/{digest[:8]}": {"name": h.name, "entries": len(h.entry_digests), "tokens": h.token_count,
+                                   "expires_in": max(h.expire_at - time.time(), 0.0)} for (endpoint_name, scope_key, digest), h in self._handles.items()}}
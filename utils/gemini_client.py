@@ -0,0 +1,206 @@
+# utils/gemini_client.py (Gemini API 呼び出しをイベントループを止めずに行うためのヘルパー)
+
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, AsyncIterator
+
+from utils import config_manager
+from utils import rate_limiter
+from utils import token_estimator
+from utils.gemini_pool import GeminiClientPool, PoolEndpoint
+from utils.context_cache import CacheableRequest, CachedPrefix
+from utils.request_scheduler import PRIORITY_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REQUEST_TIMEOUT = 60.0 # 1リクエストあたりのタイムアウト (秒)
+FALLBACK_MAX_WORKERS = 4 # aio クライアントが使えない場合に同期APIを実行するスレッド数の上限
+RETRYABLE_STATUS_CODES = (429, 500, 503) # 待ってから再試行する API エラーのステータスコード
+
+# aio を持たないクライアント用。スレッド数を絞って同時実行を制限する
+_fallback_executor = ThreadPoolExecutor(max_workers=FALLBACK_MAX_WORKERS, thread_name_prefix="gemini")
+
+
+async def generate_content_async(pool: GeminiClientPool, *, model: str, contents: Any, config: Any = None,
+                                 timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT,
+                                 priority: int = PRIORITY_CHANNEL, user_id: Optional[int] = None,
+                                 cache_request: Optional[CacheableRequest] = None) -> Any:
+    """generate_content を非同期に呼び出す
+
+    config_manager.gemini_scheduler の実行枠を priority・user_id で確保し、pool から選んだキーで呼び出す。
+    client.aio.models.generate_content (SDK の非同期API) を優先し、使えない場合は同期APIを
+    上限付きのスレッドプールで実行する。timeout 秒を超えると asyncio.TimeoutError を送出する
+    (枠の待ち時間は含まない)。呼び出し元のタスクがキャンセルされた場合、非同期APIのリクエストも
+    キャンセルされる (スレッドプールで実行中の同期APIは中断できないため、結果を待たずに戻る)。
+    cache_request を渡すと、選んだキーにコンテキストキャッシュがあれば差分だけを送る
+    (config_manager.gemini_context_cache。contents・config はキャッシュを使わない場合の内容)。
+    """
+    raw_tokens = _estimate_raw_tokens(contents, config)
+    estimated_tokens = config_manager.token_metrics.calibrated(raw_tokens) + 1 # TPM の枠取り用 (実測値で補正した見積もり)
+    config_manager.gemini_retry_budget.record_request()
+    async with config_manager.gemini_scheduler.slot(priority, user_id):
+        attempt = 0
+        while True:
+            endpoint = await _acquire_endpoint(pool, estimated_tokens)
+            client, endpoint_model = endpoint.client, endpoint.model or model
+            call_contents, call_config, cache_handle = config_manager.gemini_context_cache.prepare(endpoint, endpoint_model, cache_request, contents, config)
+            started = time.monotonic()
+            try:
+                aio = getattr(client, "aio", None)
+                if aio is not None:
+                    request = aio.models.generate_content(model=endpoint_model, contents=call_contents, config=call_config)
+                else:
+                    loop = asyncio.get_running_loop()
+                    request = loop.run_in_executor(_fallback_executor,
+                                                   lambda: client.models.generate_content(model=endpoint_model, contents=call_contents, config=call_config))
+                response = await _with_timeout(request, timeout)
+            except Exception as e:
+                if _drop_invalid_cache(pool, endpoint, cache_handle, e):
+                    cache_request = None
+                    continue
+                if not await _handle_failure(pool, endpoint, e, attempt): raise
+                attempt += 1
+                continue
+            except BaseException:
+                pool.release_cancelled(endpoint)
+                raise
+            _release_success(pool, endpoint, started, estimated_tokens, response, cache_handle, raw_tokens)
+            return response
+
+
+async def generate_content_stream_async(pool: GeminiClientPool, *, model: str, contents: Any, config: Any = None,
+                                        timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT,
+                                        priority: int = PRIORITY_CHANNEL, user_id: Optional[int] = None,
+                                        cache_request: Optional[CacheableRequest] = None) -> AsyncIterator[Any]:
+    """generate_content_stream を非同期イテレータとして呼び出す
+
+    実行枠はストリームを読み終えるまで保持する。timeout はストリーム開始までと、各チャンクの
+    到着間隔それぞれに適用する (応答全体の長さには上限を設けない)。途中で抜けた場合はストリームを閉じる。
+    再試行は最初のチャンクを受け取る前のエラーに限る。cache_request は generate_content_async と同じ。
+    """
+    raw_tokens = _estimate_raw_tokens(contents, config)
+    estimated_tokens = config_manager.token_metrics.calibrated(raw_tokens) + 1
+    config_manager.gemini_retry_budget.record_request()
+    async with config_manager.gemini_scheduler.slot(priority, user_id):
+        attempt = 0
+        while True:
+            endpoint = await _acquire_endpoint(pool, estimated_tokens)
+            endpoint_model = endpoint.model or model
+            call_contents, call_config, cache_handle = config_manager.gemini_context_cache.prepare(endpoint, endpoint_model, cache_request, contents, config)
+            started = time.monotonic()
+            last_chunk = None
+            try:
+                async for chunk in _stream_chunks(endpoint.client, model=endpoint_model, contents=call_contents, config=call_config, timeout=timeout):
+                    last_chunk = chunk
+                    yield chunk
+            except Exception as e:
+                if last_chunk is not None:
+                    pool.release_cancelled(endpoint)
+                    raise
+                if _drop_invalid_cache(pool, endpoint, cache_handle, e):
+                    cache_request = None
+                    continue
+                if not await _handle_failure(pool, endpoint, e, attempt): raise
+                attempt += 1
+                continue
+            except BaseException:
+                pool.release_cancelled(endpoint)
+                raise
+            _release_success(pool, endpoint, started, estimated_tokens, last_chunk, cache_handle, raw_tokens)
+            return
+
+
+# --- キーの選択・送信ペース・再試行 (キーごとのクォータは pool、再試行の予算は config_manager.gemini_retry_budget) ---
+async def count_tokens_async(pool: GeminiClientPool, *, model: str, contents: Any,
+                             timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT) -> Optional[int]:
+    """count_tokens で入力トークン数を数える (失敗したら None)
+
+    count_tokens は生成とは別のクォータなので、実行枠や送信ペースは使わず、切り離されていないキーで呼ぶ。
+    """
+    now = time.monotonic()
+    endpoint = next((e for e in pool.endpoints if e.is_available(now)), None)
+    aio = getattr(endpoint.client, "aio", None) if endpoint is not None else None
+    if aio is None: return None
+    try: response = await _with_timeout(aio.models.count_tokens(model=endpoint.model or model, contents=contents), timeout)
+    except Exception as e:
+        logger.debug(f"count_tokens failed on {endpoint.name}: {e}")
+        return None
+    return getattr(response, "total_tokens", None)
+
+
+async def _acquire_endpoint(pool: GeminiClientPool, estimated_tokens: int) -> PoolEndpoint:
+    pool.set_limits(config_manager.get_gemini_rpm_limit(), config_manager.get_gemini_tpm_limit())
+    return await pool.acquire(estimated_tokens)
+
+def _release_success(pool: GeminiClientPool, endpoint: PoolEndpoint, started: float, estimated_tokens: int, response: Any,
+                     cache_handle: Optional[CachedPrefix], raw_tokens: int):
+    usage = getattr(response, "usage_metadata", None)
+    pool.release_success(endpoint, time.monotonic() - started, estimated_tokens, getattr(usage, "total_token_count", None))
+    config_manager.gemini_context_cache.record_usage(response, cache_handle)
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    config_manager.token_metrics.record_prompt(raw_tokens, prompt_tokens) # 見積もりの補正にも使う
+    logger.debug(f"Prompt tokens: estimated {estimated_tokens}, actual {prompt_tokens}")
+
+def _drop_invalid_cache(pool: GeminiClientPool, endpoint: PoolEndpoint, cache_handle: Optional[CachedPrefix], error: Exception) -> bool:
+    """キャッシュを使ったリクエストがキャッシュのせいで失敗した場合は True (呼び出し元はキャッシュなしですぐ送り直す)"""
+    if cache_handle is None or not config_manager.gemini_context_cache.invalidate_on_error(endpoint, cache_handle, error): return False
+    pool.release_failure(endpoint, getattr(error, "code", None), None)
+    return True
+
+async def _handle_failure(pool: GeminiClientPool, endpoint: PoolEndpoint, error: Exception, attempt: int) -> bool:
+    """失敗をプールに記録し、再試行できるエラーなら必要なだけ待って True を返す"""
+    code = getattr(error, "code", None)
+    retry_after = rate_limiter.parse_retry_after(error) if code in RETRYABLE_STATUS_CODES else None
+    pool.release_failure(endpoint, code, retry_after)
+    if code not in RETRYABLE_STATUS_CODES: return False
+    if attempt >= config_manager.get_gemini_max_retries() or not config_manager.gemini_retry_budget.try_spend():
+        logger.warning(f"Giving up on Gemini request after {attempt + 1} attempt(s) (status {code}).")
+        return False
+    if pool.has_available_endpoint():
+        logger.info(f"Gemini API key {endpoint.name} returned {code}. Retrying with another key (attempt {attempt + 1}).")
+        return True
+    delay = rate_limiter.backoff_delay(attempt, retry_after)
+    logger.info(f"Gemini API returned {code}. Retrying in {delay:.1f}s (attempt {attempt + 1}).")
+    await asyncio.sleep(delay)
+    return True
+
+def _estimate_raw_tokens(contents: Any, config: Any) -> int:
+    """リクエスト全体 (システムインストラクションを含む) の補正前の見積もり (utils.token_estimator)"""
+    system_instruction = getattr(config, "system_instruction", None)
+    return token_estimator.estimate_contents_tokens(list(contents if isinstance(contents, (list, tuple)) else [contents])
+                                                    + ([system_instruction] if system_instruction else []))
+
+
+async def _stream_chunks(client: Any, *, model: str, contents: Any, config: Any, timeout: Optional[float]) -> AsyncIterator[Any]:
+    aio = getattr(client, "aio", None)
+    if aio is not None:
+        stream = await _with_timeout(aio.models.generate_content_stream(model=model, contents=contents, config=config), timeout)
+        iterator = stream.__aiter__()
+        try:
+            while True:
+                try: chunk = await _with_timeout(iterator.__anext__(), timeout)
+                except StopAsyncIteration: return
+                yield chunk
+        finally:
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None: await aclose()
+    else:
+        loop = asyncio.get_running_loop()
+        iterator = await _with_timeout(loop.run_in_executor(
+            _fallback_executor, lambda: iter(client.models.generate_content_stream(model=model, contents=contents, config=config))), timeout)
+        finished = object()
+        try:
+            while True:
+                chunk = await _with_timeout(loop.run_in_executor(_fallback_executor, next, iterator, finished), timeout)
+                if chunk is finished: return
+                yield chunk
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None: close()
+
+
+async def _with_timeout(awaitable, timeout: Optional[float]):
+    if timeout is None or timeout <= 0: return await awaitable
+    return await asyncio.wait_for(awaitable, timeout=timeout)
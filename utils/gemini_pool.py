@@ -0,0 +1,160 @@
+# utils/gemini_pool.py (複数の API キー / モデルに Gemini リクエストを振り分けるクライアントプール)
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.rate_limiter import AdaptiveRateLimiter, DEFAULT_RPM_LIMIT, DEFAULT_TPM_LIMIT
+
+logger = logging.getLogger(__name__)
+
+KEYS_ENV = "GOOGLE_AI_KEYS" # カンマ区切りで複数指定 ("KEY" または "KEY:モデル名")
+KEY_ENV = "GOOGLE_AI_KEY" # 従来の単一キー (GOOGLE_AI_KEYS がない場合に使う)
+EJECT_BASE = 5.0 # 429/5xx を返したキーを外す時間の基準 (秒。連続するたびに倍にする)
+EJECT_CAP = 300.0 # キーを外す時間の上限 (秒)
+LATENCY_SMOOTHING = 0.3 # 応答時間の指数移動平均の係数
+INITIAL_LATENCY = 2.0 # 応答時間の実績がないキーの見込み (秒)
+
+
+class PoolEndpoint:
+    """プール内の1つの API キー (とモデルの指定)"""
+
+    def __init__(self, name: str, client: Any, model: Optional[str] = None,
+                 rpm_limit: int = DEFAULT_RPM_LIMIT, tpm_limit: int = DEFAULT_TPM_LIMIT):
+        self.name = name
+        self.client = client
+        self.model = model # None ならリクエストで指定されたモデルを使う
+        self.limiter = AdaptiveRateLimiter(rpm_limit, tpm_limit) # クォータはキーごと
+        self.in_flight = 0
+        self.latency = INITIAL_LATENCY # 応答時間の指数移動平均 (秒)
+        self.ejected_until = 0.0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def is_available(self, now: float) -> bool: return now >= self.ejected_until
+
+    def score(self, estimated_tokens: int) -> float:
+        """小さいほど先に選ぶ (クォータの空きを待つ時間 + 混み具合を考慮した応答時間の見込み)"""
+        return self.limiter.estimated_wait(estimated_tokens) + self.latency * (1 + self.in_flight)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"model": self.model, "in_flight": self.in_flight, "latency_ms": self.latency * 1000,
+                "requests": self.requests, "failures": self.failures, "ejections": self.ejections,
+                "ejected_for_ms": max(self.ejected_until - time.monotonic(), 0.0) * 1000,
+                "rate_limiter": self.limiter.stats()}
+
+
+class GeminiClientPool:
+    """複数のキーにリクエストを振り分ける
+
+    acquire() でクォータの空きと応答時間の見込みが最も良いキーを選び、そのキーの送信ペースに
+    従って待つ。429/5xx を返したキーは一定時間候補から外す (すべて外れている場合は最初に戻るキーを待つ)。
+    """
+
+    def __init__(self, endpoints: List[PoolEndpoint]):
+        if not endpoints: raise ValueError("GeminiClientPool requires at least one endpoint")
+        self.endpoints = endpoints
+        self._limits: Optional[Tuple[int, int]] = None
+
+    def set_limits(self, rpm_limit: int, tpm_limit: int):
+        """キーごとの RPM/TPM を設定する (変わったときだけバケットを作り直す)"""
+        if self._limits == (rpm_limit, tpm_limit): return
+        self._limits = (rpm_limit, tpm_limit)
+        for endpoint in self.endpoints: endpoint.limiter.configure(rpm_limit, tpm_limit)
+
+    async def acquire(self, estimated_tokens: int) -> PoolEndpoint:
+        while True:
+            now = time.monotonic()
+            available = [e for e in self.endpoints if e.is_available(now)]
+            if available: break
+            wait = min(e.ejected_until for e in self.endpoints) - now
+            logger.info(f"All Gemini API keys are ejected. Waiting {wait:.1f}s.")
+            await asyncio.sleep(wait)
+        endpoint = min(available, key=lambda e: e.score(estimated_tokens))
+        endpoint.in_flight += 1
+        try:
+            await endpoint.limiter.acquire(estimated_tokens)
+        except BaseException:
+            endpoint.in_flight -= 1
+            raise
+        endpoint.requests += 1
+        return endpoint
+
+    def has_available_endpoint(self) -> bool:
+        now = time.monotonic()
+        return any(e.is_available(now) for e in self.endpoints)
+
+    def release_success(self, endpoint: PoolEndpoint, elapsed: float, estimated_tokens: int, actual_tokens: Optional[int]):
+        endpoint.in_flight -= 1
+        endpoint.consecutive_failures = 0
+        endpoint.latency += (elapsed - endpoint.latency) * LATENCY_SMOOTHING
+        endpoint.limiter.on_success()
+        endpoint.limiter.record_usage(estimated_tokens, actual_tokens)
+
+    def release_failure(self, endpoint: PoolEndpoint, code: Optional[int], retry_after: Optional[float]):
+        """リクエストが失敗したときに呼ぶ。429/5xx ならキーを一時的に外す"""
+        endpoint.in_flight -= 1
+        endpoint.failures += 1
+        if code == 429: endpoint.limiter.on_rate_limited(retry_after)
+        if code == 429 or (code is not None and 500 <= code < 600):
+            endpoint.consecutive_failures += 1
+            cooldown = min(EJECT_CAP, max(retry_after or 0.0, EJECT_BASE * 2 ** (endpoint.consecutive_failures - 1)))
+            endpoint.ejected_until = time.monotonic() + cooldown
+            endpoint.ejections += 1
+            logger.warning(f"Ejecting Gemini API key {endpoint.name} for {cooldown:.0f}s after status {code}.")
+
+    def release_cancelled(self, endpoint: PoolEndpoint):
+        endpoint.in_flight -= 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+
+def parse_key_entries(value: str) -> List[Tuple[str, Optional[str]]]:
+    """「KEY1,KEY2:gemini-2.0-flash」を [(キー, モデル or None), ...] にする"""
+    entries = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item: continue
+        key, _, model = item.partition(":")
+        entries.append((key.strip(), model.strip() or None))
+    return entries
+
+
+_shared_pool: Optional[GeminiClientPool] = None
+
+def get_shared_pool(client_factory: Callable[[str], Any]) -> Optional[GeminiClientPool]:
+    """環境変数のキーからプールを作り、全 Cog で共有する (キーがなければ None)
+
+    client_factory は API キーからクライアント (genai.Client) を作る関数。
+    """
+    global _shared_pool
+    if _shared_pool is not None: return _shared_pool
+    entries = parse_key_entries(os.getenv(KEYS_ENV, "")) or parse_key_entries(os.getenv(KEY_ENV, ""))
+    if not entries:
+        logger.error(f"Neither {KEYS_ENV} nor {KEY_ENV} is set in environment variables.")
+        return None
+    endpoints = []
+    for index, (key, model) in enumerate(entries, start=1):
+        try: endpoints.append(PoolEndpoint(f"key#{index}", client_factory(key), model))
+        except Exception as e: logger.error(f"Failed to initialize Gemini client for key#{index}", exc_info=e)
+    if not endpoints: return None
+    _shared_pool = GeminiClientPool(endpoints)
+    logger.info(f"Gemini client pool initialized with {len(endpoints)} key(s).")
+    return _shared_pool
+
+def current_shared_pool() -> Optional[GeminiClientPool]:
+    """作成済みの共有プール (まだなければ None。作成はしない)"""
+    return _shared_pool
+
+def reset_shared_pool():
+    """次回 get_shared_pool() で環境変数から作り直す"""
+    global _shared_pool
+    _shared_pool = None
+
+def shared_pool_stats() -> Dict[str, Dict[str, Any]]:
+    return _shared_pool.stats() if _shared_pool is not None else {}
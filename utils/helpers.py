@@ -41,6 +41,30 @@ def remove_all_prefixes(text: str) -> str:
     return cleaned_text
 
 
+def find_split_end(text: str, start: int, max_length: int) -> int:
+    """text[start:] を max_length 文字以内で区切る位置 (次の開始位置) を返す"""
+    end = start + max_length
+    if end >= len(text): return len(text) # 残りが max_length 以下の場合
+    # 境界を探す範囲を限定
+    search_start = max(start, end - 100) # 区切りは max_length 付近で見つける
+    # 改行を最優先
+    split_pos = text.rfind('\n', search_start, end)
+    if split_pos == -1:
+        # 次に句読点（全角・半角）を探す
+        split_pos = max(text.rfind('。', search_start, end), text.rfind('、', search_start, end),
+                        text.rfind('！', search_start, end), text.rfind('？', search_start, end),
+                        text.rfind('.', search_start, end), text.rfind(',', search_start, end),
+                        text.rfind('!', search_start, end), text.rfind('?', search_start, end))
+    if split_pos == -1:
+         # 次にスペース
+         split_pos = text.rfind(' ', search_start, end)
+
+    # 適切な区切りが見つからない、または区切りが前すぎる場合はmax_lengthで強制分割
+    if split_pos == -1 or split_pos < start:
+        split_pos = end - 1 # max_lengthギリギリで区切る
+    return split_pos + 1 # 区切り文字の次を次の開始位置にする
+
+
 async def split_and_send_messages(message_system: discord.Message, text: str, max_length: int):
     """メッセージを分割して送信 (エラーハンドリング強化)"""
     if not text or not text.strip(): # 空文字列や空白のみの場合は送信しない
@@ -55,34 +79,7 @@ async def split_and_send_messages(message_system: discord.Message, text: str, ma
         # 長いメッセージを分割
         start = 0
         while start < len(text):
-            # 区切り位置を探す（改行、句読点、スペースなど）
-            end = start + max_length
-            split_pos = -1 # 初期化
-            if end < len(text):
-                # 境界を探す範囲を限定
-                search_start = max(start, end - 100) # 区切りは max_length 付近で見つける
-                # 改行を最優先
-                split_pos = text.rfind('\n', search_start, end)
-                if split_pos == -1:
-                    # 次に句読点（全角・半角）を探す
-                    split_pos = max(text.rfind('。', search_start, end), text.rfind('、', search_start, end),
-                                    text.rfind('！', search_start, end), text.rfind('？', search_start, end),
-                                    text.rfind('.', search_start, end), text.rfind(',', search_start, end),
-                                    text.rfind('!', search_start, end), text.rfind('?', search_start, end))
-                if split_pos == -1:
-                     # 次にスペース
-                     split_pos = text.rfind(' ', search_start, end)
-
-                # 適切な区切りが見つからない、または区切りが前すぎる場合はmax_lengthで強制分割
-                # (split_pos == -1 or split_pos < start) の条件を追加して、startより前にならないように
-                if split_pos == -1 or split_pos < start :
-                    split_pos = end -1 # max_lengthギリギリで区切る
-
-                end = split_pos + 1 # 区切り文字の次を次の開始位置にする
-            else: # 残りが max_length 以下の場合
-                 end = len(text)
-
-
+            end = find_split_end(text, start, max_length)
             sub_message = text[start:end]
             if sub_message.strip(): # 空白のみのチャンクは追加しない
                  messages_to_send.append(sub_message)
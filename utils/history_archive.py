@@ -0,0 +1,211 @@
+# utils/history_archive.py (ホットウィンドウから押し出された履歴を保存する圧縮アーカイブ)
+
+import os
+import gzip
+import logging
+import datetime
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Tuple, Iterator, Callable
+
+from utils import json_codec
+from utils import storage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 64 # 1ブロックにまとめるエントリ数
+DEFAULT_SEGMENT_MAX_BYTES = 4 * 1024 * 1024 # これを超えたら次のセグメントに切り替える
+
+ArchiveRecord = Tuple[int, Dict[str, Any]] # (seq, 保存形式の履歴エントリ)
+
+
+class HistoryArchive:
+    """追記専用のセグメント形式アーカイブ (コールド層)
+
+    各セグメントは gzip メンバー (ブロック) を連結したファイルで、ブロックごとに JSONL で
+    エントリを格納する。セグメントごとのインデックス (.idx.json) にブロックのオフセット・長さ・
+    seq の範囲・含まれるユーザー/チャンネルを記録し、必要なブロックだけを読み出す。
+    メソッドは config_manager の I/O ワーカー (単一スレッド) から呼ばれる。
+    """
+
+    def __init__(self, directory: Path, block_size: int = DEFAULT_BLOCK_SIZE, segment_max_bytes: int = DEFAULT_SEGMENT_MAX_BYTES):
+        self.directory = directory
+        self.block_size = max(block_size, 1)
+        self.segment_max_bytes = segment_max_bytes
+        self._pending: List[ArchiveRecord] = [] # まだブロックになっていないエントリ
+        self._segments: List[Dict[str, Any]] = [] # {"id", "data_file", "blocks": [...]} を古い順に保持
+        directory.mkdir(parents=True, exist_ok=True)
+        self._load_indexes()
+
+    # --- インデックス ---
+    def _index_path(self, segment_id: int) -> Path:
+        return self.directory / f"segment-{segment_id:06d}.idx.json"
+
+    def _load_indexes(self):
+        for index_path in sorted(self.directory.glob("segment-*.idx.json")):
+            try:
+                segment_id = int(index_path.name.split("-")[1].split(".")[0])
+                with open(index_path, 'rb') as f: index = json_codec.loads(f.read())
+                data_path = self.directory / index["data_file"]
+                data_size = data_path.stat().st_size if data_path.exists() else 0
+                # 書き込み途中で止まったブロック (データが足りないもの) はインデックスから外す
+                blocks = [b for b in index.get("blocks", []) if b["offset"] + b["length"] <= data_size]
+                self._segments.append({"id": segment_id, "data_file": index["data_file"], "blocks": blocks})
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error(f"Skipping unreadable history archive index {index_path}", exc_info=e)
+        self._segments.sort(key=lambda seg: seg["id"])
+        if self._segments:
+            logger.info(f"Loaded history archive: {len(self._segments)} segment(s), {self.archived_count} entries")
+
+    def _save_index(self, segment: Dict[str, Any]):
+        storage.save_json(self._index_path(segment["id"]), {"data_file": segment["data_file"], "blocks": segment["blocks"]}, compact=True)
+
+    @property
+    def last_seq(self) -> int:
+        """アーカイブ済みの最後の seq (空なら 0)"""
+        if self._pending: return self._pending[-1][0]
+        for segment in reversed(self._segments):
+            if segment["blocks"]: return segment["blocks"][-1]["last_seq"]
+        return 0
+
+    @property
+    def archived_count(self) -> int:
+        return sum(b["count"] for seg in self._segments for b in seg["blocks"]) + len(self._pending)
+
+    def stats(self) -> Dict[str, Any]:
+        data_bytes = sum(b["length"] for seg in self._segments for b in seg["blocks"])
+        return {"entries": self.archived_count, "segments": len(self._segments),
+                "blocks": sum(len(seg["blocks"]) for seg in self._segments), "bytes": data_bytes, "pending": len(self._pending)}
+
+    # --- 書き込み ---
+    def append(self, records: List[ArchiveRecord]):
+        """押し出されたエントリを追加する (block_size 件たまるごとにブロックとして書き出す)"""
+        self._pending.extend(records)
+        while len(self._pending) >= self.block_size:
+            block, self._pending = self._pending[:self.block_size], self._pending[self.block_size:]
+            self._write_block(block)
+
+    def flush(self):
+        """たまっているエントリを (block_size 未満でも) ブロックとして書き出す"""
+        if self._pending:
+            block, self._pending = self._pending, []
+            self._write_block(block)
+
+    def _current_segment(self) -> Dict[str, Any]:
+        if self._segments:
+            segment = self._segments[-1]
+            data_path = self.directory / segment["data_file"]
+            if not data_path.exists() or data_path.stat().st_size < self.segment_max_bytes: return segment
+        segment_id = self._segments[-1]["id"] + 1 if self._segments else 1
+        segment = {"id": segment_id, "data_file": f"segment-{segment_id:06d}.jsonl.gz", "blocks": []}
+        self._segments.append(segment)
+        return segment
+
+    @staticmethod
+    def _encode_block(records: List[ArchiveRecord]) -> bytes:
+        lines = b"".join(json_codec.dumps({"seq": seq, "entry": entry}, compact=True) + b"\n" for seq, entry in records)
+        return gzip.compress(lines, compresslevel=6)
+
+    @staticmethod
+    def _block_meta(records: List[ArchiveRecord], offset: int, length: int) -> Dict[str, Any]:
+        users, channels = set(), set()
+        for _, entry in records:
+            for key in ("interlocutor_id", "current_interlocutor_id"):
+                if entry.get(key) is not None: users.add(entry[key])
+            channels.add(entry.get("channel_id"))
+        return {"offset": offset, "length": length, "first_seq": records[0][0], "last_seq": records[-1][0],
+                "count": len(records), "users": sorted(users), "channels": sorted(channels, key=lambda c: (c is None, c or 0))}
+
+    def _write_block(self, records: List[ArchiveRecord]):
+        try:
+            segment = self._current_segment()
+            data = self._encode_block(records)
+            data_path = self.directory / segment["data_file"]
+            with open(data_path, 'ab') as f:
+                offset = f.tell()
+                f.write(data); f.flush(); os.fsync(f.fileno())
+            segment["blocks"].append(self._block_meta(records, offset, len(data)))
+            self._save_index(segment)
+            logger.debug(f"Archived {len(records)} history entries to {data_path.name} (offset {offset}, {len(data)} bytes)")
+        except Exception as e:
+            logger.error(f"Error writing history archive block ({len(records)} entries)", exc_info=e)
+
+    # --- 読み出し ---
+    def _read_block(self, segment: Dict[str, Any], block: Dict[str, Any]) -> List[ArchiveRecord]:
+        with open(self.directory / segment["data_file"], 'rb') as f:
+            f.seek(block["offset"])
+            data = gzip.decompress(f.read(block["length"]))
+        records = []
+        for line in data.splitlines():
+            if not line: continue
+            record = json_codec.loads(line)
+            records.append((record["seq"], record["entry"]))
+        return records
+
+    def iter_records(self, first_seq: Optional[int] = None, last_seq: Optional[int] = None) -> Iterator[ArchiveRecord]:
+        """seq の範囲に重なるブロックだけを読み、古い順にエントリを返す"""
+        for segment in list(self._segments):
+            for block in list(segment["blocks"]):
+                if first_seq is not None and block["last_seq"] < first_seq: continue
+                if last_seq is not None and block["first_seq"] > last_seq: continue
+                for seq, entry in self._read_block(segment, block):
+                    if (first_seq is None or seq >= first_seq) and (last_seq is None or seq <= last_seq):
+                        yield seq, entry
+        for seq, entry in list(self._pending):
+            if (first_seq is None or seq >= first_seq) and (last_seq is None or seq <= last_seq):
+                yield seq, entry
+
+    # --- 削除 (/history clear に合わせてアーカイブからも消す) ---
+    def purge_user(self, user_id: int) -> int:
+        return self._purge(lambda block: user_id in block["users"],
+                           lambda entry: entry.get("interlocutor_id") == user_id or entry.get("current_interlocutor_id") == user_id)
+
+    def purge_channel(self, channel_id: Optional[int]) -> int:
+        return self._purge(lambda block: channel_id in block["channels"], lambda entry: entry.get("channel_id") == channel_id)
+
+    def clear(self):
+        self._pending = []
+        for segment in self._segments:
+            for path in (self.directory / segment["data_file"], self._index_path(segment["id"])):
+                try: path.unlink()
+                except FileNotFoundError: pass
+                except OSError as e: logger.error(f"Failed to delete history archive file {path}", exc_info=e)
+        self._segments = []
+        logger.info("Cleared history archive.")
+
+    def _purge(self, block_matches: Callable[[Dict[str, Any]], bool], entry_matches: Callable[[Dict[str, Any]], bool]) -> int:
+        """該当エントリを含むブロックがあるセグメントだけを書き直す"""
+        removed = 0
+        before = len(self._pending)
+        self._pending = [(seq, entry) for seq, entry in self._pending if not entry_matches(entry)]
+        removed += before - len(self._pending)
+        for segment in list(self._segments):
+            if not any(block_matches(block) for block in segment["blocks"]): continue
+            try:
+                removed += self._rewrite_segment(segment, entry_matches)
+            except Exception as e:
+                logger.error(f"Error purging history archive segment {segment['data_file']}", exc_info=e)
+        return removed
+
+    def _rewrite_segment(self, segment: Dict[str, Any], entry_matches: Callable[[Dict[str, Any]], bool]) -> int:
+        # 新しいデータファイルを書いてからインデックスを差し替え、最後に古いデータファイルを消す (途中で落ちても整合性を保つ)
+        old_data_path = self.directory / segment["data_file"]
+        stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+        new_data_file = f"segment-{segment['id']:06d}.r{stamp}.jsonl.gz"
+        new_blocks, removed, offset = [], 0, 0
+        with open(self.directory / new_data_file, 'wb') as f:
+            for block in segment["blocks"]:
+                records = self._read_block(segment, block)
+                kept = [(seq, entry) for seq, entry in records if not entry_matches(entry)]
+                removed += len(records) - len(kept)
+                if not kept: continue
+                data = self._encode_block(kept)
+                f.write(data)
+                new_blocks.append(self._block_meta(kept, offset, len(data)))
+                offset += len(data)
+            f.flush(); os.fsync(f.fileno())
+        segment["data_file"], segment["blocks"] = new_data_file, new_blocks
+        self._save_index(segment)
+        try: old_data_path.unlink()
+        except OSError: pass
+        logger.info(f"Rewrote history archive segment {segment['id']} ({removed} entries purged)")
+        return removed
@@ -0,0 +1,113 @@
+# utils/history_buffer.py (ユーザー・チャンネル別のインデックスを持つ会話履歴のリングバッファ)
+
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Iterator
+
+from utils.history_models import HistoryEntry
+
+SeqEntry = Tuple[int, HistoryEntry]
+
+
+class HistoryBuffer:
+    """maxlen 件まで保持する履歴バッファ (deque(maxlen) の置き換え)
+
+    エントリはシーケンス番号 (seq) をキーに古い順で保持し、発言者/会話相手ごと・チャンネルごとの
+    二次インデックスを追加・押し出し・削除のたびに更新する。ユーザーやチャンネル単位の
+    検索・削除は該当する件数 k に比例するコストで済む。
+    """
+    __slots__ = ("_maxlen", "_entries", "_by_user", "_by_channel")
+
+    def __init__(self, maxlen: int, entries: Optional[List[SeqEntry]] = None):
+        self._maxlen = max(maxlen, 0)
+        self._entries: "OrderedDict[int, HistoryEntry]" = OrderedDict()
+        self._by_user: Dict[int, Dict[int, None]] = {} # user_id -> seq の順序付き集合
+        self._by_channel: Dict[Optional[int], Dict[int, None]] = {} # channel_id (DMは None) -> seq の順序付き集合
+        for seq, entry in entries or (): self.append(seq, entry)
+
+    # --- 基本操作 ---
+    @property
+    def maxlen(self) -> int: return self._maxlen
+
+    def __len__(self) -> int: return len(self._entries)
+    def __bool__(self) -> bool: return bool(self._entries)
+    def __iter__(self) -> Iterator[HistoryEntry]: return iter(self._entries.values())
+
+    def items(self) -> Iterator[SeqEntry]:
+        """(seq, entry) を古い順に返す"""
+        return iter(self._entries.items())
+
+    def append(self, seq: int, entry: HistoryEntry) -> List[SeqEntry]:
+        """末尾に追加し、maxlen を超えて押し出されたエントリを返す"""
+        if self._maxlen == 0: return [(seq, entry)]
+        self._entries[seq] = entry
+        self._index(seq, entry)
+        return self._evict_overflow()
+
+    def resize(self, maxlen: int) -> List[SeqEntry]:
+        """保持件数を変更し、押し出されたエントリを返す"""
+        self._maxlen = max(maxlen, 0)
+        return self._evict_overflow()
+
+    def clear(self) -> List[SeqEntry]:
+        removed = list(self._entries.items())
+        self._entries.clear(); self._by_user.clear(); self._by_channel.clear()
+        return removed
+
+    # --- インデックスを使った検索・削除 ---
+    def entries_for_user(self, user_id: int) -> List[SeqEntry]:
+        """指定ユーザーが発言者または会話相手のエントリを古い順に返す"""
+        return [(seq, self._entries[seq]) for seq in self._by_user.get(user_id, ())]
+
+    def entries_for_channel(self, channel_id: Optional[int]) -> List[SeqEntry]:
+        return [(seq, self._entries[seq]) for seq in self._by_channel.get(channel_id, ())]
+
+    def count_for_user(self, user_id: int) -> int: return len(self._by_user.get(user_id, ()))
+    def count_for_channel(self, channel_id: Optional[int]) -> int: return len(self._by_channel.get(channel_id, ()))
+    def user_counts(self) -> Dict[int, int]: return {uid: len(seqs) for uid, seqs in self._by_user.items()}
+    def channel_counts(self) -> Dict[Optional[int], int]: return {cid: len(seqs) for cid, seqs in self._by_channel.items()}
+
+    def remove_user(self, user_id: int) -> List[SeqEntry]:
+        """指定ユーザーが関与するエントリを削除し、削除したものを返す"""
+        return self._remove_seqs(list(self._by_user.get(user_id, ())))
+
+    def remove_channel(self, channel_id: Optional[int]) -> List[SeqEntry]:
+        return self._remove_seqs(list(self._by_channel.get(channel_id, ())))
+
+    # --- 内部処理 ---
+    def _evict_overflow(self) -> List[SeqEntry]:
+        evicted = []
+        while len(self._entries) > self._maxlen:
+            seq, entry = self._entries.popitem(last=False)
+            self._unindex(seq, entry)
+            evicted.append((seq, entry))
+        return evicted
+
+    def _remove_seqs(self, seqs: List[int]) -> List[SeqEntry]:
+        removed = []
+        for seq in seqs:
+            entry = self._entries.pop(seq, None)
+            if entry is None: continue
+            self._unindex(seq, entry)
+            removed.append((seq, entry))
+        return removed
+
+    @staticmethod
+    def _user_keys(entry: HistoryEntry) -> Tuple[int, ...]:
+        if entry.current_interlocutor_id is None or entry.current_interlocutor_id == entry.interlocutor_id:
+            return (entry.interlocutor_id,)
+        return (entry.interlocutor_id, entry.current_interlocutor_id)
+
+    def _index(self, seq: int, entry: HistoryEntry):
+        for user_id in self._user_keys(entry): self._by_user.setdefault(user_id, {})[seq] = None
+        self._by_channel.setdefault(entry.channel_id, {})[seq] = None
+
+    def _unindex(self, seq: int, entry: HistoryEntry):
+        for user_id in self._user_keys(entry): _discard(self._by_user, user_id, seq)
+        _discard(self._by_channel, entry.channel_id, seq)
+
+
+def _discard(index: dict, key, seq: int):
+    seqs = index.get(key)
+    if seqs is None: return
+    seqs.pop(seq, None)
+    if not seqs: del index[key]
@@ -0,0 +1,107 @@
+# utils/history_models.py (会話履歴エントリのコンパクトな表現)
+
+import sys
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ROLE_USER = sys.intern("user")
+ROLE_MODEL = sys.intern("model")
+VALID_ROLES = (ROLE_USER, ROLE_MODEL)
+
+
+@dataclass(frozen=True, slots=True)
+class HistoryPart:
+    """履歴エントリの1パート (text / inline_data の MIME タイプ / function_call / function_response のいずれか)"""
+    text: Optional[str] = None
+    inline_mime_type: Optional[str] = None # inline_data はデータ本体を保存しない
+    function_call: Optional[Dict[str, Any]] = None
+    function_response: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_dict(cls, part_dict: Any) -> Optional["HistoryPart"]:
+        """保存形式の dict から生成する (認識できない場合は None)"""
+        if not isinstance(part_dict, dict): return None
+        if isinstance(part_dict.get('text'), str):
+            return cls(text=part_dict['text'])
+        if 'inline_data' in part_dict:
+            inline_data = part_dict['inline_data']
+            return cls(inline_mime_type=inline_data.get('mime_type') if isinstance(inline_data, dict) else None)
+        if isinstance(part_dict.get('function_call'), dict):
+            return cls(function_call=part_dict['function_call'])
+        if isinstance(part_dict.get('function_response'), dict):
+            return cls(function_response=part_dict['function_response'])
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """保存形式の dict に変換する"""
+        if self.text is not None: return {'text': self.text}
+        if self.function_call is not None: return {'function_call': self.function_call}
+        if self.function_response is not None: return {'function_response': self.function_response}
+        return {'inline_data': {'mime_type': self.inline_mime_type, 'data': None}}
+
+
+@dataclass(frozen=True, slots=True)
+class HistoryEntry:
+    """グローバル履歴の1エントリ。ID は int、timestamp はエポック秒 (float) で保持する"""
+    role: str
+    parts: Tuple[HistoryPart, ...]
+    interlocutor_id: int # 発言者ID
+    channel_id: Optional[int] = None
+    current_interlocutor_id: Optional[int] = None
+    timestamp: Optional[float] = None
+
+    @classmethod
+    def create(cls, role: str, parts_dict: List[Dict[str, Any]], interlocutor_id: int,
+               channel_id: Optional[int], current_interlocutor_id: Optional[int]) -> "HistoryEntry":
+        """新しいエントリを現在時刻で生成する"""
+        parts = tuple(p for p in (HistoryPart.from_dict(d) for d in parts_dict) if p is not None)
+        return cls(role=sys.intern(role), parts=parts, interlocutor_id=int(interlocutor_id),
+                   channel_id=channel_id, current_interlocutor_id=current_interlocutor_id,
+                   timestamp=datetime.datetime.now().timestamp())
+
+    @classmethod
+    def from_dict(cls, entry: Dict[str, Any]) -> "HistoryEntry":
+        """保存形式の dict から生成する (必須情報が欠けている場合は ValueError)"""
+        role = entry.get("role")
+        interlocutor_id = entry.get("interlocutor_id")
+        if role not in VALID_ROLES or interlocutor_id is None:
+            raise ValueError("missing role or interlocutor_id")
+        parts = tuple(p for p in (HistoryPart.from_dict(d) for d in entry.get("parts") or []) if p is not None)
+        channel_id = entry.get("channel_id")
+        current_interlocutor_id = entry.get("current_interlocutor_id")
+        return cls(role=sys.intern(role), parts=parts, interlocutor_id=int(interlocutor_id),
+                   channel_id=int(channel_id) if channel_id is not None else None,
+                   current_interlocutor_id=int(current_interlocutor_id) if current_interlocutor_id is not None else None,
+                   timestamp=_parse_timestamp(entry.get("timestamp")))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """保存形式の dict に変換する (timestamp は aware ローカルTZの ISO 文字列)"""
+        return {
+            "role": self.role, "parts": [p.to_dict() for p in self.parts], "channel_id": self.channel_id,
+            "interlocutor_id": self.interlocutor_id,
+            "current_interlocutor_id": self.current_interlocutor_id,
+            "timestamp": self.datetime.isoformat() if self.timestamp is not None else None,
+        }
+
+    @property
+    def datetime(self) -> Optional[datetime.datetime]:
+        """timestamp を aware ローカルTZの datetime として返す"""
+        if self.timestamp is None: return None
+        return datetime.datetime.fromtimestamp(self.timestamp).astimezone()
+
+    def involves_user(self, user_id: int) -> bool:
+        return self.interlocutor_id == user_id or self.current_interlocutor_id == user_id
+
+
+def _parse_timestamp(value: Any) -> Optional[float]:
+    """ISO 文字列 / datetime / 数値のタイムスタンプをエポック秒に変換する"""
+    if value is None: return None
+    if isinstance(value, (int, float)): return float(value)
+    if isinstance(value, str): value = datetime.datetime.fromisoformat(value)
+    if isinstance(value, datetime.datetime):
+        return value.astimezone().timestamp() # naive はローカルTZとみなす
+    raise TypeError(f"Unsupported timestamp type: {type(value)}")
@@ -0,0 +1,198 @@
+# utils/history_partitions.py (サーバー・チャンネル・DM ごとに分けた会話履歴。使われていないものはファイルに退避する)
+
+import time
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from utils import json_codec
+from utils import storage
+from utils.history_buffer import HistoryBuffer, SeqEntry
+from utils.history_models import HistoryEntry
+
+logger = logging.getLogger(__name__)
+
+SCOPE_GLOBAL = "global" # すべての会話で1つの履歴 (従来どおり)
+SCOPE_GUILD = "guild" # サーバーごと (DM はユーザーごと)
+SCOPE_CHANNEL = "channel" # チャンネルごと (DM はユーザーごと)
+SCOPE_DM = "dm" # DM だけユーザーごとに分け、サーバーのチャンネルはまとめて1つ
+HISTORY_SCOPES = (SCOPE_GLOBAL, SCOPE_GUILD, SCOPE_CHANNEL, SCOPE_DM)
+SERVERS_KEY = "servers" # SCOPE_DM でのサーバーチャンネル全体のパーティション
+
+DEFAULT_MAX_LOADED = 64 # メモリに置くパーティション数の上限 (超えたら最近使っていないものから退避する)
+DEFAULT_IDLE_SECONDS = 1800.0 # この秒数使われなかったパーティションは退避する
+DEFAULT_SAVE_EVERY = 10 # パーティションをこの回数変更するごとにファイルへ保存する
+
+
+def partition_key(scope: str, guild_id: Optional[int], channel_id: Optional[int], user_id: Optional[int]) -> str:
+    """会話の場所からパーティションのキー (ファイル名にも使う) を決める。channel_id が None なら DM"""
+    if channel_id is None: return f"dm-{user_id}"
+    if scope == SCOPE_GUILD and guild_id is not None: return f"guild-{guild_id}"
+    if scope in (SCOPE_GUILD, SCOPE_CHANNEL): return f"channel-{channel_id}" # サーバーが分からない場合もチャンネルで分ける
+    return SERVERS_KEY
+
+def backfill_predicate(key: str) -> Optional[Callable[[HistoryEntry], bool]]:
+    """初めて使うパーティションをグローバル履歴から埋めるときの条件 (サーバーはエントリから分からないので埋めない)"""
+    kind, _, value = key.partition("-")
+    if kind == "channel": return lambda entry: entry.channel_id == int(value)
+    if kind == "dm": return lambda entry: entry.channel_id is None and entry.involves_user(int(value))
+    if key == SERVERS_KEY: return lambda entry: entry.channel_id is not None
+    return None
+
+
+class HistoryPartitions:
+    """パーティションごとの HistoryBuffer を LRU で持つ
+
+    メモリに置くのは最近使った max_loaded 個までで、それを超えたものや idle_seconds 使われなかったものは
+    take_evictions() で取り出し、呼び出し側 (config_manager) が I/O ワーカーでファイルに書き出す。
+    ファイルの読み書き (load_file・save_file など) は I/O ワーカーから呼ぶ。
+    """
+
+    def __init__(self, directory: Path, maxlen: int, max_loaded: int = DEFAULT_MAX_LOADED,
+                 idle_seconds: float = DEFAULT_IDLE_SECONDS, save_every: int = DEFAULT_SAVE_EVERY):
+        self.directory = directory
+        self.maxlen = maxlen
+        self.max_loaded = max(max_loaded, 1)
+        self.idle_seconds = idle_seconds
+        self.save_every = max(save_every, 1)
+        self._loaded: "OrderedDict[str, HistoryBuffer]" = OrderedDict() # 末尾が最近使ったもの
+        self._last_used: Dict[str, float] = {}
+        self._dirty: Dict[str, int] = {} # 保存していない変更の回数
+        self._snapshots: Dict[str, Tuple[HistoryEntry, ...]] = {}
+        self.generation = 0 # メモリにないパーティションのファイルを書き換えるたびに増える (ロック外で読んだ内容が古くないかの確認用)
+        self.loads = 0
+        self.backfills = 0
+        self.evictions = 0
+
+    def configure(self, maxlen: int, max_loaded: int, idle_seconds: float):
+        self.max_loaded = max(max_loaded, 1)
+        self.idle_seconds = idle_seconds
+        self.resize(maxlen)
+
+    # --- メモリ上の操作 (履歴ロック内で呼ぶ) ---
+    def get(self, key: str) -> Optional[HistoryBuffer]:
+        buffer = self._loaded.get(key)
+        if buffer is not None: self._touch(key)
+        return buffer
+
+    def install(self, key: str, records: List[SeqEntry], backfilled: bool = False) -> HistoryBuffer:
+        """ファイルから読んだ (またはグローバル履歴から埋めた) エントリでパーティションを置く"""
+        buffer = HistoryBuffer(self.maxlen, sorted(records, key=lambda record: record[0]))
+        self._loaded[key] = buffer
+        self._snapshots.pop(key, None)
+        self._touch(key)
+        if backfilled:
+            self.backfills += 1
+            if buffer: self._dirty[key] = self.save_every # 次の保存の機会にファイルを作る
+        else: self.loads += 1
+        return buffer
+
+    def append(self, key: str, seq: int, entry: HistoryEntry) -> bool:
+        """エントリを追加する (install 済みであること)。保存すべき回数に達したら True"""
+        self._loaded[key].append(seq, entry) # 押し出されたものはグローバル履歴側でアーカイブされるので捨てる
+        return self._mark_dirty(key)
+
+    def snapshot(self, key: str) -> Tuple[HistoryEntry, ...]:
+        """パーティションの不変スナップショット (変更されるまで同じタプル)"""
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            buffer = self._loaded.get(key)
+            snapshot = self._snapshots[key] = tuple(buffer) if buffer is not None else ()
+        return snapshot
+
+    def resize(self, maxlen: int):
+        self.maxlen = max(maxlen, 0)
+        for key, buffer in self._loaded.items():
+            if buffer.resize(self.maxlen): self._mark_dirty(key, force=True)
+
+    def remove_user(self, user_id: int):
+        """メモリ上のパーティションからユーザーが関与するエントリを消す (ファイル側は rewrite_files で消す)"""
+        self.generation += 1
+        for key, buffer in self._loaded.items():
+            if buffer.remove_user(user_id): self._mark_dirty(key, force=True)
+
+    def remove_channel(self, channel_id: int):
+        self.generation += 1
+        for key, buffer in self._loaded.items():
+            if buffer.remove_channel(channel_id): self._mark_dirty(key, force=True)
+
+    def loaded_keys(self) -> Set[str]: return set(self._loaded)
+
+    def clear(self):
+        self._loaded.clear(); self._last_used.clear(); self._dirty.clear(); self._snapshots.clear()
+        self.generation += 1
+
+    def records(self, key: str) -> List[SeqEntry]:
+        """保存用に (seq, エントリ) を古い順に返し、未保存の変更をなかったことにする"""
+        self._dirty.pop(key, None)
+        buffer = self._loaded.get(key)
+        return list(buffer.items()) if buffer is not None else []
+
+    def dirty_keys(self) -> List[str]: return list(self._dirty)
+
+    def take_evictions(self) -> List[Tuple[str, Optional[List[SeqEntry]]]]:
+        """上限を超えた分と使われていない分をメモリから外し、(キー, 保存すべき記録 or None) を返す"""
+        now = time.monotonic()
+        evicted = []
+        while self._loaded:
+            key = next(iter(self._loaded))
+            if len(self._loaded) <= self.max_loaded and now - self._last_used[key] < self.idle_seconds: break
+            records = self.records(key) if key in self._dirty else None
+            del self._loaded[key]
+            self._last_used.pop(key, None); self._snapshots.pop(key, None)
+            self.evictions += 1; self.generation += 1
+            evicted.append((key, records))
+        return evicted
+
+    def _touch(self, key: str):
+        self._loaded.move_to_end(key)
+        self._last_used[key] = time.monotonic()
+
+    def _mark_dirty(self, key: str, force: bool = False) -> bool:
+        self._snapshots.pop(key, None)
+        count = self._dirty.get(key, 0) + 1
+        self._dirty[key] = count
+        return force or count >= self.save_every
+
+    # --- ファイル (I/O ワーカーから呼ぶ) ---
+    def path(self, key: str) -> Path: return self.directory / f"{key}.json"
+
+    def load_file(self, key: str) -> Optional[List[SeqEntry]]:
+        """パーティションのファイルを読む (ファイルがなければ None)"""
+        path = self.path(key)
+        if not path.exists(): return None
+        try:
+            with open(path, 'rb') as f: data = json_codec.loads(f.read())
+        except (OSError, json_codec.DecodeError, UnicodeDecodeError) as e:
+            logger.error(f"Failed to read history partition {path}. Starting it empty.", exc_info=e)
+            storage.quarantine_file(path)
+            return []
+        records = []
+        for record in data.get("entries", []):
+            try: records.append((int(record[0]), HistoryEntry.from_dict(record[1])))
+            except (TypeError, ValueError, IndexError, KeyError) as e: logger.warning(f"Skipping invalid entry in history partition {key}: {e}")
+        return records
+
+    def save_file(self, key: str, records: List[SeqEntry]):
+        storage.save_json(self.path(key), {"entries": [[seq, entry.to_dict()] for seq, entry in records]}, compact=True)
+
+    def rewrite_files(self, keep: Callable[[HistoryEntry], bool], skip_keys: Set[str]):
+        """メモリにないパーティションのファイルから keep が False のエントリを消す (ユーザー・チャンネルの履歴削除用)"""
+        if not self.directory.exists(): return
+        for path in self.directory.glob("*.json"):
+            key = path.stem
+            if key in skip_keys: continue
+            records = self.load_file(key) or []
+            kept = [(seq, entry) for seq, entry in records if keep(entry)]
+            if len(kept) != len(records): self.save_file(key, kept)
+
+    def delete_files(self):
+        if not self.directory.exists(): return
+        for path in self.directory.glob("*.json"):
+            try: path.unlink()
+            except OSError as e: logger.error(f"Failed to delete history partition {path}", exc_info=e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"loaded": len(self._loaded), "max_loaded": self.max_loaded, "dirty": len(self._dirty),
+                "loads": self.loads, "backfills": self.backfills, "evictions": self.evictions}
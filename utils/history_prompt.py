@@ -0,0 +1,190 @@
+# utils/history_prompt.py (グローバル履歴を API リクエスト用の Content に整形し、エントリごとに覚えておく)
+
+import logging
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from google.genai import types as genai_types
+
+from utils.history_models import VALID_ROLES, HistoryEntry
+from utils.token_estimator import estimate_content_tokens
+
+logger = logging.getLogger(__name__)
+
+OMITTED_ENTRY_TEXT = "(長い発言のため省略しました)" # 1件だけで予算を超えるエントリの代わりに送る本文
+
+
+class FormattedEntry:
+    """整形済みの履歴エントリ (トークン数は見積もり。exact なら count_tokens で数えた値)"""
+    __slots__ = ("entry", "speaker_name", "content", "tokens", "exact", "_placeholder")
+
+    def __init__(self, entry: HistoryEntry, speaker_name: str, content: Optional[genai_types.Content]):
+        self.entry = entry
+        self.speaker_name = speaker_name # 整形に使った発言者名 (無効なエントリは空)
+        self.content = content # 有効なパートがなければ None
+        self.tokens = estimate_content_tokens(content) if content is not None else 0
+        self.exact = False
+        self._placeholder: Optional[Tuple[genai_types.Content, int]] = None
+
+    def placeholder(self) -> Tuple[genai_types.Content, int]:
+        """予算に収まらないときに代わりに送る短い Content とそのトークン数 (発言の順番を保つため)"""
+        if self._placeholder is None:
+            content = genai_types.Content(role=self.entry.role, parts=[genai_types.Part(text=f"[{self.speaker_name}]: {OMITTED_ENTRY_TEXT}")])
+            self._placeholder = (content, estimate_content_tokens(content))
+        return self._placeholder
+
+    def real_tokens(self, scale: float) -> float:
+        """補正係数 scale を掛けた見積もり (正確な値が分かっていればその値)"""
+        return self.tokens if self.exact else self.tokens * scale
+
+
+def format_entry(entry: HistoryEntry, speaker_name: str) -> Optional[genai_types.Content]:
+    """1エントリを Content にする (最初のテキストパートに発言者プレフィックスを付ける。有効なパートがなければ None)"""
+    context_prefix = f"[{speaker_name}]: "
+    first_part = True
+    processed_parts = []
+    for part in entry.parts:
+        if part.text is not None:
+            text_content = part.text.strip()
+            if not text_content: continue
+            # 最初のテキストパートにのみプレフィックスを追加
+            processed_parts.append(genai_types.Part(text=context_prefix + text_content if first_part else text_content))
+            first_part = False
+        elif part.function_call is not None:
+            fc_data = part.function_call
+            if 'name' in fc_data and 'args' in fc_data:
+                processed_parts.append(genai_types.Part(function_call=genai_types.FunctionCall(name=fc_data.get('name'), args=fc_data.get('args'))))
+            else: logger.warning(f"Skipping invalid function_call in history: {part}")
+            first_part = False # 関数呼び出しがあれば、後続のテキストにはプレフィックス不要
+        elif part.function_response is not None:
+            fr_data = part.function_response
+            if 'name' in fr_data and 'response' in fr_data:
+                processed_parts.append(genai_types.Part(function_response=genai_types.FunctionResponse(name=fr_data.get('name'), response=fr_data.get('response'))))
+            else: logger.warning(f"Skipping invalid function_response in history: {part}")
+            first_part = False
+        else:
+            # inline_data (Blobの復元は複雑なためスキップ, データ本体は保存していない)
+            logger.warning("Skipping inline_data restoration in history formatting.")
+    if not processed_parts:
+        logger.warning(f"No valid parts constructed for history entry: {entry}")
+        return None
+    return genai_types.Content(role=entry.role, parts=processed_parts)
+
+
+class HistoryPromptFormatter:
+    """履歴のスナップショットと整形済みの Content を並べて覚えておき、差分だけを整形する
+
+    履歴は末尾への追加と先頭からの押し出しで変わるのがほとんどなので、前回の並びから押し出された分を
+    先頭から捨て、増えた分だけを整形する (O(新しいエントリ数))。途中のエントリが削除された場合は
+    エントリの同一性 (id) で前回の結果を引き直す。発言者名の版 (names_version) が変わったときは
+    名前を引き直し、名前が変わったエントリだけを作り直す。
+    トークン数はエントリごとに整形時に見積もっておき、予算を渡すと新しいものから予算内に収まる分だけを返す。
+    """
+
+    def __init__(self, resolve_speaker_name: Callable[[HistoryEntry, str], str]):
+        self._resolve_speaker_name = resolve_speaker_name # (エントリ, Bot名) → 発言者名
+        self._formatted: Deque[FormattedEntry] = deque() # 前回のスナップショットと同じ順・同じ件数
+        self._names_key: Optional[Tuple[Any, str]] = None # (発言者名の版, Bot名)
+        self._snapshot: Optional[Sequence[HistoryEntry]] = None
+        self._result: List[genai_types.Content] = []
+        self._token_sums: Optional[Tuple[int, int]] = None
+        self.formatted_count = 0 # Content を作った回数 (統計用)
+        self.last_window: Tuple[int, int, int] = (0, 0, 0) # 直近の format() で (返した件数, 有効なエントリ数, 返した分のトークン数)
+
+    def format(self, snapshot: Sequence[HistoryEntry], names_version: Any, bot_name: str,
+               token_budget: Optional[int] = None, scale: float = 1.0) -> List[genai_types.Content]:
+        """スナップショット (古い順) を整形した Content のリストを返す (呼び出し側で変更してよい新しいリスト)
+
+        token_budget を渡すと、新しいエントリから順に予算 (見積もりに scale を掛けたトークン数) に収まるまで詰め、
+        収まらないエントリに当たったらそこで止める。ただし1件だけで予算を超えるエントリ (PDF の全文など) は
+        省略した旨の短い Content に置き換えて詰め続ける (ユーザーの発言と応答の組が崩れないようにする)。
+        """
+        names_key = (names_version, bot_name)
+        if snapshot is not self._snapshot or names_key != self._names_key:
+            if names_key != self._names_key:
+                self._refresh_names(bot_name)
+                self._names_key = names_key
+            self._sync(snapshot, bot_name)
+            self._snapshot = snapshot
+            self._result = [item.content for item in self._formatted if item.content is not None]
+            self._token_sums = None
+        if token_budget is None or token_budget <= 0:
+            if self._token_sums is None: # (正確な値の合計, 見積もりの合計)。変わったときだけ数え直す
+                self._token_sums = (sum(item.tokens for item in self._formatted if item.exact),
+                                    sum(item.tokens for item in self._formatted if not item.exact))
+            self.last_window = (len(self._result), len(self._result), int(self._token_sums[0] + self._token_sums[1] * scale))
+            return list(self._result)
+        return self._select_window(token_budget, scale)
+
+    def set_exact_tokens(self, item: FormattedEntry, tokens: int):
+        """count_tokens で数えた正確なトークン数を記録する"""
+        item.tokens = tokens
+        item.exact = True
+        self._token_sums = None
+
+    def pending_exact(self, limit: int) -> List[FormattedEntry]:
+        """正確なトークン数をまだ数えていないエントリを新しい順に最大 limit 件返す"""
+        pending = []
+        for item in reversed(self._formatted):
+            if len(pending) >= limit: break
+            if item.content is not None and not item.exact: pending.append(item)
+        return pending
+
+    def clear(self):
+        self._formatted.clear()
+        self._names_key = self._snapshot = self._token_sums = None
+        self._result = []
+
+    # --- 内部処理 ---
+    def _select_window(self, token_budget: int, scale: float) -> List[genai_types.Content]:
+        selected: List[genai_types.Content] = []
+        used = 0.0
+        for item in reversed(self._formatted): # 新しい順 (選ぶ件数に比例するコスト)
+            if item.content is None: continue
+            content, tokens = item.content, item.real_tokens(scale)
+            if tokens > token_budget: # 1件だけで予算を超えるものは本文の代わりに省略の旨を送る
+                content, placeholder_tokens = item.placeholder()
+                tokens = placeholder_tokens * scale
+            if used + tokens > token_budget: break
+            selected.append(content)
+            used += tokens
+        selected.reverse()
+        self.last_window = (len(selected), len(self._result), int(used))
+        return selected
+
+    def _build(self, entry: HistoryEntry, bot_name: str) -> FormattedEntry:
+        if not entry.parts or entry.role not in VALID_ROLES:
+            logger.warning(f"Skip invalid global history entry (missing essential info): {entry}")
+            return FormattedEntry(entry, "", None)
+        speaker_name = self._resolve_speaker_name(entry, bot_name)
+        try: content = format_entry(entry, speaker_name)
+        except Exception as e:
+            logger.error(f"Error converting global history entry: {entry}", exc_info=e)
+            content = None
+        self.formatted_count += 1
+        return FormattedEntry(entry, speaker_name, content)
+
+    def _refresh_names(self, bot_name: str):
+        """発言者名を引き直し、変わったエントリだけを作り直す"""
+        refreshed: Deque[FormattedEntry] = deque()
+        for item in self._formatted:
+            if item.speaker_name and self._resolve_speaker_name(item.entry, bot_name) != item.speaker_name: item = self._build(item.entry, bot_name)
+            refreshed.append(item)
+        self._formatted = refreshed
+
+    def _sync(self, snapshot: Sequence[HistoryEntry], bot_name: str):
+        formatted = self._formatted
+        if snapshot:
+            head = snapshot[0]
+            while formatted and formatted[0].entry is not head: formatted.popleft() # 押し出された分
+        else: formatted.clear()
+        kept = len(formatted)
+        if kept > len(snapshot) or (kept and formatted[-1].entry is not snapshot[kept - 1]):
+            # 途中のエントリが削除された: 同じエントリの結果を使い回して並べ直す
+            previous: Dict[int, FormattedEntry] = {id(item.entry): item for item in formatted}
+            formatted.clear()
+            for entry in snapshot:
+                item = previous.get(id(entry))
+                formatted.append(item if item is not None and item.entry is entry else self._build(entry, bot_name))
+            return
+        for entry in snapshot[kept:]: formatted.append(self._build(entry, bot_name)) # 追加された分
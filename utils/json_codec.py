@@ -0,0 +1,93 @@
+# utils/json_codec.py (JSONのエンコード/デコード。orjson があれば使い、なければ標準の json にフォールバック)
+
+import json
+import logging
+import datetime
+from collections import deque
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError: # orjson は任意の依存
+    orjson = None
+
+# orjson.JSONDecodeError は json.JSONDecodeError のサブクラスなので、こちらで両方捕捉できる
+DecodeError = json.JSONDecodeError
+
+
+def _default(obj: Any) -> Any:
+    """標準でシリアライズできないオブジェクトの変換 (呼ばれた時点でシリアライズ不可と確定している)"""
+    if isinstance(obj, datetime.datetime):
+        # aware datetimeをisoformatに変換（TZ情報が含まれる）
+        return obj.isoformat()
+    if isinstance(obj, (deque, set, frozenset, tuple)): return list(obj)
+    logger.warning(f"Object type {type(obj)} not JSON serializable, converting to str.")
+    return str(obj)
+
+
+class StdlibJsonCodec:
+    """標準ライブラリの json による実装"""
+    name = "json"
+
+    def dumps(self, obj: Any, compact: bool = False) -> bytes:
+        if compact:
+            text = json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default)
+        else:
+            text = json.dumps(obj, indent=4, ensure_ascii=False, default=_default)
+        return text.encode('utf-8')
+
+    def loads(self, data: Any) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """orjson による実装 (datetime はネイティブに isoformat と同じ形式で出力される)"""
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None: raise RuntimeError("orjson is not installed")
+        self._compact_option = orjson.OPT_NON_STR_KEYS
+        self._pretty_option = orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2 # orjson のインデント幅は2固定
+
+    def dumps(self, obj: Any, compact: bool = False) -> bytes:
+        return orjson.dumps(obj, default=_default, option=self._compact_option if compact else self._pretty_option)
+
+    def loads(self, data: Any) -> Any:
+        return orjson.loads(data)
+
+
+def available_codecs() -> Dict[str, Any]:
+    """利用可能なコーデックを名前をキーにして返す (ベンチマーク用)"""
+    codecs = {StdlibJsonCodec.name: StdlibJsonCodec()}
+    if orjson is not None: codecs[OrjsonCodec.name] = OrjsonCodec()
+    return codecs
+
+def get_codec(name: Optional[str] = None):
+    """名前を指定してコーデックを取得する (None なら利用可能な中で最速のもの)"""
+    codecs = available_codecs()
+    if name is None: return codecs.get(OrjsonCodec.name) or codecs[StdlibJsonCodec.name]
+    if name not in codecs:
+        logger.warning(f"JSON codec '{name}' is not available. Falling back to '{StdlibJsonCodec.name}'.")
+        return codecs[StdlibJsonCodec.name]
+    return codecs[name]
+
+_codec = get_codec()
+logger.debug(f"Using JSON codec: {_codec.name}")
+
+
+def dumps(obj: Any, compact: bool = False) -> bytes:
+    """UTF-8 の JSON バイト列にエンコードする (compact=False ならインデント付き)"""
+    return _codec.dumps(obj, compact)
+
+def dumps_str(obj: Any) -> str:
+    """コンパクトな JSON 文字列にエンコードする (SQLite の列やジャーナルの1行用)"""
+    return _codec.dumps(obj, True).decode('utf-8')
+
+def loads(data: Any) -> Any:
+    """JSON (bytes / str) をデコードする"""
+    return _codec.loads(data)
+
+def codec_name() -> str:
+    return _codec.name
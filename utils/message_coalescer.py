@@ -0,0 +1,60 @@
+# utils/message_coalescer.py (短時間に続けて送られたメッセージを1回の応答にまとめる)
+
+import asyncio
+import logging
+from typing import Dict, Hashable, List, Optional
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingBatch:
+    __slots__ = ("messages", "started_at", "deadline")
+
+    def __init__(self, message: discord.Message, now: float, window: float):
+        self.messages: List[discord.Message] = [message]
+        self.started_at = now
+        self.deadline = now + window
+
+
+class MessageCoalescer:
+    """キー ((ユーザー, チャンネル) など) ごとにメッセージをまとめる
+
+    最初のメッセージを受け取った呼び出しが window 秒待ち、その間に届いた同じキーのメッセージを
+    まとめて返す。後から届いたメッセージの呼び出しは None を返す (応答は最初の呼び出しが行う)。
+    新しいメッセージや入力中 (typing) の通知があると待ち時間が延び、最初のメッセージから
+    max_wait 秒経ったら打ち切る。
+    """
+
+    def __init__(self, window: float, typing_window: float, max_wait: float):
+        self.window = window
+        self.typing_window = typing_window
+        self.max_wait = max_wait
+        self._pending: Dict[Hashable, _PendingBatch] = {}
+
+    async def submit(self, key: Hashable, message: discord.Message) -> Optional[List[discord.Message]]:
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is not None:
+            batch.messages.append(message)
+            batch.deadline = max(batch.deadline, loop.time() + self.window)
+            return None
+        batch = _PendingBatch(message, loop.time(), self.window)
+        self._pending[key] = batch
+        try:
+            while True:
+                remaining = min(batch.deadline, batch.started_at + self.max_wait) - loop.time()
+                if remaining <= 0: break
+                await asyncio.sleep(remaining)
+        finally:
+            if self._pending.get(key) is batch: del self._pending[key]
+        if len(batch.messages) > 1:
+            logger.info(f"Coalesced {len(batch.messages)} messages for {key} after {(loop.time() - batch.started_at) * 1000:.0f} ms")
+        return batch.messages
+
+    def touch(self, key: Hashable):
+        """入力中の通知を受けたとき、待ち中のまとめがあれば待ち時間を延ばす"""
+        batch = self._pending.get(key)
+        if batch is None: return
+        batch.deadline = max(batch.deadline, asyncio.get_running_loop().time() + self.typing_window)
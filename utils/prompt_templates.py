@@ -0,0 +1,160 @@
+# utils/prompt_templates.py (システムプロンプトのテンプレート。固定部分は設定の版ごとに1回だけ組み立てる)
+
+import string
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+from google.genai import types as genai_types
+
+from utils import config_manager
+
+logger = logging.getLogger(__name__)
+
+KIND_CHAT = "chat" # 会話への応答
+KIND_RANDOM_DM = "random_dm" # ランダムDM
+RENDER_CACHE_SIZE = 128 # 同じ項目の値で組み立てた Content を覚えておく数 (テンプレートごと)
+
+# 指示のテンプレート (ペルソナの後ろに続ける)。{項目名} はリクエストごとに埋める。
+# サーバーごとに prompts/guilds/<サーバーID>/chat_instructions.txt で差し替えられる (使える項目は TEMPLATE_FIELDS)
+CHAT_INSTRUCTIONS = (
+    "\n\n--- ★★★ 現在の最重要情報 ★★★ ---"
+    "\nあなたは今、以下の Discord ユーザーと **直接** 会話しています。このユーザーに集中してください。"
+    "\n- ユーザー名: {display_name} (Discord 表示名)"
+    "\n- ユーザーID: {user_id}"
+    "\n- ★★ あなたが呼びかけるべき名前: 「{call_name}」 ★★"
+    "\n   (注: これは設定されたニックネーム、またはユーザー表示名です。)"
+    "\n- 会話の場所: {location}"
+    "\n---------------------------------"
+    "{mood_section}"
+    "\n\n--- ★★★ 応答生成時の最重要指示 ★★★ ---"
+    "\n1. **最優先事項:** 会話の相手は常に上記の「ユーザーID: {user_id}」を持つ人物です。応答する際は、**必ず、絶対に「{call_name}」という名前で呼びかけてください。** "
+    "\n2. **厳禁:** 過去の会話履歴には、他のユーザーとの会話や、あなた自身の過去の発言が含まれています。履歴を参照することは許可しますが、**現在の対話相手である「{call_name}」さんを、それ以外の会話相手の名前で絶対に呼ばないでください。** 過去の文脈に引きずられず、**現在の「{call_name}」さんとの対話にのみ集中してください。**"
+    "\n3. 履歴内の各発言には `[発言者名]:` というプレフィックスが付いています。これを注意深く確認し、現在の対話相手「{call_name}」さんとの文脈に関係のある情報か慎重に判断してください。"
+    "\n4. **厳禁:** あなたの応答の **いかなる部分にも** `[{bot_name}]:` や `[{call_name}]:` のような角括弧で囲まれた発言者名を含めてはいけません。あなたの応答は、会話本文のみで構成してください。"
+    "\n4. **応答を生成する前に、本当にあなたが今誰と会話しているのかを整理してください。**"
+    "\n5. {citation_rule}"
+    "\n----------------------------------------\n"
+)
+RANDOM_DM_INSTRUCTIONS = (
+    "\n\n--- ★★★ 現在の最重要情報 ★★★ ---"
+    "\nあなたはこれから、以下の Discord ユーザーに**あなたから**ダイレクトメッセージ（DM）を送ります。これは新しい会話の始まり、または久しぶりの声かけです。"
+    "\n- ユーザー名: {display_name} (Discord 表示名)"
+    "\n- ユーザーID: {user_id}"
+    "\n- ★★ あなたが呼びかけるべき名前: 「{call_name}」 ★★"
+    "\n   (注: これは設定されたニックネーム、またはユーザー表示名です。)"
+    "\n- 会話の場所: ダイレクトメッセージ (DM)"
+    "\n---------------------------------"
+    "\n\n--- ★★★ 応答生成時の最重要指示 ★★★ ---"
+    "\n1. **最優先事項:** これはあなたからの最初のDM、または久しぶりの声かけです。応答する際は、**必ず、絶対に「{call_name}」という名前で呼びかけてください。** 他の呼び方は**禁止**します。"
+    "\n2. **厳禁:** 過去の会話履歴には、他のユーザーとの会話や、現在の相手と他のユーザーとの会話、サーバーチャンネルでの会話が含まれている可能性があります。これらの履歴は参考程度に留め、**今回のDMの内容は、現在の相手「{call_name}」さんとの新しい会話として自然なものにしてください。** 過去の他の会話に引きずられないように注意してください。"
+    "\n3. **今回のあなたの発言指示:** 「{dm_prompt}」に基づき、フレンドリーで自然な最初のメッセージを作成してください。相手が返信しやすいような、オープンな質問を含めると良いでしょう。"
+    "\n4. **厳禁:** あなたの応答の **いかなる部分にも** `[{bot_name}]:` や `[{call_name}]:` のような角括弧で囲まれた発言者名を含めてはいけません。あなたの応答は、会話本文のみで構成してください。"
+    "\n5. 引用符 `[]` は使用禁止です。"
+    "\n----------------------------------------\n"
+)
+DEFAULT_INSTRUCTIONS = {KIND_CHAT: CHAT_INSTRUCTIONS, KIND_RANDOM_DM: RANDOM_DM_INSTRUCTIONS}
+TEMPLATE_FIELDS: Dict[str, FrozenSet[str]] = {
+    KIND_CHAT: frozenset({"display_name", "user_id", "call_name", "location", "mood_section", "bot_name", "citation_rule"}),
+    KIND_RANDOM_DM: frozenset({"display_name", "user_id", "call_name", "dm_prompt", "bot_name"}),
+}
+PERSONAL_FIELDS = frozenset({"display_name", "user_id", "call_name", "location"}) # 相手・場所ごとに変わる項目 (応答キャッシュのキーに含めない)
+INSTRUCTION_FILES = {KIND_CHAT: "chat_instructions.txt", KIND_RANDOM_DM: "random_dm_instructions.txt"} # サーバーごとの差し替えファイル名
+
+# 会話テンプレートの項目に入れる文
+LOCATION_CHANNEL = "サーバーチャンネル「{channel_name}」(ID: {channel_id})"
+LOCATION_DM = "ダイレクトメッセージ (DM)"
+MOOD_SECTION_WITH_WEATHER = "\n\n--- あなたの現在の状態 ---\nあなたは「{mood}」な気分です。これは {location} の天気 ({description}) に基づいています。応答には、この気分を自然に反映させてください。"
+MOOD_SECTION = "\n\n--- あなたの現在の状態 ---\nあなたは「{mood}」な気分です。応答には、この気分を自然に反映させてください。"
+CITATION_RULE = "ウェブ検索結果などを参照する場合は、その内容を**必ず自分の言葉で要約・説明**してください。検索結果のテキストをそのまま長文でコピー＆ペーストする行為や、引用符 `[]` を使用することは禁止します。"
+CITATION_RULE_AFTER_RECITATION = "**重要:** 前回の応答はウェブ検索結果等の引用が多すぎたため停止しました。**今回は検索結果をそのまま引用せず、必ず自分の言葉で要約・説明するようにしてください。** 引用符 `[]` も使わないでください。"
+
+
+class PromptTemplate:
+    """コンパイル済みのシステムプロンプト (ペルソナ + 指示のテンプレート)
+
+    ペルソナはそのまま (波括弧も含めて) 固定部分として扱い、指示は固定の文字列と項目の並びに
+    分解しておく (毎回書式を解析する str.format より速い)。リクエストごとには項目を埋めて連結するだけで、
+    同じ値の組み合わせなら前回作った Content をそのまま返す。
+    """
+
+    def __init__(self, persona: str, instructions: str, fields: FrozenSet[str]):
+        self.persona = persona
+        self.persona_content = genai_types.Content(parts=[genai_types.Part(text=persona)], role="system") # 固定部分 (コンテキストキャッシュ用)
+        self.fields = fields
+        self.fingerprint = hashlib.sha256(f"{persona}\0{instructions}".encode('utf-8')).hexdigest() # テンプレートの中身 (サーバーごとの差し替えを区別する)
+        self._segments = self._compile(instructions, fields)
+        self._rendered: "OrderedDict[Tuple[Tuple[str, Any], ...], genai_types.Content]" = OrderedDict()
+
+    @staticmethod
+    def _compile(instructions: str, fields: FrozenSet[str]) -> Tuple[Tuple[str, Optional[str]], ...]:
+        """(固定の文字列, 項目名 or None) の並びにする。知らない項目は文字列のまま残す"""
+        try: parsed = list(string.Formatter().parse(instructions))
+        except ValueError as e:
+            logger.error(f"Invalid prompt template. Using it as plain text: {e}")
+            return ((instructions, None),)
+        segments = []
+        for literal, field, format_spec, conversion in parsed:
+            if field is not None and field not in fields:
+                logger.warning(f"Unknown field {{{field}}} in prompt template. Leaving it as text.")
+                literal, field = literal + "{" + field + "}", None
+            if segments and segments[-1][1] is None: segments[-1] = (segments[-1][0] + literal, field) # 続く固定部分は連結しておく
+            else: segments.append((literal, field))
+        return tuple(segments)
+
+    def render_instructions(self, **values: Any) -> str:
+        """指示の部分だけを埋めて返す (ペルソナは含まない。渡されなかった項目は空文字)"""
+        out = []
+        for literal, field in self._segments:
+            out.append(literal)
+            if field is not None: out.append(str(values.get(field, "")))
+        return "".join(out)
+
+    def shared_values(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        """相手・場所によらない項目の値だけを返す (応答キャッシュのキー用)"""
+        return {field: value for field, value in values.items() if field not in PERSONAL_FIELDS}
+
+    def system_instruction(self, **values: Any) -> genai_types.Content:
+        """ペルソナ + 指示のシステムインストラクションを返す (同じ値なら同じ Content を使い回す)"""
+        key = tuple(values.items())
+        content = self._rendered.get(key)
+        if content is not None:
+            self._rendered.move_to_end(key)
+            return content
+        content = genai_types.Content(parts=[genai_types.Part(text=self.persona + self.render_instructions(**values))], role="system")
+        self._rendered[key] = content
+        if len(self._rendered) > RENDER_CACHE_SIZE: self._rendered.popitem(last=False)
+        return content
+
+
+_templates: Dict[Tuple[str, Optional[str]], Tuple[int, PromptTemplate]] = {} # (種類, サーバーID) → (プロンプトの版, テンプレート)
+
+def get_template(kind: str, guild_id: Optional[int] = None) -> PromptTemplate:
+    """種類とサーバーに対応するテンプレートを返す (プロンプトの版が変わるまで同じものを使う)
+
+    サーバーごとの prompts/guilds/<サーバーID>/ に persona_prompt.txt や指示のファイルがあれば、そちらを使う。
+    """
+    guild_key = str(guild_id) if guild_id else None
+    version = config_manager.get_version("prompts")
+    cached = _templates.get((kind, guild_key))
+    if cached is not None and cached[0] == version: return cached[1]
+    persona = config_manager.get_guild_prompt_override(guild_key, "persona_prompt.txt") if guild_key else None
+    instructions = config_manager.get_guild_prompt_override(guild_key, INSTRUCTION_FILES[kind]) if guild_key else None
+    template = PromptTemplate(persona if persona is not None else config_manager.get_persona_prompt(),
+                              instructions if instructions is not None else DEFAULT_INSTRUCTIONS[kind], TEMPLATE_FIELDS[kind])
+    _templates[(kind, guild_key)] = (version, template)
+    logger.debug(f"Compiled {kind} prompt template (guild: {guild_key}, version: {version})")
+    return template
+
+def chat_location(channel_name: Optional[str], channel_id: Optional[int]) -> str:
+    return LOCATION_CHANNEL.format(channel_name=channel_name, channel_id=channel_id) if channel_id else LOCATION_DM
+
+def mood_section(mood: Optional[str], location: Optional[str] = None, description: Optional[str] = None) -> str:
+    """気分の節 (mood が None なら空)"""
+    if mood is None: return ""
+    if location and description: return MOOD_SECTION_WITH_WEATHER.format(mood=mood, location=location, description=description)
+    return MOOD_SECTION.format(mood=mood)
+
+def citation_rule(after_recitation: bool = False) -> str:
+    return CITATION_RULE_AFTER_RECITATION if after_recitation else CITATION_RULE
@@ -0,0 +1,165 @@
+# utils/rate_limiter.py (Gemini API のクォータ (RPM/TPM) に合わせた送信ペース制御と再試行の管理)
+
+import re
+import time
+import random
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RPM_LIMIT = 15 # 1分あたりのリクエスト数の上限 (0 で無制限)
+DEFAULT_TPM_LIMIT = 1_000_000 # 1分あたりのトークン数の上限 (0 で無制限)
+MIN_SCALE = 0.1 # 429 を受けて下げる送信レートの下限 (設定値に対する割合)
+DECREASE_FACTOR = 0.7 # 429 を受けたときに送信レートに掛ける係数
+INCREASE_STEP = 0.05 # 成功するたびに戻す送信レートの割合
+BACKOFF_BASE = 1.0 # 再試行の待ち時間の基準 (秒)
+BACKOFF_CAP = 30.0 # 再試行の待ち時間の上限 (秒)
+
+_RETRY_DELAY_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)s$') # google.rpc.RetryInfo の retryDelay ("12s" など)
+
+
+class AdaptiveRateLimiter:
+    """RPM と TPM の2つのトークンバケットで送信ペースを制御する
+
+    acquire() はバケットに空きができるまで待つ (失敗させない)。429 を受けると送信レートを下げ、
+    再試行の目安 (retry-after) があればその間すべての送信を止める。成功が続くと設定値まで徐々に戻す。
+    """
+
+    def __init__(self, rpm_limit: int = DEFAULT_RPM_LIMIT, tpm_limit: int = DEFAULT_TPM_LIMIT):
+        self.scale = 1.0
+        self._blocked_until = 0.0
+        self._updated = time.monotonic()
+        self.configure(rpm_limit, tpm_limit)
+        self.reset_stats()
+
+    def configure(self, rpm_limit: int, tpm_limit: int):
+        self.rpm_limit = max(rpm_limit or 0, 0)
+        self.tpm_limit = max(tpm_limit or 0, 0)
+        self._requests = float(self.rpm_limit) # バケットの残り (最初は満杯)
+        self._tokens = float(self.tpm_limit)
+
+    def reset_stats(self):
+        self.throttled = 0 # バケットの空きを待った回数
+        self.total_throttle_wait = 0.0
+        self.max_throttle_wait = 0.0
+        self.rate_limited = 0 # 429 を受けた回数
+
+    # --- 送信 ---
+    async def acquire(self, estimated_tokens: int = 0):
+        """1リクエスト分 (推定トークン数を含む) の枠ができるまで待ってから消費する"""
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._blocked_until - now
+            if wait <= 0:
+                tokens = min(estimated_tokens, self.tpm_limit) if self.tpm_limit else 0
+                wait = max(self._time_until(self._requests, 1, self.rpm_limit), self._time_until(self._tokens, tokens, self.tpm_limit))
+                if wait <= 0:
+                    if self.rpm_limit: self._requests -= 1
+                    if self.tpm_limit: self._tokens -= tokens
+                    break
+            waited += wait
+            await asyncio.sleep(wait)
+        if waited > 0:
+            self.throttled += 1
+            self.total_throttle_wait += waited
+            if waited > self.max_throttle_wait: self.max_throttle_wait = waited
+            logger.debug(f"Gemini request throttled for {waited * 1000:.0f} ms (scale {self.scale:.2f})")
+
+    def estimated_wait(self, estimated_tokens: int = 0) -> float:
+        """今 acquire() した場合に待つ秒数の見込み (消費はしない)"""
+        now = time.monotonic()
+        self._refill(now)
+        tokens = min(estimated_tokens, self.tpm_limit) if self.tpm_limit else 0
+        return max(self._blocked_until - now, self._time_until(self._requests, 1, self.rpm_limit),
+                   self._time_until(self._tokens, tokens, self.tpm_limit), 0.0)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """実際のトークン数が分かったら推定との差をバケットに反映する (不足分は借りとして次回以降に待つ)"""
+        if not self.tpm_limit or actual_tokens is None: return
+        self._tokens -= actual_tokens - min(estimated_tokens, self.tpm_limit)
+
+    def on_success(self):
+        if self.scale < 1.0: self.scale = min(1.0, self.scale + INCREASE_STEP)
+
+    def on_rate_limited(self, retry_after: Optional[float]):
+        """429 を受けたときに送信レートを下げ、retry_after 秒の間すべての送信を止める"""
+        self.rate_limited += 1
+        self.scale = max(MIN_SCALE, self.scale * DECREASE_FACTOR)
+        self._requests = min(self._requests, 0.0)
+        if retry_after: self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        logger.warning(f"Gemini API rate limited. Scaling send rate to {self.scale:.0%}" + (f", pausing {retry_after:.1f}s" if retry_after else ""))
+
+    # --- 内部処理 ---
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm_limit: self._requests = min(self.rpm_limit, self._requests + elapsed * self.rpm_limit * self.scale / 60)
+        if self.tpm_limit: self._tokens = min(self.tpm_limit, self._tokens + elapsed * self.tpm_limit * self.scale / 60)
+
+    def _time_until(self, available: float, needed: float, limit: int) -> float:
+        if not limit or available >= needed: return 0.0
+        return (needed - available) / (limit * self.scale / 60)
+
+    def stats(self) -> Dict[str, Any]:
+        """送信レートと待ちの状況を返す (時間はミリ秒)"""
+        return {"rpm_limit": self.rpm_limit, "tpm_limit": self.tpm_limit, "scale": self.scale,
+                "throttled": self.throttled, "rate_limited": self.rate_limited,
+                "avg_throttle_wait_ms": self.total_throttle_wait / self.throttled * 1000 if self.throttled else 0.0,
+                "max_throttle_wait_ms": self.max_throttle_wait * 1000,
+                "paused_ms": max(self._blocked_until - time.monotonic(), 0.0) * 1000}
+
+
+class RetryBudget:
+    """再試行をリクエスト数の一定割合までに抑える
+
+    リクエストごとに ratio ずつ貯まり、再試行1回で1消費する。障害時に再試行が
+    リクエスト数を何倍にも膨らませるのを防ぐ。
+    """
+
+    def __init__(self, ratio: float = 0.2, initial: float = 3.0, max_balance: float = 10.0):
+        self.ratio = ratio
+        self.max_balance = max_balance
+        self.balance = min(initial, max_balance)
+        self.retries = 0
+        self.denied = 0
+
+    def record_request(self):
+        self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.balance >= 1.0:
+            self.balance -= 1.0
+            self.retries += 1
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"balance": self.balance, "retries": self.retries, "denied": self.denied}
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """attempt 回目 (0始まり) の再試行までの待ち時間 (full jitter の指数バックオフ。retry_after があればそれ以上)"""
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+    return max(delay, retry_after or 0.0)
+
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    """API エラーから再試行までの秒数の目安を取り出す (RetryInfo の retryDelay、Retry-After ヘッダ)"""
+    details = getattr(error, "details", None)
+    try:
+        for detail in (details or {}).get("error", {}).get("details", []):
+            if str(detail.get("@type", "")).endswith("google.rpc.RetryInfo"):
+                match = _RETRY_DELAY_PATTERN.match(str(detail.get("retryDelay", "")))
+                if match: return float(match.group(1))
+    except (AttributeError, TypeError, ValueError): pass
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        try: return float(headers.get("retry-after"))
+        except (TypeError, ValueError): pass
+    return None
@@ -0,0 +1,140 @@
+# utils/request_scheduler.py (Gemini API 呼び出しの同時実行数・優先度・ユーザー間の公平性を制御する)
+
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Hashable, AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+# 優先度クラス (値が小さいほど優先)
+PRIORITY_INTERACTIVE_DM = 0 # DM での会話
+PRIORITY_MENTION = 1 # サーバーチャンネルでのメンション
+PRIORITY_CHANNEL = 2 # 自動応答が許可されたチャンネルでの発言
+PRIORITY_RANDOM_DM = 3 # ランダムDM
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE_DM: "interactive_dm", PRIORITY_MENTION: "mention",
+                  PRIORITY_CHANNEL: "channel", PRIORITY_RANDOM_DM: "random_dm"}
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class _Waiter:
+    __slots__ = ("future", "user", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, user: Hashable):
+        self.future = future
+        self.user = user
+        self.enqueued_at = time.perf_counter()
+
+
+class _PriorityQueue:
+    """1つの優先度クラスの待ち行列 (ユーザーごとの重み付き公平キューイング)
+
+    各リクエストに仮想終了時刻 (そのユーザーの前回の終了時刻か現在の仮想時刻の遅い方 + 1/重み) を付け、
+    小さい順に取り出す。連投したユーザーのリクエストは後ろに回り、他のユーザーと交互に処理される。
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = [] # (仮想終了時刻, 到着順, _Waiter)
+        self._counter = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish: Dict[Hashable, float] = {}
+        self.depth = 0 # キャンセルされたものを除く待ち数
+        self.max_depth = 0
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def push(self, waiter: _Waiter, weight: float):
+        start = max(self._virtual_time, self._last_finish.get(waiter.user, 0.0))
+        finish = start + 1.0 / weight
+        self._last_finish[waiter.user] = finish
+        heapq.heappush(self._heap, (finish, next(self._counter), waiter))
+        self.depth += 1
+        if self.depth > self.max_depth: self.max_depth = self.depth
+
+    def pop(self) -> Optional[_Waiter]:
+        while self._heap:
+            finish, _, waiter = heapq.heappop(self._heap)
+            if waiter.future.done(): continue # 待ち中にキャンセルされたもの
+            self.depth -= 1
+            self._virtual_time = finish
+            if not self._heap: self._last_finish.clear() # 空になったら仮想時刻の履歴は不要
+            wait = time.perf_counter() - waiter.enqueued_at
+            self.dispatched += 1
+            self.total_wait += wait
+            if wait > self.max_wait: self.max_wait = wait
+            return waiter
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queued": self.depth, "max_queued": self.max_depth, "dispatched": self.dispatched,
+                "avg_wait_ms": self.total_wait / self.dispatched * 1000 if self.dispatched else 0.0,
+                "max_wait_ms": self.max_wait * 1000}
+
+
+class RequestScheduler:
+    """同時実行数の上限つきでリクエストに実行枠を割り当てる
+
+    `async with scheduler.slot(priority, user_id):` の中で API を呼ぶ。空き枠がなければ待ち、
+    枠が空くと優先度の高いクラスから、同じクラス内ではユーザー間で公平に順番が回る。
+    """
+
+    def __init__(self, name: str, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        self.name = name
+        self.max_concurrency = max(max_concurrency, 1)
+        self.active = 0
+        self._queues: Dict[int, _PriorityQueue] = {priority: _PriorityQueue() for priority in PRIORITY_NAMES}
+        self._weights: Dict[Hashable, float] = {}
+
+    def set_max_concurrency(self, max_concurrency: int):
+        self.max_concurrency = max(max_concurrency, 1)
+        self._dispatch()
+
+    def set_weight(self, user: Hashable, weight: float):
+        """ユーザーの重みを設定する (既定 1.0。大きいほど同じクラス内で多く枠を得る)"""
+        if weight > 0: self._weights[user] = weight
+        else: self._weights.pop(user, None)
+
+    @asynccontextmanager
+    async def slot(self, priority: int, user: Hashable = None) -> AsyncIterator[None]:
+        await self._acquire(priority, user)
+        try: yield
+        finally: self._release()
+
+    async def _acquire(self, priority: int, user: Hashable):
+        queue = self._queues.get(priority, self._queues[PRIORITY_CHANNEL])
+        if self.active < self.max_concurrency and not any(q.depth for q in self._queues.values()):
+            self.active += 1
+            queue.dispatched += 1
+            return
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user)
+        queue.push(waiter, self._weights.get(user, 1.0))
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled(): self._release() # 枠を割り当てられた直後にキャンセルされた
+            else: queue.depth -= 1
+            raise
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency:
+            waiter = None
+            for priority in sorted(self._queues):
+                waiter = self._queues[priority].pop()
+                if waiter is not None: break
+            if waiter is None: return
+            self.active += 1
+            waiter.future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        """実行中の数と優先度クラスごとの待ち数・待ち時間を返す (時間はミリ秒)"""
+        return {"active": self.active, "max_concurrency": self.max_concurrency,
+                "queues": {PRIORITY_NAMES[priority]: queue.stats() for priority, queue in sorted(self._queues.items())}}
@@ -0,0 +1,139 @@
+# utils/response_cache.py (同じ入力に対する Gemini の応答を再利用する完全一致キャッシュ)
+
+import json
+import time
+import base64
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 500
+DEFAULT_TTL = 86400.0 # 秒
+CALL_NAME_MARKER = "\ue000" # 保存する応答の中の呼びかける名前を置き換える文字 (私用領域なので本文には現れない)
+
+
+def _normalize_text(text: str) -> str:
+    return ' '.join(text.split()) # 連続する空白・改行の違いは無視する
+
+def normalize_parts(parts: Iterable[Any]) -> List[Any]:
+    """Part (genai_types.Part) をキー用の値にする (テキストは空白を正規化、画像などはデータのハッシュ)"""
+    normalized = []
+    for part in parts:
+        text = getattr(part, 'text', None)
+        if text:
+            normalized.append(["text", _normalize_text(text)])
+            continue
+        inline_data = getattr(part, 'inline_data', None)
+        if inline_data is not None:
+            data = inline_data.data or b""
+            if isinstance(data, str): data = base64.b64decode(data)
+            normalized.append(["inline_data", inline_data.mime_type, hashlib.sha256(data).hexdigest()])
+            continue
+        normalized.append(["other", repr(part)])
+    return normalized
+
+def history_digest(contents: Iterable[Any]) -> str:
+    """履歴 (Content のリスト) の内容のハッシュ"""
+    digest = hashlib.sha256()
+    for content in contents:
+        record = [getattr(content, 'role', None), normalize_parts(getattr(content, 'parts', None) or [])]
+        digest.update(json.dumps(record, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+def make_cache_key(model: str, generation_config: Mapping[str, Any], safety_settings: Iterable[Mapping[str, Any]],
+                   prompt_version: int, template_fingerprint: str, prompt_values: Mapping[str, Any],
+                   parts: Iterable[Any], history: Optional[str] = None) -> str:
+    """応答を決める入力一式のハッシュをキーにする
+
+    ユーザーや場所が違っても同じ内容・URL なら同じ応答を使えるよう、システムプロンプトはテンプレート
+    (template_fingerprint) と個人によらない項目の値 (prompt_values。気分・Bot名など) で表し、呼びかける名前・
+    ユーザーID・チャンネルはキーに含めない。応答の中の呼びかける名前は depersonalize()/personalize() で差し替える。
+    history は history_digest() の値 (None なら履歴が違っても同じキーになる)。
+    """
+    record = {"model": model, "generation_config": dict(generation_config), "safety_settings": [dict(s) for s in safety_settings],
+              "prompt_version": prompt_version, "template": template_fingerprint, "prompt_values": dict(prompt_values),
+              "parts": normalize_parts(parts), "history": history}
+    return hashlib.sha256(json.dumps(record, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def depersonalize(text: str, call_name: Optional[str]) -> str:
+    """保存する応答の中の呼びかける名前を CALL_NAME_MARKER にする"""
+    return text.replace(call_name, CALL_NAME_MARKER) if call_name else text
+
+def personalize(text: str, call_name: Optional[str]) -> str:
+    """キャッシュした応答を今回の相手の名前に戻す"""
+    return text.replace(CALL_NAME_MARKER, call_name or "")
+
+
+class ResponseCache:
+    """TTL と件数上限 (LRU) つきのキャッシュ (キー → 文字列)
+
+    期限は time.time() 基準で記録するので、records()/load_records() で保存・復元しても保たれる。
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        self.max_entries = max(max_entries, 1)
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict() # キー → (保存時刻, 値)。末尾が最近使ったもの
+        self.dirty = 0 # 前回保存してから変更した回数
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int: return len(self._entries)
+
+    def configure(self, max_entries: int, ttl: float):
+        self.max_entries = max(max_entries, 1)
+        self.ttl = ttl
+        self._evict_overflow()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            del self._entries[key]
+            self.dirty += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value: str):
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        self.dirty += 1
+        self._evict_overflow()
+
+    def clear(self):
+        if self._entries: self.dirty += 1
+        self._entries.clear()
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # --- 保存・復元 ---
+    def records(self) -> List[List[Any]]:
+        """期限内のエントリを [キー, 保存時刻, 値] のリストで返す (古い順。保存用)"""
+        now = time.time()
+        return [[key, created, value] for key, (created, value) in self._entries.items() if now - created <= self.ttl]
+
+    def load_records(self, records: Iterable[Any]):
+        now = time.time()
+        for record in records:
+            try: key, created, value = record
+            except (TypeError, ValueError): continue
+            if isinstance(key, str) and isinstance(value, str) and isinstance(created, (int, float)) and now - created <= self.ttl:
+                self._entries[key] = (float(created), value)
+        self._evict_overflow()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions}
@@ -0,0 +1,166 @@
+# utils/speaker_directory.py (履歴の発言者名のキャッシュ。見つからない名前は裏でまとめて取得する)
+
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_DELAY = 1.0 # 秒。見つからなかった名前をこの間まとめてから取得する
+DEFAULT_RETRY_AFTER = 3600.0 # 秒。取得できなかったユーザーを再び取得するまでの間隔
+QUERY_MEMBERS_CHUNK = 100 # Guild.query_members に一度に渡せる user_ids の上限
+
+NameKey = Tuple[int, Optional[int]] # (ユーザーID, サーバーID。DM は None)
+
+
+def fallback_name(user_id: int) -> str: return f"User {user_id}"
+
+
+class SpeakerDirectory:
+    """発言者名 (ニックネーム > サーバーでの表示名 > グローバル名) をユーザー・サーバーごとに覚えておく
+
+    resolve() はブロックしない。Discord のキャッシュにもないユーザーは "User <ID>" を返し、
+    取得待ちに入れて裏でまとめて取得する (サーバーのメンバーは query_members、それ以外は fetch_user)。
+    名前が変わったり新しく分かったりしたら on_change を呼ぶ (整形済み履歴の作り直しに使う)。
+    """
+
+    def __init__(self, get_nickname: Callable[[int], Optional[str]], on_change: Callable[[], Any],
+                 refresh_delay: float = DEFAULT_REFRESH_DELAY, retry_after: float = DEFAULT_RETRY_AFTER):
+        self._get_nickname = get_nickname
+        self._on_change = on_change
+        self.refresh_delay = refresh_delay
+        self.retry_after = retry_after
+        self._bot: Any = None
+        self._names: Dict[int, Dict[Optional[int], str]] = {} # ユーザーID → {サーバーID → 名前}
+        self._pending: Set[NameKey] = set()
+        self._failed: Dict[NameKey, float] = {} # 取得できなかったもの → 時刻 (time.monotonic())
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.fetch_failures = 0
+
+    def attach(self, bot: Any):
+        """名前の取得に使う Bot を設定する (Bot が変わったら覚えた名前は捨てる)"""
+        if bot is not self._bot: self.clear()
+        self._bot = bot
+
+    # --- 参照 ---
+    def resolve(self, user_id: int, channel_id: Optional[int] = None) -> str:
+        """発言者名を返す (ブロックしない)。channel_id からサーバーを求め、そのサーバーでの表示名を優先する"""
+        guild = self._guild_for_channel(channel_id)
+        guild_id = guild.id if guild is not None else None
+        name = self._names.get(user_id, {}).get(guild_id)
+        if name is not None:
+            self.hits += 1
+            return name
+        self.misses += 1
+        name = self._lookup_cached(user_id, guild)
+        if name is not None:
+            self._names.setdefault(user_id, {})[guild_id] = name
+            return name
+        self._request_refresh((user_id, guild_id))
+        return fallback_name(user_id)
+
+    def _guild_for_channel(self, channel_id: Optional[int]) -> Any:
+        if channel_id is None or self._bot is None: return None
+        channel = self._bot.get_channel(channel_id)
+        return getattr(channel, "guild", None)
+
+    def _lookup_cached(self, user_id: int, guild: Any) -> Optional[str]:
+        """ニックネームと Discord のキャッシュから名前を探す (API は呼ばない)"""
+        nickname = self._get_nickname(user_id)
+        if nickname: return nickname
+        if self._bot is None: return None
+        if guild is not None:
+            member = guild.get_member(user_id)
+            if member is not None: return member.display_name # サーバーでのニックネーム > グローバル名 > ユーザー名
+        user = self._bot.get_user(user_id)
+        if user is None: return None
+        if guild is not None: self._request_refresh((user_id, guild.id)) # メンバー情報が分かればサーバーでの名前に差し替える
+        return user.display_name
+
+    # --- 無効化 ---
+    def invalidate_user(self, user_id: int, guild_id: Optional[int] = None):
+        """ユーザーの名前を忘れる (guild_id を指定するとそのサーバーの分だけ)。ニックネームやメンバー情報の変更時に呼ぶ"""
+        names = self._names.get(user_id)
+        if names is None: changed = False
+        elif guild_id is None: changed = self._names.pop(user_id, None) is not None
+        else:
+            changed = names.pop(guild_id, None) is not None
+            if not names: del self._names[user_id]
+        failed = [key for key in self._failed if key[0] == user_id and (guild_id is None or key[1] == guild_id)]
+        for key in failed: del self._failed[key] # "User <ID>" を返していたものも作り直させる
+        if changed or failed: self._on_change()
+
+    def clear(self):
+        if self._refresh_task and not self._refresh_task.done(): self._refresh_task.cancel()
+        self._refresh_task = None
+        self._names.clear(); self._pending.clear(); self._failed.clear()
+
+    # --- 裏での一括取得 ---
+    def _request_refresh(self, key: NameKey):
+        failed_at = self._failed.get(key)
+        if failed_at is not None and time.monotonic() - failed_at < self.retry_after: return
+        self._pending.add(key)
+        if self._refresh_task and not self._refresh_task.done(): return
+        try:
+            self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_pending(), name="speaker_directory_refresh")
+        except RuntimeError: pass # イベントループ外 (起動前など) では取得しない。次の resolve で再び依頼される
+
+    async def _refresh_pending(self):
+        await asyncio.sleep(self.refresh_delay) # 同じプロンプトの組み立てで見つからなかった分をまとめる
+        while self._pending and self._bot is not None:
+            batch, self._pending = self._pending, set()
+            by_guild: Dict[Optional[int], List[int]] = {}
+            for user_id, guild_id in batch: by_guild.setdefault(guild_id, []).append(user_id)
+            changed = False
+            for guild_id, user_ids in by_guild.items():
+                try: names = await self._fetch_names(guild_id, user_ids)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh speaker names (guild: {guild_id})", exc_info=e)
+                    names = {}
+                for user_id in user_ids:
+                    name = self._get_nickname(user_id) or names.get(user_id)
+                    if name is None:
+                        self._failed[(user_id, guild_id)] = time.monotonic()
+                        self.fetch_failures += 1
+                        continue
+                    self.fetched += 1
+                    guild_names = self._names.setdefault(user_id, {})
+                    if guild_names.get(guild_id) != name:
+                        guild_names[guild_id] = name
+                        changed = True
+            if changed:
+                logger.debug(f"Refreshed speaker names for {len(batch)} user(s)")
+                self._on_change()
+
+    async def _fetch_names(self, guild_id: Optional[int], user_ids: List[int]) -> Dict[int, str]:
+        """サーバーのメンバーはまとめて問い合わせ、見つからなかったユーザーは1人ずつ取得する"""
+        names: Dict[int, str] = {}
+        guild = self._bot.get_guild(guild_id) if guild_id is not None else None
+        if guild is not None:
+            for i in range(0, len(user_ids), QUERY_MEMBERS_CHUNK):
+                chunk = user_ids[i:i + QUERY_MEMBERS_CHUNK]
+                try: members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+                except Exception as e: # members インテントがない場合など
+                    logger.debug(f"query_members failed for guild {guild_id}. Falling back to fetch_user: {e}")
+                    break
+                names.update((member.id, member.display_name) for member in members)
+        for user_id in user_ids:
+            if user_id in names: continue
+            user = self._bot.get_user(user_id)
+            if user is None:
+                try: user = await self._bot.fetch_user(user_id)
+                except Exception as e:
+                    logger.debug(f"Could not fetch user {user_id} for speaker name: {e}")
+                    continue
+            names[user_id] = user.display_name
+        return names
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {"users": len(self._names), "pending": len(self._pending), "failed": len(self._failed),
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "fetched": self.fetched, "fetch_failures": self.fetch_failures}
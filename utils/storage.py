@@ -0,0 +1,522 @@
+# utils/storage.py (ユーザーデータ・会話履歴・チャンネル設定の保存先を差し替え可能にする)
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import datetime
+from pathlib import Path
+from collections import deque
+from typing import Dict, List, Any, Optional, Tuple
+
+from utils import json_codec
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_HISTORY_KEY = "global_history"
+HISTORY_SEQ_KEY = "seq" # 保存する履歴エントリに持たせるシーケンス番号
+
+
+def history_records(entries: List[Any], last_seq: int) -> List[Tuple[int, Any]]:
+    """ロードした履歴 (古い順) を (seq, エントリ) にする
+
+    エントリが持つ seq をそのまま使う (クリアで番号が飛んでいても振り直さない)。seq を持たない旧形式の
+    エントリは、次のエントリの seq (最後は last_seq + 1) から1ずつ遡って振る。
+    """
+    records = []
+    next_seq = last_seq + 1
+    for entry in reversed(entries):
+        seq = entry.get(HISTORY_SEQ_KEY) if isinstance(entry, dict) else None
+        if not isinstance(seq, int) or seq >= next_seq: seq = next_seq - 1
+        records.append((seq, entry))
+        next_seq = seq
+    records.reverse()
+    return records
+
+# --- 低レベルのファイル操作 (I/Oワーカー上で呼ばれる) ---
+def save_json(filepath: Path, data: Any, compact: bool = False):
+    """JSONファイルに安全に書き込む (datetime/deque対応, compact=True ならインデントなし)"""
+    try:
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        temp_filepath = filepath.with_suffix(filepath.suffix + '.tmp')
+        encoded = json_codec.dumps(data, compact) # 書き込み前に全体をエンコードしておく
+        with open(temp_filepath, 'wb') as f:
+            f.write(encoded)
+            f.flush(); os.fsync(f.fileno())
+        os.replace(temp_filepath, filepath)
+        logger.debug(f"Successfully saved JSON to: {filepath}")
+    except Exception as e:
+        logger.error(f"Error saving data to {filepath}", exc_info=e)
+        if 'temp_filepath' in locals() and temp_filepath.exists():
+            try: os.remove(temp_filepath)
+            except OSError: pass
+
+def save_text(filepath: Path, text: str):
+    """テキストファイルに安全に書き込む"""
+    try:
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        temp_filepath = filepath.with_suffix(filepath.suffix + '.tmp')
+        with open(temp_filepath, 'w', encoding='utf-8') as f:
+            f.write(text); f.flush(); os.fsync(f.fileno())
+        os.replace(temp_filepath, filepath)
+        logger.debug(f"Successfully saved text to: {filepath}")
+    except Exception as e:
+        logger.error(f"Error saving text to {filepath}", exc_info=e)
+        if 'temp_filepath' in locals() and temp_filepath.exists():
+            try: os.remove(temp_filepath)
+            except OSError: pass
+
+def append_jsonl(filepath: Path, record: Dict[str, Any]):
+    """JSONL ファイルに1レコードを追記する (ファイル全体は書き換えない)"""
+    try:
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        line = json_codec.dumps(record, compact=True)
+        with open(filepath, 'ab') as f:
+            f.write(line + b"\n"); f.flush(); os.fsync(f.fileno())
+        logger.debug(f"Appended journal record to: {filepath}")
+    except Exception as e:
+        logger.error(f"Error appending journal record to {filepath}", exc_info=e)
+
+def truncate_file(filepath: Path):
+    """スナップショットに取り込んだジャーナルを空にする"""
+    try:
+        if filepath.exists():
+            with open(filepath, 'w', encoding='utf-8'): pass
+            logger.debug(f"Truncated journal: {filepath}")
+    except Exception as e:
+        logger.error(f"Error truncating journal {filepath}", exc_info=e)
+
+def read_jsonl(filepath: Path) -> List[Dict[str, Any]]:
+    """JSONL ファイルを読み込む (壊れた行はスキップ)"""
+    records = []
+    if not filepath.exists(): return records
+    try:
+        with open(filepath, 'rb') as f:
+            for line_no, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line: continue
+                try:
+                    record = json_codec.loads(line)
+                except (json_codec.DecodeError, UnicodeDecodeError):
+                    # 書き込み途中でクラッシュした最終行などは読み飛ばす
+                    logger.warning(f"Skipping corrupt journal line {line_no} in {filepath}")
+                    continue
+                if isinstance(record, dict): records.append(record)
+    except Exception as e:
+        logger.error(f"Error reading journal {filepath}", exc_info=e)
+    return records
+
+def quarantine_file(filepath: Path) -> Optional[Path]:
+    """壊れたファイルを上書きせずに <名前>.corrupt-<日時> へ退避する"""
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    quarantined = filepath.with_name(f"{filepath.name}.corrupt-{stamp}")
+    try:
+        os.replace(filepath, quarantined)
+        logger.error(f"Quarantined corrupt file {filepath} -> {quarantined}")
+        return quarantined
+    except OSError as e:
+        logger.error(f"Failed to quarantine corrupt file {filepath}", exc_info=e)
+        return None
+
+def _read_json_file(filepath: Path) -> Any:
+    """JSONファイルを読み込む (存在しない場合は None, 壊れている場合は退避して None)"""
+    if not filepath.exists() or not filepath.is_file(): return None
+    try:
+        with open(filepath, 'rb') as f:
+            data = json_codec.loads(f.read())
+        logger.info(f"Successfully loaded JSON from: {filepath}")
+        return data
+    except (json_codec.DecodeError, UnicodeDecodeError) as e:
+        logger.error(f"Error decoding JSON from {filepath}: {e}")
+        quarantine_file(filepath)
+        return None
+    except OSError as e:
+        logger.error(f"Error loading {filepath}: {e}")
+        return None
+
+
+TRUNCATED_TAIL_CHARS = 12 # デコードエラーの位置が末尾からこの文字数以内なら、値が切れているだけとみなす ("\uXXXX\uXXXX" や true など)
+
+
+class _JsonStreamReader:
+    """JSON をチャンク単位で読み進め、値を1つずつデコードする (ファイル全体を一度に読み込まない)"""
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size: int = 1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.consumed = 0 # buf より前に読み捨てた文字数 (エラー位置の表示用)
+        self.eof = False
+
+    @property
+    def offset(self) -> int: return self.consumed + self.pos
+
+    def _fill(self) -> bool:
+        if self.eof: return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > self.chunk_size: # 読み終えた部分を捨ててバッファを小さく保つ
+            self.consumed += self.pos
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += chunk
+        return True
+
+    def peek(self) -> str:
+        """空白を読み飛ばして次の文字を返す (終端なら空文字)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n": self.pos += 1
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if not self._fill(): return ""
+
+    def expect(self, char: str):
+        if self.peek() != char: raise ValueError(f"Expected {char!r} at offset {self.offset}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """次の JSON 値を1つデコードする (チャンク境界をまたぐ場合は追加で読み込む)"""
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                # 値がバッファの末尾で切れている場合だけ追加で読む (途中が壊れている場合は読み進めずにすぐ失敗させる)
+                if (e.msg.startswith("Unterminated") or e.pos >= len(self.buf) - TRUNCATED_TAIL_CHARS) and self._fill(): continue
+                raise
+            if end == len(self.buf) and self._fill(): continue # 数値などが境界で切れている可能性がある
+            self.pos = end
+            return obj
+
+
+def stream_history_snapshot(filepath: Path, max_entries: int) -> Tuple[List[Any], Optional[int], int, Optional[Exception]]:
+    """履歴スナップショットを先頭から読み進め、新しい max_entries 件だけを保持する
+
+    戻り値は (保持したエントリ, last_seq (読めなかった場合は None), 読み込んだ総件数, 途中で発生したエラー)。
+    壊れていた場合も、エラー位置までに読めたエントリは返す。
+    """
+    window: deque = deque(maxlen=max(max_entries, 0))
+    last_seq: Optional[int] = None
+    scanned = 0
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            reader = _JsonStreamReader(f)
+            reader.expect('{')
+            if reader.peek() == '}': return list(window), last_seq, scanned, None
+            while True:
+                key = reader.value()
+                reader.expect(':')
+                if key == GLOBAL_HISTORY_KEY and reader.peek() == '[':
+                    reader.expect('[')
+                    if reader.peek() == ']': reader.expect(']')
+                    else:
+                        while True:
+                            window.append(reader.value())
+                            scanned += 1
+                            if reader.peek() == ',': reader.expect(',')
+                            else: reader.expect(']'); break
+                else:
+                    value = reader.value()
+                    if key == "last_seq" and isinstance(value, int): last_seq = value
+                    elif key == GLOBAL_HISTORY_KEY: logger.warning(f"Invalid history format in {filepath} ('{GLOBAL_HISTORY_KEY}' is not a list)")
+                if reader.peek() == ',': reader.expect(',')
+                else: reader.expect('}'); break
+            if reader.peek() != "": raise ValueError(f"Extra data at offset {reader.offset}")
+    except (ValueError, UnicodeDecodeError) as e: # json.JSONDecodeError は ValueError のサブクラス
+        return list(window), last_seq, scanned, e
+    return list(window), last_seq, scanned, None
+
+
+# --- ストレージバックエンド ---
+class StorageBackend:
+    """user_data・会話履歴・チャンネル設定の永続化インターフェース
+
+    メソッドはすべて同期的で、config_manager の I/O ワーカー (単一スレッド) から呼ばれる。
+    履歴エントリは JSON 化可能な dict (timestamp は ISO 文字列) で受け渡す。
+    """
+    name = "base"
+
+    def load_user_data(self) -> Dict[str, Dict[str, Any]]: raise NotImplementedError
+    def save_user_data(self, snapshot: Dict[str, Dict[str, Any]], dirty_ids: Optional[set] = None): raise NotImplementedError
+    def load_channel_settings(self) -> Dict[str, List[int]]: raise NotImplementedError
+    def save_channel_settings(self, snapshot: Dict[str, List[int]]): raise NotImplementedError
+    def load_history(self, max_entries: int) -> Tuple[List[Dict[str, Any]], int]:
+        """新しい順に最大 max_entries 件の履歴 (古い順に並べたもの。各エントリは "seq" を持つ) と最後のシーケンス番号を返す"""
+        raise NotImplementedError
+    def append_history(self, seq: int, entry: Dict[str, Any]): raise NotImplementedError
+    def compact_history(self, entries: List[Dict[str, Any]], last_seq: int):
+        """保存済みの履歴を現在のウィンドウ (entries) に揃える"""
+        raise NotImplementedError
+    def delete_user_history(self, user_id: int, remaining: List[Dict[str, Any]], last_seq: int):
+        self.compact_history(remaining, last_seq)
+    def delete_channel_history(self, channel_id: int, remaining: List[Dict[str, Any]], last_seq: int):
+        self.compact_history(remaining, last_seq)
+    def clear_history(self, last_seq: int):
+        self.compact_history([], last_seq)
+    def close(self): pass
+
+
+class JsonStorageBackend(StorageBackend):
+    """従来の JSON ファイル (+ 履歴ジャーナル) による保存
+
+    compact=True の場合はインデントなしで書き込む (読み込みはどちらの形式でも可能)。
+    """
+    name = "json"
+
+    def __init__(self, user_data_file: Path, channel_settings_file: Path, history_file: Path, history_journal_file: Path,
+                 compact: bool = False):
+        self.compact = compact
+        self.user_data_file = user_data_file
+        self.channel_settings_file = channel_settings_file
+        self.history_file = history_file
+        self.history_journal_file = history_journal_file
+
+    def load_user_data(self) -> Dict[str, Dict[str, Any]]:
+        data = _read_json_file(self.user_data_file)
+        return data if isinstance(data, dict) else {}
+
+    def save_user_data(self, snapshot: Dict[str, Dict[str, Any]], dirty_ids: Optional[set] = None):
+        save_json(self.user_data_file, snapshot, self.compact) # JSONではファイル全体を書き換えるしかない
+
+    def load_channel_settings(self) -> Dict[str, List[int]]:
+        data = _read_json_file(self.channel_settings_file)
+        return data if isinstance(data, dict) else {}
+
+    def save_channel_settings(self, snapshot: Dict[str, List[int]]):
+        save_json(self.channel_settings_file, snapshot, self.compact)
+
+    def load_history(self, max_entries: int) -> Tuple[List[Dict[str, Any]], int]:
+        # スナップショット + スナップショットより新しいジャーナルのレコードを再生する
+        start = time.perf_counter()
+        entries: List[Any] = []
+        snapshot_seq: Optional[int] = 0
+        scanned = 0
+        corrupt = False
+        if self.history_file.exists():
+            entries, snapshot_seq, scanned, error = stream_history_snapshot(self.history_file, max_entries)
+            if error is not None:
+                # 上書きせずに退避し、読めたところまでの履歴で起動する
+                logger.error(f"History file {self.history_file} is corrupt ({error}). Salvaged {len(entries)} of {scanned} entries read before the error.")
+                quarantine_file(self.history_file)
+                corrupt = True
+            elif snapshot_seq is None:
+                snapshot_seq = scanned # last_seq を持たない旧形式
+        parse_time = time.perf_counter() - start
+
+        journal = read_jsonl(self.history_journal_file)
+        if snapshot_seq is None: # last_seq まで読めなかった場合はジャーナルをすべて再生する
+            journal_seqs = [r.get("seq") for r in journal if isinstance(r.get("seq"), int)]
+            snapshot_seq = min(journal_seqs) - 1 if journal_seqs else scanned
+        window = deque(entries, maxlen=max_entries)
+        last_seq = snapshot_seq
+        replayed = 0
+        for record in journal:
+            seq = record.get("seq")
+            if not isinstance(seq, int) or seq <= snapshot_seq: continue
+            entry = record.get("entry")
+            window.append({**entry, HISTORY_SEQ_KEY: seq} if isinstance(entry, dict) else entry)
+            replayed += 1
+            last_seq = max(last_seq, seq)
+        if replayed: logger.info(f"Replayed {replayed} history entries from journal {self.history_journal_file}")
+        logger.info(f"Loaded {len(window)} history entries (scanned {scanned} in snapshot, replayed {replayed} from journal) "
+                    f"in {(time.perf_counter() - start) * 1000:.1f} ms (snapshot parse {parse_time * 1000:.1f} ms)")
+        if corrupt or scanned > max_entries:
+            # 退避したスナップショットを救出した履歴で作り直す / 保持件数を超える古いエントリを捨てて次回以降の起動を速くする
+            self.compact_history(list(window), last_seq)
+        return list(window), last_seq
+
+    def append_history(self, seq: int, entry: Dict[str, Any]):
+        append_jsonl(self.history_journal_file, {"seq": seq, "entry": entry})
+
+    def compact_history(self, entries: List[Dict[str, Any]], last_seq: int):
+        # last_seq をスナップショットに記録し、それ以前のジャーナルはロード時に再生しない
+        save_json(self.history_file, {GLOBAL_HISTORY_KEY: entries, "last_seq": last_seq}, self.compact)
+        truncate_file(self.history_journal_file)
+
+
+class SqliteStorageBackend(StorageBackend):
+    """SQLite (WALモード) による保存。変更のあった行だけを読み書き・削除する"""
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS channel_settings (
+            server_id TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (server_id, channel_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_channel_settings_channel_id ON channel_settings(channel_id);
+        CREATE TABLE IF NOT EXISTS history (
+            seq INTEGER PRIMARY KEY,
+            role TEXT NOT NULL,
+            parts TEXT NOT NULL,
+            channel_id INTEGER,
+            interlocutor_id INTEGER,
+            current_interlocutor_id INTEGER,
+            timestamp TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_interlocutor_id ON history(interlocutor_id);
+        CREATE INDEX IF NOT EXISTS idx_history_current_interlocutor_id ON history(current_interlocutor_id);
+        CREATE INDEX IF NOT EXISTS idx_history_channel_id ON history(channel_id);
+        CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, db_file: Path):
+        self.db_file = db_file
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.is_new = not db_file.exists()
+        # 起動時のロードはメインスレッド、以降の書き込みは I/O ワーカーから (同時には使わない)
+        self.conn = sqlite3.connect(str(db_file), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+        logger.info(f"Opened SQLite storage: {db_file} (new={self.is_new})")
+
+    def migrate_from(self, source: StorageBackend, max_entries: int):
+        """新規作成したDBに既存バックエンド (JSON) のデータを取り込む"""
+        logger.info(f"Migrating data from {source.name} storage into {self.db_file}...")
+        self.save_user_data(source.load_user_data())
+        self.save_channel_settings(source.load_channel_settings())
+        entries, last_seq = source.load_history(max_entries)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO history (seq, role, parts, channel_id, interlocutor_id, current_interlocutor_id, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [self._history_row(seq, e) for seq, e in history_records(entries, last_seq) if isinstance(e, dict)]
+            )
+            self._store_last_seq(last_seq)
+        logger.info(f"Migration finished ({len(entries)} history entries).")
+
+    def load_user_data(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for user_id, data in self.conn.execute("SELECT user_id, data FROM users"):
+            try: result[user_id] = json_codec.loads(data)
+            except json_codec.DecodeError: logger.warning(f"Skipping corrupt user_data row for user {user_id}")
+        return result
+
+    def save_user_data(self, snapshot: Dict[str, Dict[str, Any]], dirty_ids: Optional[set] = None):
+        try:
+            with self.conn:
+                if dirty_ids is None: # 変更箇所が不明な場合は全件を同期する
+                    self.conn.execute("DELETE FROM users WHERE user_id NOT IN (SELECT value FROM json_each(?))", (json_codec.dumps_str(list(snapshot.keys())),))
+                    target_ids = snapshot.keys()
+                else:
+                    target_ids = dirty_ids
+                for user_id in target_ids:
+                    if user_id in snapshot:
+                        self.conn.execute("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
+                                          (user_id, json_codec.dumps_str(snapshot[user_id])))
+                    else:
+                        self.conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            logger.debug(f"Saved user_data to SQLite ({'all' if dirty_ids is None else len(dirty_ids)} user(s))")
+        except sqlite3.Error as e:
+            logger.error("Error saving user_data to SQLite", exc_info=e)
+
+    def load_channel_settings(self) -> Dict[str, List[int]]:
+        result: Dict[str, List[int]] = {}
+        for server_id, channel_id in self.conn.execute("SELECT server_id, channel_id FROM channel_settings ORDER BY rowid"):
+            result.setdefault(server_id, []).append(channel_id)
+        return result
+
+    def save_channel_settings(self, snapshot: Dict[str, List[int]]):
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM channel_settings")
+                self.conn.executemany("INSERT OR IGNORE INTO channel_settings (server_id, channel_id) VALUES (?, ?)",
+                                      [(server_id, channel_id) for server_id, ids in snapshot.items() for channel_id in ids])
+        except sqlite3.Error as e:
+            logger.error("Error saving channel_settings to SQLite", exc_info=e)
+
+    @staticmethod
+    def _history_row(seq: int, entry: Dict[str, Any]) -> tuple:
+        timestamp = entry.get("timestamp")
+        if isinstance(timestamp, datetime.datetime): timestamp = timestamp.isoformat()
+        return (seq, entry.get("role"), json_codec.dumps_str(entry.get("parts", [])),
+                entry.get("channel_id"), entry.get("interlocutor_id"), entry.get("current_interlocutor_id"), timestamp)
+
+    def _store_last_seq(self, last_seq: int):
+        """採番済みの最後の seq を記録する (行を消しても番号が戻らないように、小さくはしない。トランザクション内で呼ぶ)"""
+        self.conn.execute("INSERT INTO meta (key, value) VALUES ('history_last_seq', ?) "
+                          "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)", (last_seq,))
+
+    def load_history(self, max_entries: int) -> Tuple[List[Dict[str, Any]], int]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'history_last_seq'").fetchone()
+        max_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM history").fetchone()[0]
+        last_seq = max(row[0] if row else 0, max_seq) # meta を持たない既存のDBは行の最大値から
+        rows = self.conn.execute(
+            "SELECT seq, role, parts, channel_id, interlocutor_id, current_interlocutor_id, timestamp FROM history ORDER BY seq DESC LIMIT ?",
+            (max(max_entries, 0),)
+        ).fetchall()
+        entries = []
+        for seq, role, parts, channel_id, interlocutor_id, current_interlocutor_id, timestamp in reversed(rows):
+            try: parts_list = json_codec.loads(parts)
+            except json_codec.DecodeError: parts_list = []
+            entries.append({"role": role, "parts": parts_list, "channel_id": channel_id, "interlocutor_id": interlocutor_id,
+                            "current_interlocutor_id": current_interlocutor_id, "timestamp": timestamp, HISTORY_SEQ_KEY: seq})
+        return entries, last_seq
+
+    def append_history(self, seq: int, entry: Dict[str, Any]):
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO history (seq, role, parts, channel_id, interlocutor_id, current_interlocutor_id, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    self._history_row(seq, entry)
+                )
+                self._store_last_seq(seq)
+        except sqlite3.Error as e:
+            logger.error("Error appending history to SQLite", exc_info=e)
+
+    def compact_history(self, entries: List[Dict[str, Any]], last_seq: int):
+        # 行はメモリ上のウィンドウと同じ順に並んでいるので、新しい len(entries) 件だけを残す
+        try:
+            with self.conn:
+                if not entries:
+                    self.conn.execute("DELETE FROM history")
+                else:
+                    self.conn.execute(
+                        "DELETE FROM history WHERE seq < (SELECT seq FROM history ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                        (len(entries) - 1,)
+                    )
+                self._store_last_seq(last_seq)
+        except sqlite3.Error as e:
+            logger.error("Error compacting history in SQLite", exc_info=e)
+
+    def delete_user_history(self, user_id: int, remaining: List[Dict[str, Any]], last_seq: int):
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM history WHERE interlocutor_id = ?", (user_id,))
+                self.conn.execute("DELETE FROM history WHERE current_interlocutor_id = ?", (user_id,))
+                self._store_last_seq(last_seq)
+        except sqlite3.Error as e:
+            logger.error(f"Error deleting history for user {user_id} in SQLite", exc_info=e)
+
+    def delete_channel_history(self, channel_id: int, remaining: List[Dict[str, Any]], last_seq: int):
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM history WHERE channel_id = ?", (channel_id,))
+                self._store_last_seq(last_seq)
+        except sqlite3.Error as e:
+            logger.error(f"Error deleting history for channel {channel_id} in SQLite", exc_info=e)
+
+    def clear_history(self, last_seq: int):
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM history")
+                self._store_last_seq(last_seq)
+        except sqlite3.Error as e:
+            logger.error("Error clearing history in SQLite", exc_info=e)
+
+    def close(self):
+        try: self.conn.close()
+        except sqlite3.Error: pass
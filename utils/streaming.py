@@ -0,0 +1,193 @@
+# utils/streaming.py (ストリーミング応答を Discord メッセージに逐次表示する)
+
+import re
+import time
+import asyncio
+import logging
+import discord
+from typing import List, Optional
+
+from utils import helpers
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MESSAGE_LENGTH = 1900 # 1メッセージの最大文字数 (これを超えたら次のメッセージに続ける)
+DEFAULT_EDIT_INTERVAL = 1.0 # メッセージ編集の最短間隔 (秒)
+PREFIX_HOLD_LIMIT = 200 # 先頭の [名前]: 判定のために表示を保留する最大文字数
+
+_CITATION_PATTERN = re.compile(r'\[\d+\]') # helpers.remove_citation_marks と同じ
+_PARTIAL_CITATION_PATTERN = re.compile(r'\[\d*') # 末尾がこれに一致する場合、引用マークの途中の可能性がある
+_PREFIX_PATTERN = re.compile(r'^\s*\[.*?]:\s*') # helpers.remove_all_prefixes と同じ
+
+
+class IncrementalResponseFilter:
+    """helpers.remove_citation_marks → helpers.remove_all_prefixes をチャンク単位で適用する
+
+    feed() に届いたテキストを渡すと、確定した (後続のチャンクで結果が変わらない) 部分だけを返す。
+    引用マークの途中で切れた末尾、先頭の [名前]: 判定中の部分、末尾の空白は次のチャンクまで保留する。
+    全チャンクの feed() と finish() の戻り値を連結したものは、全文に両関数を適用した結果と一致する。
+    """
+
+    def __init__(self, prefix_hold_limit: int = PREFIX_HOLD_LIMIT):
+        self.prefix_hold_limit = prefix_hold_limit
+        self._citation_pending = "" # 引用マークの途中かもしれない末尾
+        self._head = "" # プレフィックス判定待ちの先頭部分
+        self._head_done = False
+        self._trailing_space = "" # 末尾の空白 (後ろに文字が続いた場合のみ出力する)
+
+    def feed(self, text: str) -> str:
+        return self._process(text, final=False)
+
+    def finish(self) -> str:
+        return self._process("", final=True)
+
+    def _process(self, text: str, final: bool) -> str:
+        # 1. 引用マーク除去
+        data = self._citation_pending + text
+        self._citation_pending = ""
+        if not final:
+            bracket = data.rfind('[')
+            if bracket != -1 and _PARTIAL_CITATION_PATTERN.fullmatch(data, bracket):
+                data, self._citation_pending = data[:bracket], data[bracket:]
+        data = _CITATION_PATTERN.sub('', data)
+        # 2. 先頭のプレフィックス除去
+        if not self._head_done:
+            self._head += data
+            data = self._strip_head(final)
+        # 3. 末尾の空白は保留する (全体の strip に合わせる)
+        data = self._trailing_space + data
+        released = data.rstrip()
+        self._trailing_space = "" if final else data[len(released):]
+        return released
+
+    def _strip_head(self, final: bool) -> str:
+        while True:
+            head = self._head.lstrip()
+            self._head = head
+            if not head: return ""
+            if head[0] != '[': break
+            match = _PREFIX_PATTERN.match(head)
+            if match:
+                self._head = head[match.end():]
+                continue
+            # 1行目が終わるまでは後から ]: が現れる可能性がある
+            if final or '\n' in head or len(head) > self.prefix_hold_limit: break
+            return ""
+        self._head_done = True
+        released, self._head = self._head, ""
+        return released
+
+
+class StreamingReply:
+    """ストリーミング中の応答を Discord に表示する
+
+    最初のテキストが届いた時点で返信を投稿し、以降は edit_interval 秒以上の間隔でメッセージを編集して
+    追記する。max_length を超える分は helpers.split_and_send_messages と同じ区切り位置で次のメッセージに
+    続ける。max_total_length を超えた場合は末尾を "..." にして以降を無視する。
+    """
+
+    def __init__(self, message: discord.Message, max_length: int = DEFAULT_MESSAGE_LENGTH,
+                 max_total_length: Optional[int] = None, edit_interval: float = DEFAULT_EDIT_INTERVAL):
+        self._message = message
+        self.max_length = max_length
+        self.max_total_length = max_total_length
+        self.edit_interval = edit_interval
+        self._filter = IncrementalResponseFilter()
+        self._lock = asyncio.Lock()
+        self._sent: List[discord.Message] = [] # 投稿したメッセージ (古い順)
+        self._current: Optional[discord.Message] = None # 追記中のメッセージ
+        self._text = "" # 追記中のメッセージに表示すべき本文
+        self._shown = "" # 追記中のメッセージに実際に表示している本文
+        self._total = 0
+        self._last_edit = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._started_at = time.perf_counter()
+        self.first_visible_after: Optional[float] = None # 最初の投稿までにかかった秒数
+        self.edits = 0
+        self.truncated = False
+        self.failed = False
+
+    @property
+    def started(self) -> bool:
+        """1件以上メッセージを投稿したか"""
+        return bool(self._sent)
+
+    async def feed(self, text: str):
+        """届いたテキストを追加する"""
+        if self.truncated or self.failed: return
+        cleaned = self._filter.feed(text)
+        if cleaned: await self._append(cleaned)
+
+    async def finish(self):
+        """残りのテキストを表示して終了する"""
+        if not self.truncated and not self.failed:
+            cleaned = self._filter.finish()
+            if cleaned: await self._append(cleaned, schedule=False)
+        self._cancel_flush_task()
+        async with self._lock: await self._flush_nolock()
+        if self.started:
+            logger.info(f"Streamed response in {len(self._sent)} message(s), {self.edits} edit(s), first visible after "
+                        f"{self.first_visible_after * 1000:.0f} ms, total {(time.perf_counter() - self._started_at) * 1000:.0f} ms")
+
+    async def discard(self):
+        """投稿済みのメッセージを削除する (Recitation 再試行などで応答をやり直す場合)"""
+        self._cancel_flush_task()
+        async with self._lock:
+            for sent in self._sent:
+                try: await sent.delete()
+                except discord.HTTPException as e: logger.warning(f"Failed to delete streamed message {sent.id}: {e}")
+            self._sent, self._current, self._text, self._shown = [], None, "", ""
+
+    # --- 内部処理 ---
+    async def _append(self, text: str, schedule: bool = True):
+        async with self._lock:
+            if self.max_total_length is not None and self._total + len(text) > self.max_total_length:
+                logger.info(f"Streamed response exceeded max length ({self.max_total_length}). Truncating.")
+                keep = self.max_total_length - 3 - self._total
+                if keep >= 0: text = text[:keep] + "..."
+                else: # 上限ちょうどまで表示済みの場合は末尾を "..." に置き換える
+                    self._text, self._total, text = self._text[:keep], self._total + keep, "..."
+                self.truncated = True
+            self._text += text
+            self._total += len(text)
+            while len(self._text) > self.max_length and not self.failed:
+                end = helpers.find_split_end(self._text, 0, self.max_length)
+                self._text, rest = self._text[:end], self._text[end:]
+                await self._flush_nolock()
+                self._current, self._text, self._shown = None, rest, ""
+            if self._current is None or time.perf_counter() - self._last_edit >= self.edit_interval:
+                await self._flush_nolock()
+            elif schedule and self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(max(self.edit_interval - (time.perf_counter() - self._last_edit), 0))
+        self._flush_task = None
+        async with self._lock: await self._flush_nolock()
+
+    def _cancel_flush_task(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def _flush_nolock(self):
+        text = self._text
+        if self.failed or text == self._shown or not text.strip(): return
+        try:
+            if self._current is None:
+                if self._sent or isinstance(self._message.channel, discord.DMChannel): self._current = await self._message.channel.send(text)
+                else: self._current = await self._message.reply(text, mention_author=False)
+                self._sent.append(self._current)
+                if self.first_visible_after is None: self.first_visible_after = time.perf_counter() - self._started_at
+            else:
+                await self._current.edit(content=text)
+                self.edits += 1
+            self._shown = text
+            self._last_edit = time.perf_counter()
+        except discord.HTTPException as e:
+            self.failed = True
+            logger.error(f"HTTPException while streaming response (length: {len(text)}): {e.status} {e.code} {e.text}", exc_info=False)
+            try:
+                 await self._message.channel.send(f"(メッセージの一部送信に失敗しました: Discord APIエラー {e.code})")
+            except Exception:
+                 logger.error(f"Failed to send error notification about streaming failure.")
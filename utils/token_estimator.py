@@ -0,0 +1,96 @@
+# utils/token_estimator.py (API を呼ばずに入力トークン数を見積もる。日本語と英語で1トークンあたりの文字数を変える)
+
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+ASCII_CHARS_PER_TOKEN = 4.0 # 英語・記号・URL (Gemini のトークナイザーでおおむね4文字で1トークン)
+NON_ASCII_CHARS_PER_TOKEN = 1.4 # 日本語 (かな・漢字) などの非ASCII文字
+INLINE_DATA_TOKENS = 258 # 画像1枚 (PDF は1ページ) あたりのトークン数
+CONTENT_OVERHEAD_TOKENS = 4 # Content ごとの役割などの区切り
+CALIBRATION_SMOOTHING = 0.1 # 実測値で補正係数を更新するときの重み
+CALIBRATION_RANGE = (0.5, 2.0) # 補正係数の範囲 (外れ値で見積もりが壊れないようにする)
+
+
+def estimate_text_tokens(text: str) -> int:
+    """テキストのトークン数の見積もり (文字ごとに数えず、UTF-8 のバイト数との差から非ASCII文字の数を求める)"""
+    if not text: return 0
+    if text.isascii(): return int(len(text) / ASCII_CHARS_PER_TOKEN) + 1
+    # 日本語は UTF-8 で3バイトなので、(バイト数 - 文字数) / 2 がおおよその非ASCII文字数になる
+    non_ascii = (len(text.encode('utf-8')) - len(text)) // 2
+    return int((len(text) - non_ascii) / ASCII_CHARS_PER_TOKEN + non_ascii / NON_ASCII_CHARS_PER_TOKEN) + 1
+
+def estimate_part_tokens(part: Any) -> int:
+    text = getattr(part, 'text', None)
+    if text: return estimate_text_tokens(text)
+    if getattr(part, 'inline_data', None) is not None: return INLINE_DATA_TOKENS
+    for name in ('function_call', 'function_response'):
+        value = getattr(part, name, None)
+        if value is not None: return estimate_text_tokens(repr(value))
+    return 0
+
+def estimate_content_tokens(content: Any) -> int:
+    """Content (または文字列) 1つのトークン数の見積もり"""
+    if isinstance(content, str): return estimate_text_tokens(content) + CONTENT_OVERHEAD_TOKENS
+    return sum(estimate_part_tokens(part) for part in getattr(content, 'parts', None) or ()) + CONTENT_OVERHEAD_TOKENS
+
+def estimate_contents_tokens(contents: Iterable[Any]) -> int:
+    return sum(estimate_content_tokens(content) for content in contents)
+
+
+class TokenMetrics:
+    """送ったトークン数の記録と、実測値による見積もりの補正
+
+    scale は「実際のトークン数 / 見積もり」の移動平均。応答の usage_metadata や count_tokens の結果で更新し、
+    見積もりに掛けて使う。
+    """
+
+    def __init__(self):
+        self.scale = 1.0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = 0
+        self.truncated_requests = 0 # トークン予算のために履歴を削った回数
+        self.dropped_entries = 0
+        self.history_tokens = 0 # 履歴として送った見積もりトークン数の合計
+        self.max_history_tokens = 0
+        self.observations = 0
+        self.estimated_prompt_tokens = 0 # 実測値が分かったリクエストの見積もりの合計
+        self.actual_prompt_tokens = 0
+        self.last: Optional[Dict[str, Any]] = None
+
+    def calibrated(self, raw_tokens: int) -> int: return int(raw_tokens * self.scale)
+
+    def observe(self, raw_tokens: int, actual_tokens: Optional[int]):
+        """補正前の見積もりと実際のトークン数を記録し、補正係数を更新する"""
+        if not actual_tokens or raw_tokens <= 0: return
+        ratio = min(max(actual_tokens / raw_tokens, CALIBRATION_RANGE[0]), CALIBRATION_RANGE[1])
+        self.scale += (ratio - self.scale) * CALIBRATION_SMOOTHING
+        self.observations += 1
+
+    def record_history_window(self, selected: int, total: int, tokens: int, budget: int):
+        """1リクエストで履歴から選んだ件数とトークン数を記録する"""
+        self.requests += 1
+        self.history_tokens += tokens
+        self.max_history_tokens = max(self.max_history_tokens, tokens)
+        if selected < total:
+            self.truncated_requests += 1
+            self.dropped_entries += total - selected
+        self.last = {"history_entries": selected, "history_total": total, "history_tokens": tokens, "budget": budget}
+
+    def record_prompt(self, raw_tokens: int, actual_tokens: Optional[int]):
+        """送ったリクエスト全体の見積もりと、応答の usage_metadata の入力トークン数を記録する"""
+        if actual_tokens:
+            self.estimated_prompt_tokens += self.calibrated(raw_tokens)
+            self.actual_prompt_tokens += actual_tokens
+        self.observe(raw_tokens, actual_tokens)
+        if self.last is not None: self.last = {**self.last, "prompt_estimated": self.calibrated(raw_tokens), "prompt_actual": actual_tokens}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "truncated_requests": self.truncated_requests, "dropped_entries": self.dropped_entries,
+                "avg_history_tokens": self.history_tokens / self.requests if self.requests else 0.0,
+                "max_history_tokens": self.max_history_tokens, "scale": self.scale, "observations": self.observations,
+                "estimated_prompt_tokens": self.estimated_prompt_tokens, "actual_prompt_tokens": self.actual_prompt_tokens,
+                "last": self.last}